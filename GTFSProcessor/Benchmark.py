@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+import platform
+import tempfile
+import threading
+import subprocess
+
+from io                         import StringIO
+from shutil                     import rmtree
+from contextlib                 import redirect_stdout
+from concurrent.futures         import ThreadPoolExecutor, ProcessPoolExecutor
+
+from GTFSProcessor              import Routes
+from GTFSProcessor              import Snapshot
+from GTFSProcessor              import Synthetic
+from GTFSProcessor              import ZIPImporter
+from GTFSProcessor.Instrumentation import Instrumentation
+
+
+# write_synthetic_feed arguments per named feed size
+FEED_SIZES = {
+    'small': {'stop_count': 1000, 'route_count': 50, 'trip_count': 2000,
+        'stops_per_trip': 20},
+    'medium': {'stop_count': 10000, 'route_count': 300, 'trip_count': 25000,
+        'stops_per_trip': 20},
+    'large': {'stop_count': 50000, 'route_count': 2000, 'trip_count': 250000,
+        'stops_per_trip': 40},
+    }
+DEFAULT_SIZES = ('small', 'medium')
+QUERY_SAMPLE_STOPS = 200
+# time of day of the benchmarked next departures queries
+NEXT_DEPARTURES_AFTER = '08:00:00'
+# radius of the benchmarked stops near queries, around the sampled stops
+STOPS_NEAR_RADIUS_M = 300
+CLI_RUNS = 5
+# threads querying a RoutesPool at once in the concurrency benchmark
+CONCURRENCY_THREADS = (1, 2, 4, 8)
+# stop reports per thread count, split between the threads
+CONCURRENCY_QUERIES = 4000
+ROUTES_AT_STOP_PATH = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'routes_at_stop.py')
+
+
+def _summarise_latencies(latencies) -> dict:
+    '''latencies in seconds, returns microseconds'''
+    latencies = sorted(latencies)
+    def percentile(percent):
+        return latencies[min(len(latencies) - 1,
+                int(round(percent / 100 * (len(latencies) - 1))))] * 1e6
+    return {'calls': len(latencies),
+            'mean_us': sum(latencies) / len(latencies) * 1e6,
+            'p50_us': percentile(50),
+            'p99_us': percentile(99),
+            'max_us': latencies[-1] * 1e6}
+
+
+def _time_calls(function, args_list) -> dict:
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+    return _summarise_latencies(latencies)
+
+
+def benchmark_import(zip_path, db_path, batch_size=ZIPImporter.DEFAULT_BATCH_SIZE
+        ) -> dict:
+    '''returns {'total_sec', 'phases': {phase : {'wall_sec', 'rows',
+    'rows_per_sec', 'process_peak_rss_kb'}}, 'db_size_bytes'}'''
+    # earlier runs' generations would add to the timed import's bookkeeping
+    ZIPImporter.remove_database(db_path)
+    instrumentation = Instrumentation()
+    start = time.perf_counter()
+    ZIPImporter.import_into_database(zip_path, db_path, batch_size,
+            instrumentation=instrumentation)
+    total_sec = time.perf_counter() - start
+    phases = {record['name']: {key: record[key] for key in
+                ('wall_sec', 'rows', 'rows_per_sec',
+                    'process_peak_rss_kb')}
+            for record in instrumentation.report()['phases']}
+    return {'total_sec': total_sec, 'phases': phases,
+            'db_size_bytes': os.path.getsize(db_path)}
+
+
+def benchmark_queries(db_path, sample_stops=QUERY_SAMPLE_STOPS, seed=0) -> dict:
+    '''latency of each Routes query on one open session, over a sample of
+    stops and of the routes serving them, for every backend. The snapshot
+    is exported first'''
+    with sqlite3.connect(db_path) as db_connection:
+        stops = db_connection.execute(
+                'SELECT id, lat, lon FROM Stop ORDER BY id;').fetchall()
+        pairs = db_connection.execute('''SELECT Stop.id, Route.id
+                FROM Stop_Route_Summary
+                JOIN Stop ON Stop.key = Stop_Route_Summary.stop_key
+                JOIN Route ON Route.key = Stop_Route_Summary.route_key;
+                ''').fetchall()
+    db_connection.close()
+    rng = random.Random(seed)
+    sampled_stops = rng.sample(stops, min(sample_stops, len(stops)))
+    stop_args = [(stop_id,) for stop_id, _, _ in sampled_stops]
+    pair_args = rng.sample(pairs, min(sample_stops, len(pairs)))
+    route_args = [(route_id,) for _, route_id in pair_args]
+    route_stop_args = [(route_id, stop_id) for stop_id, route_id in pair_args]
+    next_departures_args = [(stop_id, NEXT_DEPARTURES_AFTER)
+            for stop_id, in stop_args]
+    stops_near_args = [(lat, lon, STOPS_NEAR_RADIUS_M)
+            for _, lat, lon in sampled_stops if lat is not None]
+    start = time.perf_counter()
+    snapshot_size = Snapshot.export_snapshot(db_path)
+    export_sec = time.perf_counter() - start
+    results = {}
+    for backend in Routes.BACKENDS:
+        start = time.perf_counter()
+        session = Routes.open_session(db_path, backend)
+        backend_results = {'open_sec': time.perf_counter() - start}
+        if backend == 'snapshot':
+            backend_results['export_sec'] = export_sec
+            backend_results['size_bytes'] = snapshot_size
+        with session:
+            for name, args_list in (
+                    ('check_if_stop_exists', stop_args),
+                    ('get_stop_name', stop_args),
+                    ('get_route_ids_passing_through_stop', stop_args),
+                    ('get_route_short_name', route_args),
+                    ('get_route_long_name', route_args),
+                    ('get_earliest_service_for_stop_on_trip', route_stop_args),
+                    ('get_latest_service_for_stop_on_trip', route_stop_args),
+                    ('get_stop_report', stop_args),
+                    ('get_next_departures', next_departures_args),
+                    ('get_stops_near', stops_near_args)):
+                backend_results[name] = _time_calls(getattr(session, name),
+                        args_list)
+            start = time.perf_counter()
+            list(session.get_stop_reports([args[0] for args in stop_args]))
+            backend_results['get_stop_reports_sec'] = (time.perf_counter()
+                    - start)
+        results[backend] = backend_results
+    return results
+
+
+def benchmark_cli(db_path, stop_id, runs=CLI_RUNS) -> dict:
+    '''wall time of a complete routes_at_stop.py process'''
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, ROUTES_AT_STOP_PATH, db_path,
+                str(stop_id)], stdout=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - start)
+    return _summarise_latencies(latencies)
+
+
+def _run_query_threads(function, args_list, threads, until=None) -> tuple:
+    '''calls function(*args) for each of args_list, split between threads
+    threads; with until, a threading.Event, the threads cycle through their
+    args until it is set. returns (elapsed sec, latencies, errors)'''
+    latencies = []
+    errors = [0]
+
+    def run(thread_args_list):
+        thread_latencies = []
+        while True:
+            for args in thread_args_list:
+                start = time.perf_counter()
+                try:
+                    function(*args)
+                except Exception:
+                    errors[0] += 1
+                thread_latencies.append(time.perf_counter() - start)
+            if until is None or until.is_set():
+                break
+        latencies.extend(thread_latencies)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for future in [executor.submit(run, args_list[i::threads])
+                for i in range(threads)]:
+            future.result()
+    return time.perf_counter() - start, latencies, errors[0]
+
+
+def _import_quietly(zip_path, db_path) -> float:
+    '''runs in a process of its own, as import.py would. returns the import
+    wall time'''
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        ZIPImporter.import_into_database(zip_path, db_path,
+                instrumentation=Instrumentation())
+    return time.perf_counter() - start
+
+
+def benchmark_concurrency(db_path, zip_path, thread_counts=CONCURRENCY_THREADS,
+        queries=CONCURRENCY_QUERIES, seed=0) -> dict:
+    '''
+    Throughput of stop reports & next departures over a Routes.RoutesPool
+    shared by each of thread_counts threads, and of a single RoutesSession
+    shared by the most threads for comparison. Then zip_path is imported
+    into db_path again by another process while the most threads keep
+    querying stop reports: every query must succeed and the pool end on the
+    new generation.
+    returns {'pool': {query : {threads : {'queries_per_sec', 'speedup',
+    latencies}}}, 'shared_session': {query : {...}}, 'import_under_load':
+    {'import_sec', 'errors', 'moved_to_new_generation', latencies}}
+    '''
+    with sqlite3.connect(db_path) as db_connection:
+        stop_ids = [stop_id for stop_id, in db_connection.execute(
+                'SELECT id FROM Stop ORDER BY id;')]
+    db_connection.close()
+    rng = random.Random(seed)
+    sampled_stop_ids = [rng.choice(stop_ids) for _ in range(queries)]
+    args_lists = {
+        'get_stop_report': [(stop_id,) for stop_id in sampled_stop_ids],
+        'get_next_departures': [(stop_id, NEXT_DEPARTURES_AFTER)
+            for stop_id in sampled_stop_ids],
+        }
+    max_threads = max(thread_counts)
+
+    def summarise(elapsed_sec, latencies, errors):
+        return dict(_summarise_latencies(latencies), errors=errors,
+                queries_per_sec=len(latencies) / elapsed_sec)
+
+    results = {'pool': {}, 'shared_session': {}}
+    with Routes.RoutesPool(db_path, max_threads) as pool:
+        for name, args_list in args_lists.items():
+            query_results = results['pool'][name] = {}
+            for threads in thread_counts:
+                query_results[threads] = summarise(*_run_query_threads(
+                        getattr(pool, name), args_list, threads))
+                query_results[threads]['speedup'] = (
+                        query_results[threads]['queries_per_sec']
+                        / query_results[thread_counts[0]]['queries_per_sec'])
+            with Routes.RoutesSession(db_path) as session:
+                results['shared_session'][name] = summarise(
+                        *_run_query_threads(getattr(session, name),
+                            args_list, max_threads))
+        generation = pool.generation
+        done = threading.Event()
+        with ProcessPoolExecutor(1) as executor:
+            import_future = executor.submit(_import_quietly, zip_path,
+                    db_path)
+            import_future.add_done_callback(lambda future: done.set())
+            load = summarise(*_run_query_threads(pool.get_stop_report,
+                    args_lists['get_stop_report'], max_threads, until=done))
+            load['import_sec'] = import_future.result()
+        pool.get_stop_report(sampled_stop_ids[0])
+        load['moved_to_new_generation'] = pool.generation != generation
+        results['import_under_load'] = load
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, work_dir=None) -> dict:
+    '''
+    For each named size in FEED_SIZES: generates the synthetic feed, then
+    benchmarks the import, the Routes queries, routes_at_stop.py and the
+    query throughput of threads sharing a RoutesPool.
+    returns a JSON serialisable dict
+    '''
+    own_work_dir = work_dir is None
+    if own_work_dir:
+        work_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for size in sizes:
+            zip_path = os.path.join(work_dir, '%s.zip' % size)
+            db_path = os.path.join(work_dir, '%s.sqlite' % size)
+            start = time.perf_counter()
+            feed = Synthetic.write_synthetic_feed(zip_path, **FEED_SIZES[size])
+            feed['generate_sec'] = time.perf_counter() - start
+            import_result = benchmark_import(zip_path, db_path)
+            query_result = benchmark_queries(db_path)
+            cli_result = benchmark_cli(db_path, 1)
+            concurrency_result = benchmark_concurrency(db_path, zip_path)
+            results.append({'size': size, 'feed': feed,
+                    'import': import_result, 'queries': query_result,
+                    'routes_at_stop_cli': cli_result,
+                    'concurrency': concurrency_result})
+    finally:
+        if own_work_dir:
+            rmtree(work_dir)
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'results': results}
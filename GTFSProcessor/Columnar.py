@@ -0,0 +1,149 @@
+from array                      import array
+from operator                   import add
+from itertools                  import repeat
+
+try:
+    import numpy
+except ImportError:
+    # columns are then stdlib arrays, and times are converted by maps over
+    # their characters instead of with array arithmetic
+    numpy = None
+
+
+# a time convert_times could not convert, no time converts to the smallest
+# int32
+INVALID_TIME = -1 << 31
+# HH:MM:SS, longer times are converted one by one by the NumPy path
+TIME_WIDTH = 8
+# positions of the digits and of the colons in a HH:MM:SS time
+TIME_DIGIT_POSITIONS = (0, 1, 3, 4, 6, 7)
+TIME_COLON_POSITIONS = (2, 5)
+SECONDS_COLUMN_TYPECODE = 'i'
+# seconds of each two digit hour, minute & second, for the stdlib path
+HOUR_SECONDS = {'%02d' % i: i * 3600 for i in range(100)}
+MINUTE_SECONDS = {'%02d' % i: i * 60 for i in range(100)}
+SECOND_SECONDS = {'%02d' % i: i for i in range(100)}
+
+
+def split_columns(text, column_count, indexes) -> list:
+    '''
+    The columns at indexes of text, whole CSV lines of column_count fields,
+    as lists of str. The lines are checked & split by str methods over the
+    whole text, no object is created per row but the fields.
+    returns None if a line is blank, quoted or has another field count, the
+    text is then to be parsed record by record
+    '''
+    if '"' in text:
+        return None
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    if not lines:
+        return [[] for _ in indexes]
+    if set(map(str.count, lines, repeat(',', len(lines)))) \
+            != {column_count - 1}:
+        return None
+    fields = ','.join(lines).split(',')
+    return [fields[i::column_count] for i in indexes]
+
+
+def map_distinct(values, function) -> list:
+    '''[function(value) for value in values], function being called once per
+    distinct value'''
+    results = {value: function(value) for value in set(values)}
+    return list(map(results.__getitem__, values))
+
+
+def _convert_or_invalid(time_string, convert_time) -> int:
+    if time_string is None:
+        return INVALID_TIME
+    try:
+        return convert_time(time_string)
+    except ValueError:
+        return INVALID_TIME
+
+
+def _convert_times_with_numpy(times, convert_time):
+    '''HH:MM:SS and H:MM:SS times are converted by array arithmetic on their
+    code points, any other value by convert_time'''
+    codes = numpy.array(times, dtype='U%d' % TIME_WIDTH).view(
+            numpy.uint32).reshape(-1, TIME_WIDTH).astype(numpy.int32)
+    short = codes[:, TIME_WIDTH - 1] == 0
+    if short.any():
+        codes[short, 1:] = codes[short, :-1]
+        codes[short, 0] = ord('0')
+    digits = codes - ord('0')
+    valid = ((codes[:, TIME_COLON_POSITIONS] == ord(':')).all(axis=1)
+            & ((digits[:, TIME_DIGIT_POSITIONS] >= 0)
+                & (digits[:, TIME_DIGIT_POSITIONS] <= 9)).all(axis=1))
+    seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600
+            + (digits[:, 3] * 10 + digits[:, 4]) * 60
+            + digits[:, 6] * 10 + digits[:, 7])
+    for i in numpy.flatnonzero(~valid):
+        seconds[i] = _convert_or_invalid(times[i], convert_time)
+    return seconds
+
+
+def _get_digit_pairs(text, position) -> map:
+    '''the two characters at position of each TIME_WIDTH wide time of
+    text'''
+    return map(add, text[position::TIME_WIDTH],
+            text[position + 1::TIME_WIDTH])
+
+
+def _convert_times_with_str_maps(times) -> list:
+    '''HH:MM:SS and H:MM:SS times converted by maps over the characters at
+    each position of the times, looked up in HOUR_SECONDS etc. returns None
+    if any time has another format'''
+    if None in times or max(map(len, times)) > TIME_WIDTH:
+        return None
+    text = ''.join(map(str.rjust, times, repeat(TIME_WIDTH), repeat('0')))
+    colons = ':' * len(times)
+    if (not text.isascii() or text[2::TIME_WIDTH] != colons
+            or text[5::TIME_WIDTH] != colons
+            or not text.replace(':', '').isdigit()):
+        return None
+    return list(map(add, map(add,
+            map(HOUR_SECONDS.__getitem__, _get_digit_pairs(text, 0)),
+            map(MINUTE_SECONDS.__getitem__, _get_digit_pairs(text, 3))),
+            map(SECOND_SECONDS.__getitem__, _get_digit_pairs(text, 6))))
+
+
+def convert_times(times, convert_time):
+    '''
+    The seconds of each of times, a list of str or None, as a NumPy int32
+    array or without NumPy an array('i'). The times of a chunk are
+    converted all at once; when some are not [H]H:MM:SS, by NumPy row by
+    row or without it by convert_time once per distinct value. Values
+    convert_time raises ValueError for, and None, are INVALID_TIME.
+    '''
+    if not times:
+        return array(SECONDS_COLUMN_TYPECODE)
+    if (numpy is not None and None not in times
+            and max(map(len, times)) <= TIME_WIDTH):
+        return _convert_times_with_numpy(times, convert_time)
+    seconds = None if numpy is not None else _convert_times_with_str_maps(
+            times)
+    if seconds is None:
+        seconds = map_distinct(times,
+                lambda value: _convert_or_invalid(value, convert_time))
+    if numpy is not None:
+        return numpy.array(seconds, dtype=numpy.int32)
+    return array(SECONDS_COLUMN_TYPECODE, seconds)
+
+
+def get_indexes(column, value) -> list:
+    '''the indexes of the entries of column equal to value'''
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return numpy.flatnonzero(column == value).tolist()
+    if value not in column:
+        return []
+    return [i for i, item in enumerate(column) if item == value]
+
+
+def to_list(column) -> list:
+    '''the values of a column as Python objects, which is what sqlite3
+    binds'''
+    return column.tolist()
@@ -0,0 +1,152 @@
+import json
+import time
+import functools
+import threading
+import tracemalloc
+
+from contextlib                 import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak RSS is then reported as None
+    resource = None
+
+
+def _get_process_peak_rss_kb():
+    '''peak resident set size of this process so far, in KB on Linux. Not
+    reset between phases: it only grows past the earlier phases' peak'''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def print_phase(event):
+    '''hook printing each finished import phase, the default console output'''
+    if event['type'] != 'phase':
+        return
+    line = 'Processed %s: %d rows in %.2fs (%d rows/sec' % (event['name'],
+            event['rows'], event['wall_sec'], event['rows_per_sec'])
+    if event['process_peak_rss_kb'] is not None:
+        line += ', process peak RSS %.1f MB' % (
+                event['process_peak_rss_kb'] / 1024)
+    if event['peak_traced_bytes'] is not None:
+        line += ', peak traced %.1f MB' % (event['peak_traced_bytes'] / 1e6)
+    print(line + ').')
+
+
+class Instrumentation:
+    '''
+    Collects import phase measurements (wall time, rows, rows/sec, the peak
+    RSS of the process so far and, with trace_memory, the tracemalloc peak
+    of the phase) and Routes query counts & latencies.
+    Every measurement is also passed as an event dict to the registered
+    hooks, report() returns everything collected as a JSON serialisable
+    dict.
+
+    instrumentation = Instrumentation()
+    instrumentation.add_hook(print)
+    ZIPImporter.import_into_database(zip_path, db_path,
+            instrumentation=instrumentation)
+    instrumentation.to_json()
+    '''
+    def __init__(self, hooks=(), trace_memory=False):
+        self.hooks = list(hooks)
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.queries = {}
+        self._lock = threading.Lock()
+        self._phase_depth = 0
+        self._started_tracing = False
+        # per open phase, the traced peak before the phases nested in it
+        # reset it
+        self._traced_peaks = []
+
+    def add_hook(self, hook):
+        '''hook(event) is called with every phase and query event'''
+        self.hooks.append(hook)
+
+    def _notify(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    @contextmanager
+    def phase(self, name):
+        '''times the body, which may set 'rows' on the yielded dict. With
+        trace_memory, tracemalloc is started if it is not tracing yet and
+        stopped again when the outermost phase exits. The traced peak of a
+        phase includes the phases nested in it'''
+        record = {'type': 'phase', 'name': name, 'rows': 0}
+        if self.trace_memory:
+            if self._phase_depth == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            peak = tracemalloc.get_traced_memory()[1]
+            self._traced_peaks = [max(outer_peak, peak)
+                    for outer_peak in self._traced_peaks] + [0]
+            tracemalloc.reset_peak()
+        self._phase_depth += 1
+        start = time.perf_counter()
+        try:
+            yield record
+            record['wall_sec'] = time.perf_counter() - start
+            record['rows_per_sec'] = (record['rows'] / record['wall_sec']
+                    if record['wall_sec'] > 0 else float(record['rows']))
+            record['process_peak_rss_kb'] = _get_process_peak_rss_kb()
+            record['peak_traced_bytes'] = (max(self._traced_peaks[-1],
+                        tracemalloc.get_traced_memory()[1])
+                    if self.trace_memory else None)
+        finally:
+            self._phase_depth -= 1
+            if self.trace_memory:
+                self._traced_peaks.pop()
+            if self._phase_depth == 0 and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        self.record_phase(record)
+
+    def record_phase(self, record):
+        '''records a phase measured elsewhere, e.g. in another process'''
+        with self._lock:
+            self.phases.append(record)
+        self._notify(record)
+
+    def record_query(self, name, latency_sec):
+        with self._lock:
+            stats = self.queries.get(name)
+            if stats is None:
+                stats = self.queries[name] = {'count': 0, 'total_sec': 0.0,
+                        'max_sec': 0.0}
+            stats['count'] += 1
+            stats['total_sec'] += latency_sec
+            stats['max_sec'] = max(stats['max_sec'], latency_sec)
+        if self.hooks:
+            self._notify({'type': 'query', 'name': name,
+                    'latency_sec': latency_sec})
+
+    def report(self) -> dict:
+        with self._lock:
+            queries = {name: dict(stats, mean_us=stats['total_sec']
+                        / stats['count'] * 1e6)
+                    for name, stats in self.queries.items()}
+            return {'phases': [dict(record) for record in self.phases],
+                    'queries': queries}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.report(), **kwargs)
+
+
+def instrumented_query(method):
+    '''decorates a query method of an object with an 'instrumentation'
+    attribute, recording the latency of each call under the method name'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.instrumentation.record_query(method.__name__,
+                    time.perf_counter() - start)
+    return wrapper
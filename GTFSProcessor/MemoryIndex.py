@@ -0,0 +1,366 @@
+import math
+import heapq
+import sqlite3
+
+from sys                        import intern
+from array                      import array
+from bisect                     import bisect_left, bisect_right
+from itertools                  import islice
+
+from GTFSProcessor.Routes       import (_optional_seconds_to_str,
+                                        _get_read_only_uri,
+                                        _time_of_day_to_seconds,
+                                        _get_service_day_bounds,
+                                        _merge_next_departures,
+                                        _get_bounding_box,
+                                        _get_nearest_stops,
+                                        _add_stop_location,
+                                        DEFAULT_STOP_CHUNK_SIZE,
+                                        DEFAULT_NEXT_DEPARTURES)
+from GTFSProcessor.Instrumentation import instrumented_query
+
+
+# every departure of every (stop, route) pair, in the order the arrays are
+# built. A pair without departures is a single row with a NULL departure
+DEPARTURES_SQL = '''SELECT Stop_Route_Summary.stop_key,
+                        Stop_Route_Summary.route_key,
+                        Stop_Departure.departure_time_in_sec,
+                        Stop_Departure.trip_key
+                    FROM Stop_Route_Summary
+                    LEFT JOIN Stop_Departure
+                    ON Stop_Departure.stop_key = Stop_Route_Summary.stop_key
+                    AND Stop_Departure.route_key = Stop_Route_Summary.route_key
+                    ORDER BY Stop_Route_Summary.stop_key,
+                        Stop_Route_Summary.route_key,
+                        Stop_Departure.departure_time_in_sec,
+                        Stop_Departure.trip_key;'''
+STOPS_SQL = '''SELECT key, id, name, lat, lon FROM Stop ORDER BY key;'''
+ROUTES_SQL = '''SELECT key, id, short_name, long_name FROM Route
+                    ORDER BY key;'''
+TRIPS_SQL = '''SELECT key, id FROM Trip ORDER BY key;'''
+# side of the cells of the stop location grid, in degrees of latitude and
+# longitude, about 1.1km north-south
+GRID_CELL_DEGREES = 0.01
+GRID_COLUMNS = int(360 / GRID_CELL_DEGREES) + 1
+
+
+def _to_key(value):
+    '''ids are stored with INT affinity, so '29' and 29 name the same row.
+    Mirrors that for dict lookups'''
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+def _get_grid_cell(lat, lon) -> tuple:
+    '''(row, column) of the grid cell holding the point'''
+    return (int((lat + 90) // GRID_CELL_DEGREES),
+            int((lon + 180) // GRID_CELL_DEGREES))
+
+
+def _get_grid_cell_id(lat, lon) -> int:
+    '''cells are numbered row by row, so the cells of a row between two
+    columns have consecutive ids'''
+    row, column = _get_grid_cell(lat, lon)
+    return row * GRID_COLUMNS + column
+
+
+class ArrayRoutesIndex:
+    '''
+    The Routes query surface served from flat arrays, with no SQL at query
+    time. Subclasses provide the arrays and tables below.
+
+    Layout, CSR style:
+      stops, routes and trips are numbered 0..n in surrogate key order.
+      stop_pair_offsets[i] .. stop_pair_offsets[i+1] is the slice of
+      (stop, route) pairs for stop i, sorted by route index.
+      pair_route_index holds each pair's route and
+      pair_departure_offsets[p] .. pair_departure_offsets[p+1] the slice of
+      departure_sec, sorted, for pair p, with the trip of each departure in
+      departure_trip_index.
+      _stop_names, _route_ids, _route_short_names, _route_long_names and
+      _trip_ids are indexed like the arrays, _stop_index_map and
+      _route_index_map map a GTFS id to its index.
+      stop_lat and stop_lon hold each stop's coordinates, NaN if it has
+      none. grid_cell_ids lists the grid cells holding stops in id order,
+      grid_cell_offsets[c] .. grid_cell_offsets[c+1] is the slice of
+      grid_stop_index listing the stops in cell c.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''nothing to release, kept for parity with RoutesSession'''
+
+    def _get_pair_range(self, stop_id) -> tuple:
+        stop_index = self._stop_index_map.get(_to_key(stop_id))
+        if stop_index is None:
+            return 0, 0
+        return (self.stop_pair_offsets[stop_index],
+                self.stop_pair_offsets[stop_index + 1])
+
+    def _find_pair(self, route_id, stop_id):
+        '''returns the pair index of (stop_id, route_id), or None'''
+        route_index = self._route_index_map.get(_to_key(route_id))
+        if route_index is None:
+            return None
+        lo, hi = self._get_pair_range(stop_id)
+        pair = bisect_left(self.pair_route_index, route_index, lo, hi)
+        if pair < hi and self.pair_route_index[pair] == route_index:
+            return pair
+        return None
+
+    def _get_pair_earliest_sec(self, pair) -> int:
+        '''None if the pair has no departures'''
+        lo, hi = self.pair_departure_offsets[pair:pair + 2]
+        return self.departure_sec[lo] if lo < hi else None
+
+    def _get_pair_latest_sec(self, pair) -> int:
+        '''None if the pair has no departures'''
+        lo, hi = self.pair_departure_offsets[pair:pair + 2]
+        return self.departure_sec[hi - 1] if lo < hi else None
+
+    @instrumented_query
+    def check_if_stop_exists(self, stop_id) -> bool:
+        return _to_key(stop_id) in self._stop_index_map
+
+    @instrumented_query
+    def get_stop_name(self, stop_id) -> str:
+        '''if there is no match, returns an empty str'''
+        stop_index = self._stop_index_map.get(_to_key(stop_id))
+        return '' if stop_index is None else self._stop_names[stop_index]
+
+    @instrumented_query
+    def get_route_ids_passing_through_stop(self, stop_id) -> set:
+        '''if there is no match, returns an empty set'''
+        lo, hi = self._get_pair_range(stop_id)
+        return set([self._route_ids[route_index]
+                for route_index in self.pair_route_index[lo:hi]])
+
+    @instrumented_query
+    def get_route_short_name(self, route_id) -> str:
+        '''If there is no match, returns an empty str'''
+        route_index = self._route_index_map.get(_to_key(route_id))
+        return ('' if route_index is None
+                else self._route_short_names[route_index])
+
+    @instrumented_query
+    def get_route_long_name(self, route_id) -> str:
+        '''If there is no match, returns an empty str'''
+        route_index = self._route_index_map.get(_to_key(route_id))
+        return ('' if route_index is None
+                else self._route_long_names[route_index])
+
+    @instrumented_query
+    def get_latest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''If there is no match, returns an empty str'''
+        pair = self._find_pair(route_id, stop_id)
+        if pair is None:
+            return ''
+        return _optional_seconds_to_str(self._get_pair_latest_sec(pair))
+
+    @instrumented_query
+    def get_earliest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''If there is no match, returns an empty str'''
+        pair = self._find_pair(route_id, stop_id)
+        if pair is None:
+            return ''
+        return _optional_seconds_to_str(self._get_pair_earliest_sec(pair))
+
+    @instrumented_query
+    def get_stop_report(self, stop_id) -> dict:
+        '''see RoutesSession.get_stop_report'''
+        stop_index = self._stop_index_map.get(_to_key(stop_id))
+        if stop_index is None:
+            return {}
+        return self._get_stop_report(stop_index, stop_id)
+
+    def _get_stop_report(self, stop_index, stop_id) -> dict:
+        routes = []
+        for pair in range(self.stop_pair_offsets[stop_index],
+                self.stop_pair_offsets[stop_index + 1]):
+            route_index = self.pair_route_index[pair]
+            routes.append({'route_id': self._route_ids[route_index],
+                'short_name': self._route_short_names[route_index],
+                'long_name': self._route_long_names[route_index],
+                'earliest': _optional_seconds_to_str(
+                    self._get_pair_earliest_sec(pair)),
+                'latest': _optional_seconds_to_str(
+                    self._get_pair_latest_sec(pair))})
+        return {'stop_id': stop_id, 'stop_name': self._stop_names[stop_index],
+                'routes': routes}
+
+    def _get_grid_stops(self, min_lat, max_lat, min_lon, max_lon):
+        '''yields the index of every stop in the grid cells covering the
+        bounding box'''
+        min_row, min_column = _get_grid_cell(min_lat, min_lon)
+        max_row, max_column = _get_grid_cell(max_lat, max_lon)
+        for row in range(min_row, max_row + 1):
+            lo = bisect_left(self.grid_cell_ids, row * GRID_COLUMNS
+                    + min_column)
+            hi = bisect_right(self.grid_cell_ids, row * GRID_COLUMNS
+                    + max_column, lo)
+            yield from self.grid_stop_index[self.grid_cell_offsets[lo]:
+                    self.grid_cell_offsets[hi]]
+
+    @instrumented_query
+    def get_stops_near(self, lat, lon, radius_m, limit=None) -> list:
+        '''see RoutesSession.get_stops_near, the candidate stops are those
+        of the grid cells covering the bounding box'''
+        nearest = _get_nearest_stops(lat, lon, radius_m,
+                ((stop_index, self.stop_lat[stop_index],
+                  self.stop_lon[stop_index], stop_index)
+                 for stop_index in self._get_grid_stops(
+                     *_get_bounding_box(lat, lon, radius_m))), limit)
+        return [_add_stop_location(self._get_stop_report(stop_index,
+                    str(self._stop_ids[stop_index])), stop_lat, stop_lon,
+                    distance_m)
+                for distance_m, stop_lat, stop_lon, stop_index in nearest]
+
+    def _get_pair_departures(self, pair, min_sec):
+        '''yields the departures of pair from min_sec on, in the row layout
+        of Routes.NEXT_DEPARTURES_SQL'''
+        route_index = self.pair_route_index[pair]
+        hi = self.pair_departure_offsets[pair + 1]
+        for i in range(bisect_left(self.departure_sec, min_sec,
+                self.pair_departure_offsets[pair], hi), hi):
+            trip_index = self.departure_trip_index[i]
+            yield (self.departure_sec[i], trip_index,
+                    self._trip_ids[trip_index],
+                    self._route_ids[route_index],
+                    self._route_short_names[route_index],
+                    self._route_long_names[route_index])
+
+    @instrumented_query
+    def get_next_departures(self, stop_id, after,
+            limit=DEFAULT_NEXT_DEPARTURES, route_id=None) -> list:
+        '''see RoutesSession.get_next_departures'''
+        after_sec = _time_of_day_to_seconds(after)
+        if route_id is None:
+            pairs = range(*self._get_pair_range(stop_id))
+        else:
+            pair = self._find_pair(route_id, stop_id)
+            pairs = [] if pair is None else [pair]
+        day_rows = [(day_offset, islice(heapq.merge(
+                    *[self._get_pair_departures(pair, min_sec)
+                        for pair in pairs], key=lambda row: row[:2]), limit))
+                for day_offset, min_sec in _get_service_day_bounds(after_sec)]
+        return _merge_next_departures(after_sec, day_rows, limit)
+
+    def get_stop_reports(self, stop_ids,
+            chunk_size=DEFAULT_STOP_CHUNK_SIZE):
+        '''see RoutesSession.get_stop_reports, chunk_size is ignored'''
+        for stop_id in stop_ids:
+            yield stop_id, self.get_stop_report(stop_id)
+
+
+class MemoryRoutesIndex(ArrayRoutesIndex):
+    '''
+    An ArrayRoutesIndex loaded once from an imported database into array
+    and list objects. Names and trip ids are interned.
+    '''
+    def __init__(self, db_connection, instrumentation=None):
+        self.instrumentation = instrumentation
+        cursor = db_connection.cursor()
+        self._stop_ids = []
+        self._stop_names = []
+        self._stop_index_map = {}
+        self.stop_lat = array('d')
+        self.stop_lon = array('d')
+        stop_key_index_map = {}
+        for key, stop_id, name, lat, lon in cursor.execute(STOPS_SQL):
+            self._stop_index_map[stop_id] = stop_key_index_map[key] = len(
+                    self._stop_ids)
+            self._stop_ids.append(stop_id)
+            self._stop_names.append(_intern(name))
+            self.stop_lat.append(math.nan if lat is None else lat)
+            self.stop_lon.append(math.nan if lon is None else lon)
+        self._build_grid()
+        self._route_ids = []
+        self._route_short_names = []
+        self._route_long_names = []
+        self._route_index_map = {}
+        route_key_index_map = {}
+        for key, route_id, short_name, long_name in cursor.execute(ROUTES_SQL):
+            self._route_index_map[route_id] = route_key_index_map[key] = len(
+                    self._route_ids)
+            self._route_ids.append(route_id)
+            self._route_short_names.append(_intern(short_name))
+            self._route_long_names.append(_intern(long_name))
+        self._trip_ids = []
+        trip_key_index_map = {}
+        for key, trip_id in cursor.execute(TRIPS_SQL):
+            trip_key_index_map[key] = len(self._trip_ids)
+            self._trip_ids.append(_intern(trip_id))
+        self._load_departures(cursor, stop_key_index_map, route_key_index_map,
+                trip_key_index_map)
+
+    def _build_grid(self):
+        cells = sorted((_get_grid_cell_id(lat, lon), stop_index)
+                for stop_index, (lat, lon) in enumerate(zip(self.stop_lat,
+                    self.stop_lon))
+                if not (math.isnan(lat) or math.isnan(lon)))
+        self.grid_cell_ids = array('q')
+        self.grid_cell_offsets = array('q')
+        self.grid_stop_index = array('l')
+        for cell_id, stop_index in cells:
+            if not self.grid_cell_ids or self.grid_cell_ids[-1] != cell_id:
+                self.grid_cell_ids.append(cell_id)
+                self.grid_cell_offsets.append(len(self.grid_stop_index))
+            self.grid_stop_index.append(stop_index)
+        self.grid_cell_offsets.append(len(self.grid_stop_index))
+
+    def _load_departures(self, cursor, stop_key_index_map,
+            route_key_index_map, trip_key_index_map):
+        self.stop_pair_offsets = array('l', [0])
+        self.pair_route_index = array('l')
+        self.pair_departure_offsets = array('l', [0])
+        self.departure_sec = array('l')
+        self.departure_trip_index = array('l')
+        current_stop = 0
+        current_pair = None
+        for stop_key, route_key, departure_sec, trip_key in cursor.execute(
+                DEPARTURES_SQL):
+            stop_index = stop_key_index_map.get(stop_key)
+            route_index = route_key_index_map.get(route_key)
+            if stop_index is None or route_index is None:
+                continue
+            while current_stop < stop_index:
+                self._close_pair(current_pair)
+                current_pair = None
+                self.stop_pair_offsets.append(len(self.pair_route_index))
+                current_stop += 1
+            if current_pair != route_index:
+                self._close_pair(current_pair)
+                self.pair_route_index.append(route_index)
+                current_pair = route_index
+            if departure_sec is not None:
+                self.departure_sec.append(departure_sec)
+                self.departure_trip_index.append(
+                        trip_key_index_map[trip_key])
+        self._close_pair(current_pair)
+        while len(self.stop_pair_offsets) <= len(self._stop_ids):
+            self.stop_pair_offsets.append(len(self.pair_route_index))
+
+    def _close_pair(self, current_pair):
+        if current_pair is not None:
+            self.pair_departure_offsets.append(len(self.departure_sec))
+
+    @classmethod
+    def from_database(cls, db_filepath, instrumentation=None):
+        db_connection = sqlite3.connect(_get_read_only_uri(db_filepath),
+                uri=True)
+        try:
+            return cls(db_connection, instrumentation)
+        finally:
+            db_connection.close()
@@ -0,0 +1,292 @@
+import os
+import time
+import heapq
+
+from itertools                  import islice
+from concurrent.futures         import ProcessPoolExecutor, ThreadPoolExecutor
+
+from GTFSProcessor              import Routes
+from GTFSProcessor              import ZIPImporter
+from GTFSProcessor.Validation   import ValidationReport
+from GTFSProcessor.Instrumentation import (Instrumentation, instrumented_query,
+                                           print_phase)
+
+
+# the database of each feed is [database dir]/[feed name]FEED_DB_SUFFIX
+FEED_DB_SUFFIX = '.sqlite'
+# separates the feed name from the phase name in the recorded phases
+FEED_PHASE_SEPARATOR = '/'
+
+
+def get_feed_name(archive_path) -> str:
+    '''the archive filename without its extension'''
+    return os.path.splitext(os.path.basename(archive_path))[0]
+
+
+def get_feed_database_path(archive_path, database_dir) -> str:
+    '''where import_feeds builds the database of the archive'''
+    return os.path.join(database_dir,
+            get_feed_name(archive_path) + FEED_DB_SUFFIX)
+
+
+def get_feed_databases(database_dir) -> dict:
+    '''returns {feed name : database path} of every feed database in
+    database_dir, sorted by feed name'''
+    return {filename[:-len(FEED_DB_SUFFIX)]:
+                os.path.join(database_dir, filename)
+            for filename in sorted(os.listdir(database_dir))
+            if filename.endswith(FEED_DB_SUFFIX)}
+
+
+def _import_feed(archive_path, db_filepath, import_kwargs) -> tuple:
+    '''runs in a pool process, returns (imported filenames, phase records,
+    validation report dict)'''
+    instrumentation = Instrumentation()
+    validation_report = ValidationReport()
+    filenames = ZIPImporter.import_into_database(archive_path, db_filepath,
+            instrumentation=instrumentation,
+            validation_report=validation_report, **import_kwargs)
+    return filenames, instrumentation.phases, validation_report.report()
+
+
+def import_feeds(archive_paths, database_dir, processes=None,
+        instrumentation=None, validation_reports=None, **import_kwargs) -> dict:
+    '''
+    Imports each GTFS archive into its own database, [database_dir]/[feed
+    name].sqlite where the feed name is the archive filename without its
+    extension, each feed in its own process.
+    import_kwargs are passed to ZIPImporter.import_into_database.
+    The phases of every feed are recorded by instrumentation named
+    '[feed name]/[phase]', by default they are printed as each feed
+    completes. Each feed prints its validation summary, a given
+    validation_reports dict is filled with {feed name :
+    Validation.ValidationReport.report()}.
+    returns {feed name : database path}, in archive order. raises ValueError
+    if no archive is given or two archives have the same feed name
+    '''
+    feeds = {}
+    for archive_path in archive_paths:
+        feed_name = get_feed_name(archive_path)
+        if feed_name in feeds:
+            raise ValueError('Feed %s given twice' % feed_name)
+        feeds[feed_name] = archive_path
+    if not feeds:
+        raise ValueError('No feeds given')
+    if instrumentation is None:
+        instrumentation = Instrumentation([print_phase])
+    os.makedirs(database_dir, exist_ok=True)
+    db_filepaths = {feed_name: get_feed_database_path(archive_path,
+                        database_dir)
+                    for feed_name, archive_path in feeds.items()}
+    with ProcessPoolExecutor(processes or min(len(feeds),
+            os.cpu_count() or 1)) as executor:
+        futures = {feed_name: executor.submit(_import_feed,
+                        feeds[feed_name], db_filepaths[feed_name],
+                        import_kwargs)
+                   for feed_name in feeds}
+        for feed_name, future in futures.items():
+            filenames, phases, validation_report = future.result()
+            if validation_reports is not None:
+                validation_reports[feed_name] = validation_report
+            for record in phases:
+                instrumentation.record_phase(dict(record, name=feed_name
+                        + FEED_PHASE_SEPARATOR + record['name']))
+            print('Feed %s: imported %s.' % (feed_name,
+                    ', '.join(filenames) or 'nothing'))
+    return db_filepaths
+
+
+def _merge_stop_reports(stop_id, feed_reports) -> dict:
+    '''feed_reports: [(feed name, report as in get_stop_report)]. returns a
+    single report, with the feed of each route. If the stop is in no feed,
+    returns an empty dict'''
+    found = [(feed_name, report) for feed_name, report in feed_reports
+            if report]
+    if not found:
+        return {}
+    return {'stop_id': stop_id,
+            'stop_name': found[0][1]['stop_name'],
+            'routes': [dict(route, feed=feed_name)
+                       for feed_name, report in found
+                       for route in report['routes']]}
+
+
+def _merge_next_departures(feed_departures, limit) -> list:
+    '''feed_departures: [(feed name, departures as in get_next_departures)].
+    returns the first limit departures of all feeds, with their feed'''
+    merged = heapq.merge(*[[dict(departure, feed=feed_name)
+                            for departure in departures]
+                           for feed_name, departures in feed_departures],
+            key=lambda departure: departure['wait_sec'])
+    return list(islice(merged, limit))
+
+
+class MultiFeedSession:
+    '''
+    Answers the Routes queries over several feeds, each served by its own
+    session (see Routes.open_session). Every query is sent to all the feeds
+    at once on a thread pool and the results merged, so it takes as long as
+    the slowest feed rather than the sum of them.
+    Stop ids are looked up in every feed, route ids are namespaced: routes
+    are returned & given as (feed name, route_id) tuples, and the routes of
+    stop reports & departures carry a 'feed' key.
+    Given an Instrumentation.Instrumentation, the count & latency of every
+    merged query is recorded.
+
+    with MultiFeedSession.from_databases(get_feed_databases('feeds')) as s:
+        s.get_stop_report('5644')
+    '''
+    def __init__(self, sessions, instrumentation=None):
+        '''sessions: {feed name : session}, closed with this session'''
+        self.sessions = dict(sessions)
+        self.instrumentation = instrumentation
+        self._executor = ThreadPoolExecutor(max(1, len(self.sessions)))
+
+    @classmethod
+    def from_databases(cls, db_filepaths, backend='sqlite',
+            instrumentation=None):
+        '''db_filepaths: {feed name : database path}'''
+        sessions = {}
+        try:
+            for feed_name, db_filepath in db_filepaths.items():
+                sessions[feed_name] = Routes.open_session(db_filepath,
+                        backend)
+        except Exception:
+            for session in sessions.values():
+                session.close()
+            raise
+        return cls(sessions, instrumentation)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown()
+        for session in self.sessions.values():
+            session.close()
+
+    def _map(self, method_name, *args) -> list:
+        '''calls method_name on every feed's session concurrently, returns
+        [(feed name, result)] in feed order'''
+        results = self._executor.map(
+                lambda session: getattr(session, method_name)(*args),
+                self.sessions.values())
+        return list(zip(self.sessions, results))
+
+    def _call_route_feed(self, method_name, route_id, *args):
+        '''calls method_name with the id of route_id, a (feed name, route_id)
+        tuple, on its feed's session. returns None for an unknown feed'''
+        feed_name, feed_route_id = route_id
+        session = self.sessions.get(feed_name)
+        if session is None:
+            return None
+        return getattr(session, method_name)(feed_route_id, *args)
+
+    @instrumented_query
+    def check_if_stop_exists(self, stop_id) -> bool:
+        return any(exists for _, exists
+                in self._map('check_if_stop_exists', stop_id))
+
+    @instrumented_query
+    def get_stop_name(self, stop_id) -> str:
+        '''the name in the first feed with the stop. If there is no match,
+        returns an empty str'''
+        return next((name for _, name in self._map('get_stop_name', stop_id)
+                if name), '')
+
+    @instrumented_query
+    def get_route_ids_passing_through_stop(self, stop_id) -> set:
+        '''returns {(feed name, route_id)}, an empty set if there is no
+        match'''
+        return {(feed_name, route_id) for feed_name, route_ids
+                in self._map('get_route_ids_passing_through_stop', stop_id)
+                for route_id in route_ids}
+
+    @instrumented_query
+    def get_route_short_name(self, route_id) -> str:
+        '''route_id is a (feed name, route_id) tuple. If there is no match,
+        returns an empty str'''
+        return self._call_route_feed('get_route_short_name', route_id) or ''
+
+    @instrumented_query
+    def get_route_long_name(self, route_id) -> str:
+        '''route_id is a (feed name, route_id) tuple. If there is no match,
+        returns an empty str'''
+        return self._call_route_feed('get_route_long_name', route_id) or ''
+
+    @instrumented_query
+    def get_latest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''route_id is a (feed name, route_id) tuple. If there is no match,
+        returns an empty str'''
+        return self._call_route_feed('get_latest_service_for_stop_on_trip',
+                route_id, stop_id) or ''
+
+    @instrumented_query
+    def get_earliest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''route_id is a (feed name, route_id) tuple. If there is no match,
+        returns an empty str'''
+        return self._call_route_feed('get_earliest_service_for_stop_on_trip',
+                route_id, stop_id) or ''
+
+    @instrumented_query
+    def get_stop_report(self, stop_id) -> dict:
+        '''as RoutesSession.get_stop_report, the routes of every feed serving
+        the stop in feed order, each with its 'feed'. The stop name is the
+        one of the first feed with the stop'''
+        return _merge_stop_reports(stop_id,
+                self._map('get_stop_report', stop_id))
+
+    @instrumented_query
+    def get_next_departures(self, stop_id, after,
+            limit=Routes.DEFAULT_NEXT_DEPARTURES, route_id=None) -> list:
+        '''as RoutesSession.get_next_departures over every feed, each
+        departure with its 'feed'. route_id, a (feed name, route_id) tuple,
+        only queries that feed'''
+        if route_id is None:
+            feed_departures = self._map('get_next_departures', stop_id,
+                    after, limit)
+        else:
+            feed_name, feed_route_id = route_id
+            feed_departures = [(feed_name,
+                    self.sessions[feed_name].get_next_departures(stop_id,
+                        after, limit, feed_route_id))
+                ] if feed_name in self.sessions else []
+        return _merge_next_departures(feed_departures, limit)
+
+    @instrumented_query
+    def get_stops_near(self, lat, lon, radius_m, limit=None) -> list:
+        '''as RoutesSession.get_stops_near over every feed, nearest first,
+        each stop with its 'feed'. A stop in several feeds is listed once per
+        feed'''
+        merged = heapq.merge(*[[dict(stop, feed=feed_name) for stop in stops]
+                               for feed_name, stops in self._map(
+                                   'get_stops_near', lat, lon, radius_m,
+                                   limit)],
+                key=lambda stop: stop['distance_m'])
+        return list(islice(merged, limit))
+
+    def get_stop_reports(self, stop_ids,
+            chunk_size=Routes.DEFAULT_STOP_CHUNK_SIZE):
+        '''generator, as RoutesSession.get_stop_reports with the reports of
+        get_stop_report. Each chunk of stop_ids is resolved by all the feeds
+        at once'''
+        stop_ids = iter(stop_ids)
+        while True:
+            chunk = list(islice(stop_ids, chunk_size))
+            if not chunk:
+                break
+            start = time.perf_counter()
+            feed_reports = list(zip(self.sessions, self._executor.map(
+                    lambda session: list(session.get_stop_reports(chunk,
+                        chunk_size)),
+                    self.sessions.values())))
+            if self.instrumentation is not None:
+                self.instrumentation.record_query('get_stop_reports',
+                        time.perf_counter() - start)
+            for i, stop_id in enumerate(chunk):
+                yield stop_id, _merge_stop_reports(stop_id,
+                        [(feed_name, reports[i][1])
+                         for feed_name, reports in feed_reports])
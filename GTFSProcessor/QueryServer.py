@@ -0,0 +1,282 @@
+import json
+import time
+import asyncio
+
+from collections                import OrderedDict
+from urllib.parse               import quote, unquote
+from concurrent.futures         import ThreadPoolExecutor
+
+from GTFSProcessor              import Routes
+
+
+DEFAULT_THREADS = 4
+DEFAULT_CACHE_SIZE = 10000
+STOPS_PATH_PREFIX = '/stops/'
+HEALTH_PATH = '/health'
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                405: 'Method Not Allowed', 500: 'Internal Server Error'}
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+class LRUCache:
+    '''a dict bounded to max_size entries, evicting the least recently used'''
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class StopReportService:
+    '''
+    Serves stop reports from a bounded pool of threads sharing a
+    Routes.RoutesPool, with an LRU cache of the reports in front of them.
+    The database generation is checked on every request, when it changes
+    the cache is cleared, and the RoutesPool moves to the new generation on
+    its next query.
+    '''
+    def __init__(self, db_filepath, threads=DEFAULT_THREADS,
+            cache_size=DEFAULT_CACHE_SIZE):
+        self.db_filepath = db_filepath
+        self.cache = LRUCache(cache_size)
+        self.generation = Routes.get_database_generation(db_filepath)
+        self._executor = ThreadPoolExecutor(threads)
+        self._pool = Routes.RoutesPool(db_filepath, threads)
+
+    def check_generation(self):
+        generation = Routes.get_database_generation(self.db_filepath)
+        if generation != self.generation:
+            self.generation = generation
+            self.cache.clear()
+
+    async def get_stop_report(self, stop_id) -> dict:
+        self.check_generation()
+        generation = self.generation
+        stop_report = self.cache.get(stop_id)
+        if stop_report is None:
+            stop_report = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._pool.get_stop_report, stop_id)
+            if generation == self.generation:
+                self.cache.put(stop_id, stop_report)
+        return stop_report
+
+    def close(self):
+        self._executor.shutdown()
+        self._pool.close()
+
+
+def _encode_response(status, body, keep_alive=True) -> bytes:
+    payload = json.dumps(body).encode('utf-8')
+    headers = ['HTTP/1.1 %d %s' % (status, HTTP_REASONS[status]),
+               'Content-Type: application/json',
+               'Content-Length: %d' % len(payload),
+               'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('ascii') + payload
+
+
+async def _read_request(reader):
+    '''returns (method, path, keep_alive), or None once the client is done.
+    Request bodies are not used and are skipped, raises ValueError for a
+    Content-Length that is not a number of bytes'''
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    content_length = 0
+    keep_alive = True
+    while True:
+        header_line = await reader.readline()
+        if not header_line.strip():
+            break
+        name, _, value = header_line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            try:
+                content_length = int(value.strip())
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                raise ValueError('invalid Content-Length %s' % value.strip())
+        elif name == 'connection':
+            keep_alive = value.strip().lower() != 'close'
+    if content_length:
+        await reader.readexactly(content_length)
+    parts = request_line.decode('latin-1').split()
+    if len(parts) < 2:
+        return '', '', False
+    if len(parts) > 2 and parts[2] == 'HTTP/1.0':
+        keep_alive = False
+    return parts[0], parts[1], keep_alive
+
+
+async def _route_request(service, method, path) -> tuple:
+    '''returns (status, body)'''
+    if method != 'GET':
+        return 405, {'error': 'only GET is supported'}
+    path = path.split('?', 1)[0]
+    if path == HEALTH_PATH:
+        service.check_generation()
+        return 200, {'generation': list(service.generation),
+                     'cache_size': len(service.cache),
+                     'cache_hits': service.cache.hits,
+                     'cache_misses': service.cache.misses}
+    if path.startswith(STOPS_PATH_PREFIX):
+        stop_id = unquote(path[len(STOPS_PATH_PREFIX):])
+        if not stop_id:
+            return 400, {'error': 'missing stop_id'}
+        stop_report = await service.get_stop_report(stop_id)
+        if not stop_report:
+            return 404, {'error': 'Stop %s not found in database.' % stop_id}
+        return 200, stop_report
+    return 404, {'error': 'unknown path %s' % path}
+
+
+def make_connection_handler(service):
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except ValueError as e:
+                    # the end of the request is unknown, the connection too
+                    writer.write(_encode_response(400, {'error': str(e)},
+                            False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, keep_alive = request
+                try:
+                    status, body = await _route_request(service, method, path)
+                except Exception as e:
+                    status, body = 500, {'error': str(e)}
+                writer.write(_encode_response(status, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle_connection
+
+
+async def start_server(service, host='127.0.0.1', port=0, unix_path=None):
+    '''returns the asyncio Server, listening on unix_path if given, otherwise
+    on host:port (port 0 picks a free port)'''
+    handler = make_connection_handler(service)
+    if unix_path:
+        return await asyncio.start_unix_server(handler, path=unix_path)
+    return await asyncio.start_server(handler, host, port)
+
+
+def serve_forever(db_filepath, host='127.0.0.1', port=8080, unix_path=None,
+        threads=DEFAULT_THREADS, cache_size=DEFAULT_CACHE_SIZE):
+    async def run():
+        service = StopReportService(db_filepath, threads, cache_size)
+        server = await start_server(service, host, port, unix_path)
+        print('Serving %s on %s' % (db_filepath, unix_path
+                or '%s:%d' % server.sockets[0].getsockname()[:2]))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            service.close()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1,
+            int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def _open_connection(host, port, unix_path):
+    if unix_path:
+        return await asyncio.open_unix_connection(unix_path)
+    return await asyncio.open_connection(host, port)
+
+
+async def _read_response(reader) -> tuple:
+    '''returns (status, body bytes)'''
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    content_length = 0
+    while True:
+        header_line = await reader.readline()
+        if not header_line.strip():
+            break
+        name, _, value = header_line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            content_length = int(value.strip())
+    return status, await reader.readexactly(content_length)
+
+
+async def run_load_test(stop_ids, requests=10000, concurrency=16,
+        host='127.0.0.1', port=8080, unix_path=None) -> dict:
+    '''
+    Sends requests GET /stops/<stop_id> requests, cycling through stop_ids
+    (percent-encoded), over concurrency keep-alive connections.
+    returns {'requests', 'errors', 'elapsed_sec', 'requests_per_sec',
+    'latency_ms': {'p50', 'p90', 'p99', 'max'}}
+    '''
+    stop_ids = list(stop_ids)
+    latencies = []
+    errors = [0]
+    counter = iter(range(requests))
+
+    async def client():
+        reader, writer = await _open_connection(host, port, unix_path)
+        try:
+            for i in counter:
+                stop_id = stop_ids[i % len(stop_ids)]
+                request = ('GET %s%s HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                        % (STOPS_PATH_PREFIX, quote(str(stop_id), safe=''))
+                        ).encode('utf-8')
+                start = time.perf_counter()
+                writer.write(request)
+                await writer.drain()
+                status, _ = await _read_response(reader)
+                latencies.append(time.perf_counter() - start)
+                if status not in (200, 404):
+                    errors[0] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed_sec = time.perf_counter() - start
+    latencies.sort()
+    latency_ms = {'p%d' % p: _percentile(latencies, p) * 1000
+            for p in LATENCY_PERCENTILES}
+    latency_ms['max'] = latencies[-1] * 1000 if latencies else 0.0
+    return {'requests': len(latencies),
+            'errors': errors[0],
+            'elapsed_sec': elapsed_sec,
+            'requests_per_sec': len(latencies) / elapsed_sec
+                if elapsed_sec > 0 else 0.0,
+            'latency_ms': latency_ms}
@@ -1,4 +1,149 @@
+import os
+import math
+import time
+import heapq
 import sqlite3
+import threading
+
+from pathlib                    import Path
+from itertools                  import groupby, islice
+
+from GTFSProcessor.Instrumentation import instrumented_query
+
+
+STOP_EXISTS_SQL = '''select id
+                    from stop
+                    where stop.id =:id;'''
+STOP_NAME_SQL = '''select name
+                    from stop
+                    where stop.id =:id;'''
+ROUTE_IDS_AT_STOP_SQL = '''SELECT Route.id
+                    FROM Stop
+                    JOIN Stop_Route_Summary
+                    ON Stop_Route_Summary.stop_key = Stop.key
+                    JOIN Route ON Route.key = Stop_Route_Summary.route_key
+                    WHERE Stop.id =:id;'''
+ROUTE_SHORT_NAME_SQL = '''SELECT short_name
+                    FROM Route
+                    WHERE Route.id =:id;'''
+ROUTE_LONG_NAME_SQL = '''SELECT long_name
+                    FROM Route
+                    WHERE Route.id =:id;'''
+LATEST_SERVICE_SQL = '''SELECT Stop_Route_Summary.latest_sec
+                    FROM Stop, Route
+                    JOIN Stop_Route_Summary
+                    ON Stop_Route_Summary.stop_key = Stop.key
+                    AND Stop_Route_Summary.route_key = Route.key
+                    WHERE Stop.id = :in_stop_id
+                    AND Route.id = :in_trip_id
+                    ;'''
+EARLIEST_SERVICE_SQL = '''SELECT Stop_Route_Summary.earliest_sec
+                    FROM Stop, Route
+                    JOIN Stop_Route_Summary
+                    ON Stop_Route_Summary.stop_key = Stop.key
+                    AND Stop_Route_Summary.route_key = Route.key
+                    WHERE Stop.id = :in_stop_id
+                    AND Route.id = :in_trip_id
+                    ;'''
+# routes are listed in surrogate key order, the order of routes.txt
+STOP_REPORT_SQL = '''SELECT Stop.name, Route.id, Route.short_name,
+                        Route.long_name, Stop_Route_Summary.earliest_sec,
+                        Stop_Route_Summary.latest_sec
+                    FROM Stop
+                    LEFT JOIN Stop_Route_Summary
+                    ON Stop_Route_Summary.stop_key = Stop.key
+                    LEFT JOIN Route ON Route.key = Stop_Route_Summary.route_key
+                    WHERE Stop.id = :id
+                    ORDER BY Stop_Route_Summary.route_key;'''
+# STOP_REPORTS_SQL is formatted with one '(?, ?)' pair per requested stop
+STOP_REPORTS_SQL = '''WITH Requested_Stop(position, stop_id) AS (VALUES %s)
+                    SELECT Requested_Stop.position, Stop.name, Route.id,
+                        Route.short_name, Route.long_name,
+                        Stop_Route_Summary.earliest_sec,
+                        Stop_Route_Summary.latest_sec
+                    FROM Requested_Stop
+                    JOIN Stop ON Stop.id = Requested_Stop.stop_id
+                    LEFT JOIN Stop_Route_Summary
+                    ON Stop_Route_Summary.stop_key = Stop.key
+                    LEFT JOIN Route ON Route.key = Stop_Route_Summary.route_key
+                    ORDER BY Requested_Stop.position,
+                        Stop_Route_Summary.route_key;'''
+# both read Stop_Departure in (departure_time_in_sec, trip_key) order
+NEXT_DEPARTURES_SQL = '''SELECT Stop_Departure.departure_time_in_sec,
+                        Stop_Departure.trip_key, Trip.id, Route.id,
+                        Route.short_name, Route.long_name
+                    FROM Stop
+                    JOIN Stop_Departure ON Stop_Departure.stop_key = Stop.key
+                    JOIN Trip ON Trip.key = Stop_Departure.trip_key
+                    JOIN Route ON Route.key = Stop_Departure.route_key
+                    WHERE Stop.id = :stop_id
+                    AND Stop_Departure.departure_time_in_sec >= :after_sec
+                    ORDER BY Stop_Departure.departure_time_in_sec,
+                        Stop_Departure.trip_key
+                    LIMIT :limit;'''
+NEXT_ROUTE_DEPARTURES_SQL = '''SELECT Stop_Departure.departure_time_in_sec,
+                        Stop_Departure.trip_key, Trip.id, Route.id,
+                        Route.short_name, Route.long_name
+                    FROM Stop, Route
+                    JOIN Stop_Departure ON Stop_Departure.stop_key = Stop.key
+                    AND Stop_Departure.route_key = Route.key
+                    JOIN Trip ON Trip.key = Stop_Departure.trip_key
+                    WHERE Stop.id = :stop_id
+                    AND Route.id = :route_id
+                    AND Stop_Departure.departure_time_in_sec >= :after_sec
+                    ORDER BY Stop_Departure.departure_time_in_sec,
+                        Stop_Departure.trip_key
+                    LIMIT :limit;'''
+# the stops with a route summary row each, or a single row without routes,
+# whose Stop_Location box intersects the searched bounding box. Checked by
+# its own query plan test, SQLite reports the R*Tree lookup as a SCAN of the
+# virtual table
+NEARBY_STOP_REPORTS_SQL = '''SELECT Stop.key, Stop.id, Stop.lat, Stop.lon,
+                        Stop_Route_Summary.route_key, Stop.name, Route.id,
+                        Route.short_name, Route.long_name,
+                        Stop_Route_Summary.earliest_sec,
+                        Stop_Route_Summary.latest_sec
+                    FROM Stop_Location
+                    JOIN Stop ON Stop.key = Stop_Location.stop_key
+                    LEFT JOIN Stop_Route_Summary
+                    ON Stop_Route_Summary.stop_key = Stop.key
+                    LEFT JOIN Route ON Route.key = Stop_Route_Summary.route_key
+                    WHERE Stop_Location.max_lat >= :min_lat
+                    AND Stop_Location.min_lat <= :max_lat
+                    AND Stop_Location.max_lon >= :min_lon
+                    AND Stop_Location.min_lon <= :max_lon;'''
+SECONDS_PER_DAY = 24 * 3600
+# mean earth radius, for great circle distances
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+# service days searched by get_next_departures, relative to the query's day:
+# GTFS times past 24:00 belong to the previous service day and the next
+# departures may only come after midnight
+SERVICE_DAY_OFFSETS = (-1, 0, 1)
+DEFAULT_NEXT_DEPARTURES = 10
+# stops resolved per STOP_REPORTS_SQL query
+DEFAULT_STOP_CHUNK_SIZE = 500
+# accepted by open_session
+BACKENDS = ('sqlite', 'memory', 'snapshot')
+# prepared statements kept per connection, comfortably above len(QUERIES)
+STATEMENT_CACHE_SIZE = 64
+# idle sessions a RoutesPool keeps open, more are opened while more threads
+# query at once
+DEFAULT_POOL_SIZE = 8
+# every query above, with sample parameters, checked by the query plan tests
+QUERIES = (
+    (STOP_EXISTS_SQL, {'id': 0}),
+    (STOP_NAME_SQL, {'id': 0}),
+    (ROUTE_IDS_AT_STOP_SQL, {'id': 0}),
+    (ROUTE_SHORT_NAME_SQL, {'id': 0}),
+    (ROUTE_LONG_NAME_SQL, {'id': 0}),
+    (LATEST_SERVICE_SQL, {'in_stop_id': 0, 'in_trip_id': 0}),
+    (EARLIEST_SERVICE_SQL, {'in_stop_id': 0, 'in_trip_id': 0}),
+    (STOP_REPORT_SQL, {'id': 0}),
+    (NEXT_DEPARTURES_SQL, {'stop_id': 0, 'after_sec': 0, 'limit': 1}),
+    (NEXT_ROUTE_DEPARTURES_SQL, {'stop_id': 0, 'route_id': 0, 'after_sec': 0,
+        'limit': 1}),
+    )
 
 
 def _seconds_to_str(seconds) -> str:
@@ -7,99 +152,529 @@ def _seconds_to_str(seconds) -> str:
     return '%02d:%02d:%02d' % (h, m, s)
 
 
+def _optional_seconds_to_str(seconds) -> str:
+    '''an empty str for None, the departures of a route serving a stop only
+    with stop times without times'''
+    return '' if seconds is None else _seconds_to_str(seconds)
+
+
+def _seconds_to_str_or_empty(result) -> str:
+    '''result is a fetchone() row. If there is no match, returns an empty str'''
+    if result is None or result[0] is None:
+        return ''
+    else:
+        return _seconds_to_str(result[0])
+
+
+def _build_stop_report(stop_id, rows) -> dict:
+    '''rows as returned by STOP_REPORT_SQL. If there are none, returns an
+    empty dict'''
+    if not rows:
+        return {}
+    routes = [{'route_id': route_id,
+               'short_name': short_name,
+               'long_name': long_name,
+               'earliest': _optional_seconds_to_str(earliest_sec),
+               'latest': _optional_seconds_to_str(latest_sec)}
+              for _, route_id, short_name, long_name, earliest_sec, latest_sec
+              in rows if route_id is not None]
+    return {'stop_id': stop_id, 'stop_name': rows[0][0], 'routes': routes}
+
+
+def _time_of_day_to_seconds(time_of_day) -> int:
+    '''time_of_day is seconds or a 'HH:MM[:SS]' str, returns seconds since
+    midnight, wrapped into a single day. raises ValueError'''
+    if isinstance(time_of_day, str):
+        numbers = [int(x) for x in time_of_day.split(':')]
+        if not 2 <= len(numbers) <= 3 or min(numbers) < 0:
+            raise ValueError('Expected HH:MM[:SS], got %s' % time_of_day)
+        time_of_day = sum(60 ** (2 - i) * number
+                for i, number in enumerate(numbers))
+    return int(time_of_day) % SECONDS_PER_DAY
+
+
+def _get_service_day_bounds(after_sec) -> list:
+    '''[(day_offset, the earliest GTFS departure_time_in_sec on that service
+    day that is not before after_sec on the query's day)]'''
+    return [(day_offset, max(0, after_sec - day_offset * SECONDS_PER_DAY))
+            for day_offset in SERVICE_DAY_OFFSETS]
+
+
+def _shift_departures(day_offset, rows):
+    for departure_sec, trip_key, trip_id, route_id, short_name, long_name \
+            in rows:
+        yield (departure_sec + day_offset * SECONDS_PER_DAY, trip_key,
+                day_offset, departure_sec, trip_id, route_id, short_name,
+                long_name)
+
+
+def _merge_next_departures(after_sec, day_rows, limit) -> list:
+    '''day_rows: [(day_offset, rows)], each rows as returned by
+    NEXT_DEPARTURES_SQL for that service day. returns the first limit
+    departures of all service days, as in get_next_departures'''
+    merged = heapq.merge(*[_shift_departures(day_offset, rows)
+            for day_offset, rows in day_rows], key=lambda row: row[:2])
+    return [{'departure': _seconds_to_str(departure_sec),
+             'departure_sec': departure_sec,
+             'day_offset': day_offset,
+             'wait_sec': time_sec - after_sec,
+             'route_id': route_id,
+             'short_name': short_name,
+             'long_name': long_name,
+             'trip_id': trip_id}
+            for time_sec, _, day_offset, departure_sec, trip_id, route_id,
+                short_name, long_name in islice(merged, limit)]
+
+
+def _get_distance_m(lat1, lon1, lat2, lon2) -> float:
+    '''great circle distance between two points in degrees, haversine'''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2)
+            * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _get_bounding_box(lat, lon, radius_m) -> tuple:
+    '''(min_lat, max_lat, min_lon, max_lon) in degrees of a box containing
+    every point within radius_m of (lat, lon). Boxes crossing a pole or the
+    antimeridian span every longitude. raises ValueError'''
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180 and radius_m >= 0):
+        raise ValueError('Expected -90 <= lat <= 90, -180 <= lon <= 180 and '
+                'radius_m >= 0, got %s, %s, %s' % (lat, lon, radius_m))
+    lat_delta = radius_m / METRES_PER_DEGREE
+    min_lat, max_lat = max(-90.0, lat - lat_delta), min(90.0, lat + lat_delta)
+    cos_lat = min(math.cos(math.radians(min_lat)),
+            math.cos(math.radians(max_lat)))
+    if cos_lat <= 0 or lat_delta / cos_lat >= 180:
+        return min_lat, max_lat, -180.0, 180.0
+    lon_delta = lat_delta / cos_lat
+    if lon - lon_delta < -180 or lon + lon_delta > 180:
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, lon - lon_delta, lon + lon_delta
+
+
+def _get_nearest_stops(lat, lon, radius_m, stops, limit) -> list:
+    '''stops: iterable of (stop order, stop lat, stop lon, value) for the
+    stops in the bounding box. returns [(distance_m, stop lat, stop lon,
+    value)] of the stops within radius_m, nearest first then in stop order,
+    at most limit (None for all)'''
+    nearest = []
+    for order, stop_lat, stop_lon, value in stops:
+        distance_m = _get_distance_m(lat, lon, stop_lat, stop_lon)
+        if distance_m <= radius_m:
+            nearest.append((distance_m, order, stop_lat, stop_lon, value))
+    nearest.sort(key=lambda stop: stop[:2])
+    return [(distance_m, stop_lat, stop_lon, value) for distance_m, _,
+            stop_lat, stop_lon, value in nearest[:limit]]
+
+
+def _add_stop_location(stop_report, stop_lat, stop_lon, distance_m) -> dict:
+    return dict(stop_report, lat=stop_lat, lon=stop_lon,
+            distance_m=distance_m)
+
+
+def get_database_generation(db_filepath) -> tuple:
+    '''identifies the database file currently at db_filepath, following the
+    symlink to the generation an import publishes. Every import publishes a
+    new file, so always gives a new generation'''
+    stat = os.stat(db_filepath)
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _get_read_only_uri(db_filepath, immutable=True) -> str:
+    uri = Path(db_filepath).resolve().as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
+
+class RoutesSession:
+    '''
+    A read-only connection to an imported database, opened once and reused
+    for every query so its prepared statements stay cached.
+    Calls are serialised with a lock, so a session may be shared between
+    threads, although a session per thread avoids the contention.
+    With immutable=True SQLite skips all locking and change detection, the
+    database file must not be modified while the session is open.
+    Given an Instrumentation.Instrumentation, the count & latency of every
+    query is recorded.
+
+    with RoutesSession('db.sqlite') as session:
+        session.get_stop_report('5644')
+    '''
+    def __init__(self, db_filepath, immutable=True, instrumentation=None):
+        self.db_filepath = db_filepath
+        self.instrumentation = instrumentation
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+                _get_read_only_uri(db_filepath, immutable), uri=True,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _fetchall(self, sql_query, params) -> list:
+        with self._lock:
+            return self._connection.execute(sql_query, params).fetchall()
+
+    def _fetchone(self, sql_query, params):
+        with self._lock:
+            return self._connection.execute(sql_query, params).fetchone()
+
+    @instrumented_query
+    def check_if_stop_exists(self, stop_id) -> bool:
+        return self._fetchone(STOP_EXISTS_SQL, {'id' : stop_id}) is not None
+
+    @instrumented_query
+    def get_stop_name(self, stop_id) -> str:
+        '''if there is no match, returns an empty str'''
+        result = self._fetchone(STOP_NAME_SQL, {'id' : stop_id})
+        return result[0] if result else ''
+
+    @instrumented_query
+    def get_route_ids_passing_through_stop(self, stop_id) -> set:
+        '''if there is no match, returns an empty set'''
+        return set([tuple_[0] for tuple_ in
+                self._fetchall(ROUTE_IDS_AT_STOP_SQL, {'id' : stop_id})])
+
+    @instrumented_query
+    def get_route_short_name(self, route_id) -> str:
+        '''If there is no match, returns an empty str'''
+        result = self._fetchone(ROUTE_SHORT_NAME_SQL, {'id' : route_id})
+        return result[0] if result else ''
+
+    @instrumented_query
+    def get_route_long_name(self, route_id) -> str:
+        '''If there is no match, returns an empty str'''
+        result = self._fetchone(ROUTE_LONG_NAME_SQL, {'id' : route_id})
+        return result[0] if result else ''
+
+    @instrumented_query
+    def get_latest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''If there is no match, returns an empty str'''
+        return _seconds_to_str_or_empty(self._fetchone(LATEST_SERVICE_SQL,
+                {'in_stop_id' : stop_id, 'in_trip_id' : route_id}))
+
+    @instrumented_query
+    def get_earliest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''If there is no match, returns an empty str'''
+        return _seconds_to_str_or_empty(self._fetchone(EARLIEST_SERVICE_SQL,
+                {'in_stop_id' : stop_id, 'in_trip_id' : route_id}))
+
+    @instrumented_query
+    def get_stop_report(self, stop_id) -> dict:
+        '''returns {'stop_id', 'stop_name', 'routes': [{'route_id',
+        'short_name', 'long_name', 'earliest', 'latest'}, ...]} in a single
+        query. If the stop does not exist, returns an empty dict'''
+        return _build_stop_report(stop_id,
+                self._fetchall(STOP_REPORT_SQL, {'id' : stop_id}))
+
+    @instrumented_query
+    def get_next_departures(self, stop_id, after,
+            limit=DEFAULT_NEXT_DEPARTURES, route_id=None) -> list:
+        '''
+        The next limit departures from stop_id at or after the time of day
+        after (seconds or 'HH:MM[:SS]'), optionally only on route_id,
+        assuming every trip runs every day. Times past 24:00 of the previous
+        service day and departures after midnight are included.
+        returns [{'departure' (GTFS time), 'departure_sec', 'day_offset'
+        (service day relative to today), 'wait_sec', 'route_id',
+        'short_name', 'long_name', 'trip_id'}, ...] in departure order,
+        an empty list if there is no match.
+        Each service day is a range scan of Stop_Departure.
+        '''
+        after_sec = _time_of_day_to_seconds(after)
+        sql_query = (NEXT_DEPARTURES_SQL if route_id is None
+                else NEXT_ROUTE_DEPARTURES_SQL)
+        day_rows = [(day_offset, self._fetchall(sql_query,
+                    {'stop_id': stop_id, 'route_id': route_id,
+                    'after_sec': min_sec, 'limit': limit}))
+                for day_offset, min_sec in _get_service_day_bounds(after_sec)]
+        return _merge_next_departures(after_sec, day_rows, limit)
+
+    @instrumented_query
+    def get_stops_near(self, lat, lon, radius_m, limit=None) -> list:
+        '''
+        The stops within radius_m metres (great circle) of the point (lat,
+        lon) in degrees, nearest first, at most limit.
+        returns [{'stop_id', 'stop_name', 'lat', 'lon', 'distance_m',
+        'routes': [...]}, ...], each as in get_stop_report with the stop's
+        location, an empty list if there is no match. raises ValueError
+        for coordinates out of range or a negative radius.
+        A single query, the candidate stops are found with the Stop_Location
+        R*Tree and the rows of each joined by key.
+        '''
+        min_lat, max_lat, min_lon, max_lon = _get_bounding_box(lat, lon,
+                radius_m)
+        rows_by_stop = {}
+        for row in self._fetchall(NEARBY_STOP_REPORTS_SQL, {
+                'min_lat': min_lat, 'max_lat': max_lat,
+                'min_lon': min_lon, 'max_lon': max_lon}):
+            rows_by_stop.setdefault(row[0], []).append(row)
+        nearest = _get_nearest_stops(lat, lon, radius_m,
+                ((stop_key, rows[0][2], rows[0][3], rows)
+                 for stop_key, rows in rows_by_stop.items()), limit)
+        # in route key order, as STOP_REPORT_SQL returns them. Ids are
+        # returned as str, as the other queries echo them
+        return [_add_stop_location(_build_stop_report(str(rows[0][1]),
+                    [row[5:] for row in sorted(rows,
+                        key=lambda row: row[4] or 0)]),
+                    stop_lat, stop_lon, distance_m)
+                for distance_m, stop_lat, stop_lon, rows in nearest]
+
+    def get_stop_reports(self, stop_ids,
+            chunk_size=DEFAULT_STOP_CHUNK_SIZE):
+        '''generator, yields (stop_id, stop report) for every stop_id in the
+        iterable stop_ids, in order, resolving chunk_size stops per query.
+        The report is as in get_stop_report, an empty dict if the stop does
+        not exist'''
+        stop_ids = iter(stop_ids)
+        while True:
+            chunk = list(islice(stop_ids, chunk_size))
+            if not chunk:
+                break
+            sql_query = STOP_REPORTS_SQL % ', '.join(['(?, ?)'] * len(chunk))
+            params = [value for position, stop_id in enumerate(chunk)
+                    for value in (position, stop_id)]
+            start = time.perf_counter()
+            rows = self._fetchall(sql_query, params)
+            if self.instrumentation is not None:
+                self.instrumentation.record_query('get_stop_reports',
+                        time.perf_counter() - start)
+            rows_by_position = {position: [row[1:] for row in rows]
+                    for position, rows in groupby(rows,
+                        key=lambda row: row[0])}
+            for position, stop_id in enumerate(chunk):
+                yield stop_id, _build_stop_report(stop_id,
+                        rows_by_position.get(position))
+
+
+class RoutesPool:
+    '''
+    The query methods of RoutesSession for any number of threads at once:
+    each query borrows an idle session, or opens one, so queries run on
+    their own connection in parallel rather than queueing on a shared
+    session's lock. SQLite releases the GIL while it runs a query.
+    The database generation is checked before every query. Once an import
+    publishes a new one, the next queries open sessions on it and the
+    sessions of the previous generation are closed as their queries return,
+    so no query is dropped or waits for the swap.
+
+    with RoutesPool('db.sqlite') as pool:
+        pool.get_stop_report('5644')
+    '''
+    def __init__(self, db_filepath, size=DEFAULT_POOL_SIZE,
+            instrumentation=None):
+        self.db_filepath = db_filepath
+        self.size = size
+        self.instrumentation = instrumentation
+        self.generation = get_database_generation(db_filepath)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''closes the idle sessions, those borrowed are closed as they are
+        returned'''
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+    def _acquire(self) -> tuple:
+        '''returns (generation, session), a session of the current
+        generation'''
+        stale = []
+        with self._lock:
+            if self._closed:
+                raise ValueError('RoutesPool of %s is closed'
+                        % self.db_filepath)
+            # stat under the lock: a thread that stat'ed the previous
+            # generation before another saw the new one would flip back
+            generation = get_database_generation(self.db_filepath)
+            if generation != self.generation:
+                self.generation = generation
+                stale, self._idle = self._idle, []
+            session = self._idle.pop() if self._idle else None
+        for stale_session in stale:
+            stale_session.close()
+        if session is None:
+            # resolves the symlink, the session stays on this generation
+            session = RoutesSession(self.db_filepath,
+                    instrumentation=self.instrumentation)
+        return generation, session
+
+    def _release(self, generation, session):
+        with self._lock:
+            if (not self._closed and generation == self.generation
+                    and len(self._idle) < self.size):
+                self._idle.append(session)
+                return
+        session.close()
+
+    def _query(self, method_name, *args):
+        generation, session = self._acquire()
+        try:
+            return getattr(session, method_name)(*args)
+        finally:
+            self._release(generation, session)
+
+    def check_if_stop_exists(self, stop_id) -> bool:
+        return self._query('check_if_stop_exists', stop_id)
+
+    def get_stop_name(self, stop_id) -> str:
+        '''if there is no match, returns an empty str'''
+        return self._query('get_stop_name', stop_id)
+
+    def get_route_ids_passing_through_stop(self, stop_id) -> set:
+        '''if there is no match, returns an empty set'''
+        return self._query('get_route_ids_passing_through_stop', stop_id)
+
+    def get_route_short_name(self, route_id) -> str:
+        '''If there is no match, returns an empty str'''
+        return self._query('get_route_short_name', route_id)
+
+    def get_route_long_name(self, route_id) -> str:
+        '''If there is no match, returns an empty str'''
+        return self._query('get_route_long_name', route_id)
+
+    def get_latest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''If there is no match, returns an empty str'''
+        return self._query('get_latest_service_for_stop_on_trip', route_id,
+                stop_id)
+
+    def get_earliest_service_for_stop_on_trip(self, route_id, stop_id) -> str:
+        '''If there is no match, returns an empty str'''
+        return self._query('get_earliest_service_for_stop_on_trip', route_id,
+                stop_id)
+
+    def get_stop_report(self, stop_id) -> dict:
+        '''see RoutesSession.get_stop_report'''
+        return self._query('get_stop_report', stop_id)
+
+    def get_next_departures(self, stop_id, after,
+            limit=DEFAULT_NEXT_DEPARTURES, route_id=None) -> list:
+        '''see RoutesSession.get_next_departures'''
+        return self._query('get_next_departures', stop_id, after, limit,
+                route_id)
+
+    def get_stops_near(self, lat, lon, radius_m, limit=None) -> list:
+        '''see RoutesSession.get_stops_near'''
+        return self._query('get_stops_near', lat, lon, radius_m, limit)
+
+    def get_stop_reports(self, stop_ids,
+            chunk_size=DEFAULT_STOP_CHUNK_SIZE):
+        '''see RoutesSession.get_stop_reports, every report comes from the
+        generation current when the iteration started'''
+        generation, session = self._acquire()
+        try:
+            yield from session.get_stop_reports(stop_ids, chunk_size)
+        finally:
+            self._release(generation, session)
+
+
+def open_session(db_filepath, backend='sqlite', instrumentation=None):
+    '''returns a RoutesSession for backend 'sqlite', a
+    MemoryIndex.MemoryRoutesIndex for backend 'memory', or a
+    Snapshot.SnapshotRoutesIndex of the snapshot exported next to the
+    database for backend 'snapshot'. All expose the same query methods and
+    can be used as context managers'''
+    if backend == 'sqlite':
+        return RoutesSession(db_filepath, instrumentation=instrumentation)
+    elif backend == 'memory':
+        from GTFSProcessor.MemoryIndex import MemoryRoutesIndex
+        return MemoryRoutesIndex.from_database(db_filepath, instrumentation)
+    elif backend == 'snapshot':
+        from GTFSProcessor.Snapshot import (SnapshotRoutesIndex,
+                                            SNAPSHOT_SUFFIX)
+        return SnapshotRoutesIndex(db_filepath + SNAPSHOT_SUFFIX,
+                instrumentation)
+    raise ValueError('Unknown backend %s, expected one of %s'
+            % (backend, ', '.join(BACKENDS)))
+
+
+# Module level functions open a RoutesSession for a single call.
+# Use a RoutesSession directly when making more than one query.
+
 def check_if_stop_exists(db_filepath, stop_id) -> bool:
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''select id
-                    from stop
-                    where stop.id =:id;''', {"id" : stop_id})
-    return len(cursor.fetchall()) > 0
+    with RoutesSession(db_filepath) as session:
+        return session.check_if_stop_exists(stop_id)
 
 
 def get_stop_name(db_filepath, stop_id) -> str:
     '''if there is no match, returns an empty str'''
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''select name
-                    from stop
-                    where stop.id =:id;''', {"id" : stop_id})
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    else:
-        return ''
-    
+    with RoutesSession(db_filepath) as session:
+        return session.get_stop_name(stop_id)
+
+
 def get_route_ids_passing_through_stop(db_filepath, stop_id) -> set:
     '''if there is no match, returns an empty set'''
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''select route_id 
-                    from stop_route
-                    where stop_route.stop_id =:id;''', {"id" : stop_id})
-    return set([tuple_[0] for tuple_ in cursor.fetchall()])
+    with RoutesSession(db_filepath) as session:
+        return session.get_route_ids_passing_through_stop(stop_id)
 
 
 def get_route_short_name(db_filepath, route_id) -> str:
     '''If there is no match, returns an empty str'''
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''SELECT short_name
-                    FROM Route
-                    WHERE Route.id =:id;''', {'id' : route_id})
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    else:
-        return ''
+    with RoutesSession(db_filepath) as session:
+        return session.get_route_short_name(route_id)
 
 
 def get_route_long_name(db_filepath, route_id) -> str:
     '''If there is no match, returns an empty str'''
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''SELECT long_name
-                    FROM Route
-                    WHERE Route.id =:id;''', {'id' : route_id})
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    else:
-        return ''
+    with RoutesSession(db_filepath) as session:
+        return session.get_route_long_name(route_id)
 
 
-def get_latest_service_for_stop_on_trip(db_filepath, route_id, 
+def get_latest_service_for_stop_on_trip(db_filepath, route_id,
         stop_id) -> str:
     '''If there is no match, returns an empty str'''
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''SELECT max(Stop_Trip.departure_time_in_sec) 
-                    FROM Stop_Trip, Trip
-                    WHERE Stop_Trip.stop_id = :in_stop_id 
-                    AND Stop_Trip.trip_id = Trip.id
-                    AND Trip.route_id = :in_trip_id
-                    ;''', {'in_stop_id' : stop_id,
-                        'in_trip_id' : route_id})
-    result = cursor.fetchone()
-    if result[0] is None:
-        return ''
-    else:
-        return _seconds_to_str(result[0])
+    with RoutesSession(db_filepath) as session:
+        return session.get_latest_service_for_stop_on_trip(route_id, stop_id)
 
 
-def get_earliest_service_for_stop_on_trip(db_filepath, route_id, 
+def get_earliest_service_for_stop_on_trip(db_filepath, route_id,
         stop_id) -> str:
     '''If there is no match, returns an empty str'''
-    db_connection = sqlite3.connect(db_filepath)
-    cursor = db_connection.cursor()
-    cursor.execute('''SELECT min(Stop_Trip.departure_time_in_sec)
-                    FROM Stop_Trip, Trip
-                    WHERE Stop_Trip.stop_id = :in_stop_id 
-                    AND Stop_Trip.trip_id = Trip.id
-                    AND Trip.route_id = :in_trip_id
-                    ;''', {'in_stop_id' : stop_id,
-                        'in_trip_id' : route_id})
-    result = cursor.fetchone()
-    if result[0] is None:
-        return ''
-    else:
-        return _seconds_to_str(result[0])
+    with RoutesSession(db_filepath) as session:
+        return session.get_earliest_service_for_stop_on_trip(route_id, stop_id)
+
+
+def get_stop_report(db_filepath, stop_id) -> dict:
+    '''see RoutesSession.get_stop_report'''
+    with RoutesSession(db_filepath) as session:
+        return session.get_stop_report(stop_id)
+
+
+def get_stop_reports(db_filepath, stop_ids,
+        chunk_size=DEFAULT_STOP_CHUNK_SIZE):
+    '''see RoutesSession.get_stop_reports'''
+    with RoutesSession(db_filepath) as session:
+        yield from session.get_stop_reports(stop_ids, chunk_size)
+
+
+def get_next_departures(db_filepath, stop_id, after,
+        limit=DEFAULT_NEXT_DEPARTURES, route_id=None) -> list:
+    '''see RoutesSession.get_next_departures'''
+    with RoutesSession(db_filepath) as session:
+        return session.get_next_departures(stop_id, after, limit, route_id)
+
+
+def get_stops_near(db_filepath, lat, lon, radius_m, limit=None) -> list:
+    '''see RoutesSession.get_stops_near'''
+    with RoutesSession(db_filepath) as session:
+        return session.get_stops_near(lat, lon, radius_m, limit)
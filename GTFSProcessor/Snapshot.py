@@ -0,0 +1,248 @@
+import os
+import mmap
+import sys
+import sqlite3
+import struct
+
+from array                      import array
+
+from GTFSProcessor.Routes       import _get_read_only_uri
+from GTFSProcessor.MemoryIndex  import ArrayRoutesIndex, MemoryRoutesIndex
+from GTFSProcessor.ZIPImporter  import BUILDING_SUFFIX
+
+
+# export_snapshot's default path, and the file open_session opens for the
+# 'snapshot' backend, is the database path plus SNAPSHOT_SUFFIX
+SNAPSHOT_SUFFIX = '.snapshot'
+MAGIC = b'GTFSSNAP'
+FORMAT_VERSION = 2
+# magic, format version, byte order (0 little, 1 big), section count
+HEADER_FORMAT = '=8sIII'
+# name, array typecode, offset from the start of the file, item count
+SECTION_FORMAT = '=32s4sqq'
+# every section starts on a multiple of this, so it can be cast in place
+SECTION_ALIGNMENT = 8
+# first byte of each string table entry, the rest is the utf-8 payload
+STR_TAG = b's'
+INT_TAG = b'i'
+NONE_TAG = b'n'
+# (section name, typecode) of the arrays of an ArrayRoutesIndex. Offsets
+# and cell ids are 64 bit, values indexing stops, routes or trips 32 bit
+ARRAY_SECTIONS = (
+    ('stop_pair_offsets', 'q'),
+    ('pair_route_index', 'i'),
+    ('pair_departure_offsets', 'q'),
+    ('departure_sec', 'i'),
+    ('departure_trip_index', 'i'),
+    ('stop_lat', 'd'),
+    ('stop_lon', 'd'),
+    ('grid_cell_ids', 'q'),
+    ('grid_cell_offsets', 'q'),
+    ('grid_stop_index', 'i'),
+    )
+# string tables of an ArrayRoutesIndex, the id tables are also searchable
+STRING_TABLES = ('_stop_names', '_route_short_names', '_route_long_names',
+        '_trip_ids')
+ID_TABLES = (('_stop_ids', '_stop_index_map'),
+             ('_route_ids', '_route_index_map'))
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return NONE_TAG
+    if isinstance(value, int):
+        return INT_TAG + str(value).encode('ascii')
+    return STR_TAG + value.encode('utf-8')
+
+
+def _decode(data) -> object:
+    tag, payload = data[:1], data[1:]
+    if tag == INT_TAG:
+        return int(payload)
+    if tag == STR_TAG:
+        return payload.decode('utf-8')
+    return None
+
+
+def _get_string_table_sections(name, values) -> list:
+    '''returns [(section name, array)] for the offsets and the utf-8 data of
+    the tagged values'''
+    offsets = array('q', [0])
+    data = bytearray()
+    for value in values:
+        data += _encode(value)
+        offsets.append(len(data))
+    return [(name + '.offsets', offsets), (name + '.data', array('B', data))]
+
+
+def _get_id_order_section(name, values) -> tuple:
+    '''indexes of values sorted by their encoding, for binary search'''
+    encoded = [_encode(value) for value in values]
+    return (name + '.order', array('i', sorted(range(len(encoded)),
+            key=encoded.__getitem__)))
+
+
+def _get_sections(index) -> list:
+    sections = [(name, array(typecode, getattr(index, name)))
+            for name, typecode in ARRAY_SECTIONS]
+    for name in STRING_TABLES:
+        sections += _get_string_table_sections(name, getattr(index, name))
+    for name, _ in ID_TABLES:
+        values = getattr(index, name)
+        sections += _get_string_table_sections(name, values)
+        sections.append(_get_id_order_section(name, values))
+    return sections
+
+
+def _align(offset) -> int:
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+
+def _write_snapshot_file(f, sections):
+    offset = _align(struct.calcsize(HEADER_FORMAT)
+            + struct.calcsize(SECTION_FORMAT) * len(sections))
+    table = []
+    for name, values in sections:
+        table.append(struct.pack(SECTION_FORMAT, name.encode('ascii'),
+                values.typecode.encode('ascii'), offset, len(values)))
+        offset = _align(offset + len(values) * values.itemsize)
+    f.write(struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION,
+            sys.byteorder == 'big', len(sections)))
+    f.write(b''.join(table))
+    for name, values in sections:
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        values.tofile(f)
+
+
+def export_snapshot(db_filepath, snapshot_path=None) -> int:
+    '''
+    Writes the query-ready arrays and string tables of an imported database
+    to snapshot_path, db_filepath + SNAPSHOT_SUFFIX by default, to be served
+    by SnapshotRoutesIndex.
+    The file is written next to snapshot_path then renamed over it, so
+    processes with the previous snapshot mapped keep reading it unchanged.
+    returns the snapshot size in bytes
+    '''
+    db_connection = sqlite3.connect(_get_read_only_uri(db_filepath), uri=True)
+    try:
+        sections = _get_sections(MemoryRoutesIndex(db_connection))
+    finally:
+        db_connection.close()
+    if snapshot_path is None:
+        snapshot_path = db_filepath + SNAPSHOT_SUFFIX
+    building_path = snapshot_path + BUILDING_SUFFIX
+    with open(building_path, 'wb') as f:
+        _write_snapshot_file(f, sections)
+    os.replace(building_path, snapshot_path)
+    return os.path.getsize(snapshot_path)
+
+
+class _StringTable:
+    '''read-only sequence decoding the entries of a string table section
+    pair on access'''
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get_bytes(self, i) -> bytes:
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return _decode(self.get_bytes(i))
+
+
+class _IdIndex:
+    '''the dict interface ArrayRoutesIndex uses to map an id to its index,
+    a binary search of the string table in encoded order'''
+    def __init__(self, string_table, order):
+        self._string_table = string_table
+        self._order = order
+
+    def get(self, value, default=None):
+        target = _encode(value)
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string_table.get_bytes(self._order[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._order):
+            i = self._order[lo]
+            if self._string_table.get_bytes(i) == target:
+                return i
+        return default
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+
+class SnapshotRoutesIndex(ArrayRoutesIndex):
+    '''
+    An ArrayRoutesIndex served straight from a memory-mapped snapshot
+    written by export_snapshot: the arrays are memoryview casts of the
+    mapping and strings are decoded on access, so opening costs no parsing
+    or copying and every process mapping the file shares its pages through
+    the OS page cache.
+
+    with SnapshotRoutesIndex('db.sqlite.snapshot') as index:
+        index.get_stop_report('5644')
+    '''
+    def __init__(self, snapshot_path, instrumentation=None):
+        self.instrumentation = instrumentation
+        with open(snapshot_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = [memoryview(self._mmap)]
+        try:
+            sections = self._read_sections()
+        except Exception:
+            self.close()
+            raise
+        for name, _ in ARRAY_SECTIONS:
+            setattr(self, name, sections[name])
+        for name in STRING_TABLES:
+            setattr(self, name, _StringTable(sections[name + '.offsets'],
+                    sections[name + '.data']))
+        for name, index_map_name in ID_TABLES:
+            string_table = _StringTable(sections[name + '.offsets'],
+                    sections[name + '.data'])
+            setattr(self, name, string_table)
+            setattr(self, index_map_name, _IdIndex(string_table,
+                    sections[name + '.order']))
+
+    def _read_sections(self) -> dict:
+        '''returns {section name : memoryview cast to its typecode}, raises
+        ValueError if the file is not a snapshot this reader can map'''
+        view = self._views[0]
+        header_size = struct.calcsize(HEADER_FORMAT)
+        if len(view) < header_size:
+            raise ValueError('Not a GTFS snapshot')
+        magic, version, big_endian, section_count = struct.unpack_from(
+                HEADER_FORMAT, view)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('Not a version %d GTFS snapshot'
+                    % FORMAT_VERSION)
+        if big_endian != (sys.byteorder == 'big'):
+            raise ValueError('Snapshot was written with another byte order')
+        sections = {}
+        section_size = struct.calcsize(SECTION_FORMAT)
+        for i in range(section_count):
+            name, typecode, offset, count = struct.unpack_from(SECTION_FORMAT,
+                    view, header_size + i * section_size)
+            typecode = typecode.rstrip(b'\0').decode('ascii')
+            size = count * array(typecode).itemsize
+            section = view[offset:offset + size].cast(typecode)
+            self._views.append(section)
+            sections[name.rstrip(b'\0').decode('ascii')] = section
+        return sections
+
+    def close(self):
+        '''releases the views and the mapping, the index is unusable after'''
+        while self._views:
+            self._views.pop().release()
+        self._mmap.close()
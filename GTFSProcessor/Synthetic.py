@@ -0,0 +1,102 @@
+import io
+import random
+import zipfile
+
+
+# fixed so that the same arguments always produce the same archive bytes
+ZIP_DATE_TIME = (2016, 1, 1, 0, 0, 0)
+WRITE_BATCH_LINES = 10000
+CENTER_LAT = 45.5
+CENTER_LON = -73.6
+SPREAD_DEGREES = 0.2
+FIRST_DEPARTURE_SEC = 4 * 3600
+# trips start up to this long after FIRST_DEPARTURE_SEC, running past 24:00
+SERVICE_SPAN_SEC = 21 * 3600
+MIN_HOP_SEC = 60
+MAX_HOP_SEC = 180
+
+
+def _format_time(seconds) -> str:
+    m, s = divmod(seconds, 60)
+    h, m = divmod(m, 60)
+    return '%02d:%02d:%02d' % (h, m, s)
+
+
+def _write_member(zip_file, filename, header, lines):
+    '''streams lines (an iterable of str without newline) into the archive'''
+    info = zipfile.ZipInfo(filename, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    with zip_file.open(info, 'w', force_zip64=True) as raw_file:
+        f = io.TextIOWrapper(raw_file, encoding='utf-8', newline='\n')
+        f.write(header + '\n')
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= WRITE_BATCH_LINES:
+                f.write('\n'.join(batch) + '\n')
+                batch = []
+        if batch:
+            f.write('\n'.join(batch) + '\n')
+        f.flush()
+        f.detach()
+
+
+def _route_lines(route_count):
+    for i in range(1, route_count + 1):
+        yield '%d,SYN,R%d,Synthetic route %d,3' % (i, i, i)
+
+
+def _trip_lines(trip_count, route_count):
+    for i in range(trip_count):
+        yield '%d,WEEK,T%d' % (i % route_count + 1, i)
+
+
+def _stop_lines(stop_count, rng):
+    for i in range(1, stop_count + 1):
+        yield '%d,Stop %d,%.6f,%.6f' % (i, i,
+                CENTER_LAT + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+                CENTER_LON + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES))
+
+
+def _stop_time_lines(trip_count, route_patterns, rng):
+    route_count = len(route_patterns)
+    for i in range(trip_count):
+        seconds = FIRST_DEPARTURE_SEC + rng.randrange(SERVICE_SPAN_SEC)
+        for sequence, stop_id in enumerate(route_patterns[i % route_count], 1):
+            time_string = _format_time(seconds)
+            yield 'T%d,%s,%s,%d,%d' % (i, time_string, time_string, stop_id,
+                    sequence)
+            seconds += rng.randint(MIN_HOP_SEC, MAX_HOP_SEC)
+
+
+def write_synthetic_feed(zip_path, stop_count=1000, route_count=50,
+        trip_count=2000, stops_per_trip=20, seed=0) -> dict:
+    '''
+    Writes a GTFS zip with routes.txt, trips.txt, stops.txt and
+    stop_times.txt. Every route serves its own random sequence of
+    stops_per_trip stops, trips are spread over the routes round robin and
+    start between 04:00 and 25:00. Members are streamed, so feeds of 10M+
+    stop_times need no more memory than small ones.
+    The output is fully determined by the arguments.
+    returns dict: {'stops', 'routes', 'trips', 'stop_times' : row counts}
+    '''
+    if min(stop_count, route_count, trip_count, stops_per_trip) < 1:
+        raise ValueError('All counts must be positive')
+    stops_per_trip = min(stops_per_trip, stop_count)
+    rng = random.Random(seed)
+    route_patterns = [rng.sample(range(1, stop_count + 1), stops_per_trip)
+            for _ in range(route_count)]
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        _write_member(zip_file, 'routes.txt', 'route_id,agency_id,'
+                'route_short_name,route_long_name,route_type',
+                _route_lines(route_count))
+        _write_member(zip_file, 'trips.txt', 'route_id,service_id,trip_id',
+                _trip_lines(trip_count, route_count))
+        _write_member(zip_file, 'stops.txt',
+                'stop_id,stop_name,stop_lat,stop_lon',
+                _stop_lines(stop_count, rng))
+        _write_member(zip_file, 'stop_times.txt', 'trip_id,arrival_time,'
+                'departure_time,stop_id,stop_sequence',
+                _stop_time_lines(trip_count, route_patterns, rng))
+    return {'stops': stop_count, 'routes': route_count, 'trips': trip_count,
+            'stop_times': trip_count * stops_per_trip}
@@ -0,0 +1,115 @@
+import json
+
+
+# the examples of each issue kept by a ValidationReport
+DEFAULT_MAX_SAMPLES = 5
+ERROR = 'error'
+WARNING = 'warning'
+# check name : (severity, description). Rows failing an error check are not
+# imported, warnings are about rows imported as is or that no query reaches
+CHECKS = {
+    'malformed_row': (ERROR, 'fewer fields than the header, row skipped'),
+    'invalid_time': (ERROR, 'time neither empty nor formatted as HH:MM:SS, '
+        'row skipped'),
+    'duplicate_id': (ERROR, 'id already used earlier in the file, row '
+        'skipped'),
+    'unknown_route_id': (ERROR, 'route_id not in routes.txt, row skipped'),
+    'unknown_trip_id': (ERROR, 'trip_id not in trips.txt, row skipped'),
+    'unknown_stop_id': (ERROR, 'stop_id not in stops.txt, row skipped'),
+    'invalid_coordinate': (WARNING, 'stop_lat or stop_lon not a number, '
+        'stop imported without coordinates'),
+    'route_without_trips': (WARNING, 'no trip runs the route'),
+    'trip_without_stop_times': (WARNING, 'no stop time on the trip'),
+    'stop_without_departures': (WARNING, 'no stop time at the stop'),
+    }
+# (check name, file of the rows, query of their ids). Each is a single
+# anti-join over a whole table, run once the import is complete
+UNUSED_ROW_CHECKS = (
+    ('route_without_trips', 'routes.txt',
+        'SELECT id FROM Route WHERE key NOT IN (SELECT route_key FROM Trip);'),
+    ('trip_without_stop_times', 'trips.txt',
+        '''SELECT id FROM Trip
+        WHERE key NOT IN (SELECT trip_key FROM Stop_Trip);'''),
+    ('stop_without_departures', 'stops.txt',
+        '''SELECT id FROM Stop
+        WHERE key NOT IN (SELECT stop_key FROM Stop_Trip);'''),
+    )
+
+
+def print_summary(report):
+    '''prints a ValidationReport, one line per issue with its first
+    samples'''
+    print('Validation: %d errors, %d warnings.' % (report.error_count,
+            report.warning_count))
+    for issue in report.report()['issues']:
+        print('  %s %s %s: %d rows (%s), e.g. %s' % (issue['severity'],
+                issue['filename'], issue['check'], issue['count'],
+                issue['description'],
+                ', '.join(repr(sample) for sample in issue['samples'])))
+
+
+class ValidationReport:
+    '''
+    The issues found in a feed while it is imported, counted per (file,
+    check) in CHECKS with the first max_samples examples of each: the
+    offending id, time or line.
+
+    report = ValidationReport()
+    ZIPImporter.import_into_database(zip_path, db_path,
+            validation_report=report)
+    report.error_count
+    '''
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.issues = {}
+
+    def add(self, filename, check, sample):
+        issue = self.issues.get((filename, check))
+        if issue is None:
+            severity, description = CHECKS[check]
+            issue = self.issues[(filename, check)] = {'filename': filename,
+                    'check': check, 'severity': severity,
+                    'description': description, 'count': 0, 'samples': []}
+        issue['count'] += 1
+        if len(issue['samples']) < self.max_samples:
+            issue['samples'].append(sample)
+
+    def get_recorder(self, filename):
+        '''returns record_issue(check, sample), adding to this report for
+        filename'''
+        return lambda check, sample: self.add(filename, check, sample)
+
+    def _get_count(self, severity) -> int:
+        return sum(issue['count'] for issue in self.issues.values()
+                if issue['severity'] == severity)
+
+    @property
+    def error_count(self) -> int:
+        return self._get_count(ERROR)
+
+    @property
+    def warning_count(self) -> int:
+        return self._get_count(WARNING)
+
+    def report(self) -> dict:
+        '''the issues, errors first, as a JSON serialisable dict'''
+        issues = sorted(self.issues.values(), key=lambda issue: (
+                issue['severity'] != ERROR, issue['filename'], issue['check']))
+        return {'errors': self.error_count, 'warnings': self.warning_count,
+                'issues': [dict(issue, samples=list(issue['samples']))
+                           for issue in issues]}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.report(), **kwargs)
+
+
+def check_unused_rows(db_connection, report) -> int:
+    '''adds the routes without trips, trips without stop times and stops
+    without departures of an imported database to report, their GTFS ids as
+    str. returns the number of rows found'''
+    row_count = 0
+    for check, filename, sql_query in UNUSED_ROW_CHECKS:
+        for gtfs_id, in db_connection.execute(sql_query):
+            report.add(filename, check, str(gtfs_id))
+            row_count += 1
+    return row_count
@@ -1,205 +1,1215 @@
+import io
 import os
+import csv
+import shutil
+import hashlib
 import zipfile
 import sqlite3
 
-from shutil                     import rmtree
-from operator                   import add
-from functools                  import reduce
+from itertools                  import chain, islice
+from collections                import deque
+from concurrent.futures         import ProcessPoolExecutor
+
+from GTFSProcessor              import Columnar
+from GTFSProcessor.Instrumentation import Instrumentation, print_phase
+from GTFSProcessor.Validation   import (ValidationReport, check_unused_rows,
+                                        print_summary)
 
 
-TEMP_DIR = 'temp/'
 REQUIRED_GFTS_FILENAMES_SET = ['routes.txt','stops.txt', 'stop_times.txt',
         'trips.txt']
+DEFAULT_BATCH_SIZE = 50000
+# the database is built in sqlite_database_path + BUILDING_SUFFIX, then renamed
+# to a new generation, sqlite_database_path + GENERATION_SUFFIX + number, and
+# sqlite_database_path atomically replaced by a symlink to it
+BUILDING_SUFFIX = '.building'
+GENERATION_SUFFIX = '.generation-'
+# the symlink is created here, then renamed over sqlite_database_path
+LINK_SUFFIX = '.link'
+# generations left on disk, the current and the previous one, which readers
+# that have not moved to the current generation yet may still be querying
+KEEP_GENERATIONS = 2
+# of a published generation: readers never wait on a writer, nor a writer on
+# readers, should anything write to it
+PUBLISHED_JOURNAL_MODE = 'WAL'
+# where symlinks cannot be created (Windows without the privilege) the
+# database itself is renamed over sqlite_database_path, as a single file: a
+# WAL file left next to the path would be applied to the next database there
+UNLINKED_JOURNAL_MODE = 'DELETE'
+HASH_BLOCK_SIZE = 1 << 20
+# bytes of whole lines handed to a parser process at a time when workers > 1
+PARSE_CHUNK_SIZE = 4 << 20
+# parsed chunks allowed in flight per worker before the writer catches up
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+# bytes of whole lines split into columns at a time by the columnar
+# stop_times path, each chunk is inserted & checkpointed in one go
+COLUMNAR_CHUNK_SIZE = 1 << 20
+# a quote still open after this many chunk sizes is taken as a stray one, not
+# as a quoted field, and the chunk is cut at its last line end
+MAX_OPEN_QUOTE_CHUNKS = 4
+# applied for the duration of the import only, previous values are restored
+IMPORT_PRAGMAS = (('journal_mode', 'MEMORY'),
+                  ('synchronous', 'OFF'),
+                  ('cache_size', -262144))
+# a full import commits a checkpoint with every batch, its journal must
+# survive the process being killed for the side file to be resumable.
+# Pages appended to the file are not journaled, so this costs little more
+IMPORT_CHECKPOINTED_PRAGMAS = (('journal_mode', 'TRUNCATE'),
+                               ('synchronous', 'OFF'),
+                               ('cache_size', -262144))
+# left next to a database by an interrupted transaction
+JOURNAL_SUFFIXES = ('-journal', '-wal', '-shm')
+# created once the bulk load has finished, then ANALYZE is run
+INDEXES = (
+    ('''CREATE INDEX Stop_Trip_stop_idx
+        ON Stop_Trip (stop_key);'''),
+    ('''CREATE INDEX Stop_Departure_route_idx
+        ON Stop_Departure (stop_key, route_key, departure_time_in_sec);'''),
+    )
+# stored in PRAGMA user_version, an incremental import of a database with
+# another version falls back to a full import
+SCHEMA_VERSION = 4
+# departure_time_in_sec of a stop time with empty times, a non-timepoint
+# stop: it links the stop to the trip's route but is no departure
+UNTIMED_SEC = -1
 
 def _verify_zip_contains_required_GTFS_filenames(zip_path):
-    zip_file = zipfile.ZipFile(zip_path)
-    filenames_set = set(zip_file.namelist())
+    with zipfile.ZipFile(zip_path) as zip_file:
+        filenames_set = set(zip_file.namelist())
     for filename in REQUIRED_GFTS_FILENAMES_SET:
         if filename not in filenames_set:
             raise zipfile.BadZipfile('Archive is missing filename %s' 
                     % filename)
 
 
-def _extract_to_temp_dir(zip_path):
-    if os.path.exists(TEMP_DIR):
-        rmtree(TEMP_DIR)
-    zip_file = zipfile.ZipFile(zip_path)
-    for filename in REQUIRED_GFTS_FILENAMES_SET:
-        zip_file.extract(filename, path=TEMP_DIR)
-
-
 def _create_sqlite_db(path) -> sqlite3.Connection:
+    '''
+    Route, Trip and Stop map each GTFS id to a dense integer surrogate key,
+    which is all the link tables store. GTFS route & stop ids keep INT
+    affinity, trip ids are TEXT.
+    Stop_Location is an R*Tree of the stops with coordinates, each a point
+    box keyed by its stop_key.
+    '''
     connection = sqlite3.connect(path)
     cursor = connection.cursor()    
     cursor.execute('''CREATE TABLE Route 
-                    (id INT PRIMARY KEY,
-                    short_name VARCHAR(10),
-                    long_name TEXT(150));''')
+                    (key INTEGER PRIMARY KEY,
+                    id INT NOT NULL UNIQUE,
+                    short_name TEXT,
+                    long_name TEXT);''')
     cursor.execute('''CREATE TABLE Trip 
-                    (id VARCHAR(100) PRIMARY KEY,
-                    route_id INT,
-                    FOREIGN KEY(route_id) REFERENCES Route(id));''')
+                    (key INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    route_key INTEGER NOT NULL,
+                    FOREIGN KEY(route_key) REFERENCES Route(key));''')
     cursor.execute('''CREATE TABLE Stop 
-                    (name TEXT(150),
-                    id INT PRIMARY KEY);''')
+                    (key INTEGER PRIMARY KEY,
+                    id INT NOT NULL UNIQUE,
+                    name TEXT,
+                    lat REAL,
+                    lon REAL);''')
+    cursor.execute('''CREATE VIRTUAL TABLE Stop_Location USING rtree
+                    (stop_key,
+                    min_lat, max_lat,
+                    min_lon, max_lon);''')
     cursor.execute('''CREATE TABLE Stop_Trip
-                    (stop_id INT,
-                    trip_id VARCHAR(100),
-                    departure_time_in_sec INT,
-                    FOREIGN KEY(trip_id) REFERENCES Trip(id),
-                    FOREIGN KEY(stop_id) REFERENCES Stop(id)
-                    ); ''')
-    cursor.execute('''CREATE TABLE Stop_Route
-                    (route_id INT,
-                    stop_id INT,
-                    FOREIGN KEY(route_id) REFERENCES Route(id),
-                    FOREIGN KEY(stop_id) REFERENCES Stop(id));''')
+                    (trip_key INTEGER,
+                    departure_time_in_sec INTEGER,
+                    stop_key INTEGER,
+                    PRIMARY KEY(trip_key, departure_time_in_sec, stop_key),
+                    FOREIGN KEY(trip_key) REFERENCES Trip(key),
+                    FOREIGN KEY(stop_key) REFERENCES Stop(key)
+                    ) WITHOUT ROWID;''')
+    cursor.execute('''CREATE TABLE Stop_Departure
+                    (stop_key INTEGER,
+                    departure_time_in_sec INTEGER,
+                    trip_key INTEGER,
+                    route_key INTEGER NOT NULL,
+                    PRIMARY KEY(stop_key, departure_time_in_sec, trip_key)
+                    ) WITHOUT ROWID;''')
+    cursor.execute('''CREATE TABLE Feed_File
+                    (filename TEXT PRIMARY KEY,
+                    sha256 TEXT);''')
+    cursor.execute('''CREATE TABLE Stop_Route_Summary
+                    (stop_key INTEGER,
+                    route_key INTEGER,
+                    earliest_sec INTEGER,
+                    latest_sec INTEGER,
+                    PRIMARY KEY(stop_key, route_key),
+                    FOREIGN KEY(route_key) REFERENCES Route(key),
+                    FOREIGN KEY(stop_key) REFERENCES Stop(key)
+                    ) WITHOUT ROWID;''')
+    cursor.execute('PRAGMA user_version = %d;' % SCHEMA_VERSION)
     connection.commit()
     return connection
 
 
-def _get_file_column_to_index_map(filepath) -> dict:
+def _get_file_column_to_index_map(header_line, filename) -> dict:
     '''
     returns dict: {column_name : column_index , ... }
     '''
-    f = open(filepath)
-    line = f.readline()
-    if '\n' not in line:
-        raise Exception("%s is empty !" % filepath)
-    columns = line.rstrip('\n').split(',')
-    col_to_index_map = { col:i for i,col in enumerate(columns) }
-    f.close()
-    return col_to_index_map
+    if '\n' not in header_line:
+        raise Exception("%s is empty !" % filename)
+    columns = next(_split_csv_records([header_line]))
+    return { col:i for i,col in enumerate(columns) }
+
 
+def _set_pragmas(db_connection, pragmas) -> tuple:
+    '''applies ((pragma_name, value), ...), returns the previous values
+    in the same structure so they can be restored afterwards'''
+    previous = []
+    for name, value in pragmas:
+        previous.append(
+            (name, db_connection.execute('PRAGMA %s;' % name).fetchone()[0]))
+        db_connection.execute('PRAGMA %s = %s;' % (name, value))
+    return tuple(previous)
 
-def _insert_data_into_table(db_connection, columns_to_values_map, table_name):
-    cursor = db_connection.cursor()
-    column_names, values = zip(*columns_to_values_map.items())
-    sql_query = 'INSERT INTO %s\n' % table_name \
-        + '(' + ', '.join(['"%s"' % n for n in column_names]) \
-        + ')\nVALUES (' \
-        + ', '.join(['"%s"' % v for v in values]) + ');'
-    cursor.execute(sql_query)
+
+def _bulk_insert(db_connection, table_name, column_names, rows,
+        batch_size=DEFAULT_BATCH_SIZE, ignore_duplicates=False,
+        checkpoint=None) -> int:
+    '''inserts an iterable of row tuples with executemany, batch_size rows
+    at a time, all within one transaction. With ignore_duplicates, rows
+    conflicting with the primary key are dropped.
+    With a checkpoint (see _read_checkpoints), each batch is instead
+    committed together with the checkpoint, then the checkpoint is marked
+    complete.
+    returns the row count read from rows'''
+    sql_query = 'INSERT %sINTO %s (%s) VALUES (%s);' % (
+            'OR IGNORE ' if ignore_duplicates else '', table_name,
+            ', '.join(['"%s"' % n for n in column_names]),
+            ', '.join(['?'] * len(column_names)))
+    rows = iter(rows)
+    row_count = 0
+    with db_connection:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            db_connection.executemany(sql_query, batch)
+            row_count += len(batch)
+            if checkpoint is not None:
+                _write_checkpoint(db_connection, checkpoint)
+                db_connection.commit()
+        if checkpoint is not None:
+            _write_checkpoint(db_connection, checkpoint, complete=True)
+    return row_count
 
 
 def _convert_time_data_to_seconds(time_string) -> int:
-    '''expecting time_string formatted as HH:MM:SS'''
-    number_list = [int(x) for x in time_string.split(':')]
-    return reduce(add, [60 ** (2-i) * num for i, num in enumerate(number_list)])
+    '''expecting time_string formatted as HH:MM:SS, hours may be a single
+    or more than two digits. raises ValueError for any other shape'''
+    parts = time_string.strip().split(':')
+    if len(parts) != 3 or not all(part.isascii() and part.isdigit()
+            for part in parts):
+        raise ValueError('Expected HH:MM:SS, got %s' % time_string)
+    hours, minutes, seconds = map(int, parts)
+    return hours * 3600 + minutes * 60 + seconds
 
         
-def _populate_departure_time_in_sec(db_connection):
-    f = open(TEMP_DIR+'stop_times.txt')
-    col_to_index_map = _get_file_column_to_index_map(TEMP_DIR \
-            + 'stop_times.txt')
-    cursor = db_connection.cursor()
-    for line in f.readlines()[1:]:
-        line_items = line.rstrip('\n').split(',')
-        time_string = line_items[ col_to_index_map['departure_time']]
-        seconds = _convert_time_data_to_seconds(time_string)
-        stop_id = line_items[ col_to_index_map['stop_id']]
-        cursor.execute('''
-                UPDATE Stop_Trip
-                SET departure_time_in_sec = :seconds
-                WHERE stop_id = :stop_id
-                ''', {'seconds': seconds, 'stop_id': stop_id})
-    cursor.commit()
-    f.close()
-
-
-def _insert_data_from_file_into_table(db_connection, filepath, db_table_name, 
-        file_to_table_col_map):
-    '''file_to_table_col_map structure:
-    { file_col_name : table_col_name , ...  }
-    '''
-    col_to_index_map = _get_file_column_to_index_map(filepath)
-    file_column_names, table_column_names = zip(*file_to_table_col_map.items())
-    table_column_names = ['"%s"' % x for x in table_column_names]
-
-    f = open(filepath)
-    cursor = db_connection.cursor()
-    for line in f.readlines()[1:]:
-        line_items = line.rstrip('\n').split(',')
-
-        sql_query = 'INSERT INTO %s\n(' % db_table_name
-        sql_query +=  ', '.join(table_column_names) + ')\n VALUES ( '
-        
-        inserted_values = list()
-        for file_col_name in file_column_names:
-            file_column_index = col_to_index_map[file_col_name]
-            inserted_values.append( line_items[file_column_index] )
-        inserted_values = ['"%s"' % x for x in inserted_values]
-        sql_query += ', '.join(inserted_values) + ' );'
-        
-        cursor.execute(sql_query)
-    f.close()
-    db_connection.commit()
-
-
-def _process_routes_file(db_connection):
-    mapping = {'route_id': 'id','route_short_name':'short_name',
-            'route_long_name':'long_name'}
-    _insert_data_from_file_into_table(db_connection, 
-            TEMP_DIR + 'routes.txt', 'Route', mapping)
-
-
-def _process_trips_file(db_connection):
-    mapping = {'trip_id': 'id', 'route_id':'route_id'}
-    _insert_data_from_file_into_table(db_connection, 
-            TEMP_DIR + 'trips.txt', 'Trip', mapping)
-
-
-def _process_stops_file(db_connection):
-    mapping = {'stop_id':'id', 'stop_name':'name'}
-    _insert_data_from_file_into_table(db_connection, 
-            TEMP_DIR + 'stops.txt', 'Stop', mapping)
-
-
-def _process_stop_times_file(db_connection):
-    f = open(TEMP_DIR + 'stop_times.txt')
-    col_to_index_map = _get_file_column_to_index_map(TEMP_DIR \
-            + 'stop_times.txt')
-    for line in f.readlines()[1:]:
-        line_items = line.rstrip('\n').split(',')
-        time_string = line_items[ col_to_index_map['departure_time']]
-        seconds = _convert_time_data_to_seconds(time_string)
-        stop_id = line_items[ col_to_index_map['stop_id']]
-        trip_id  = line_items[ col_to_index_map['trip_id']]
-        mapping = {
-                'stop_id' : stop_id,
-                'trip_id' : trip_id,
-                'departure_time_in_sec' : seconds
-                }
-        _insert_data_into_table(db_connection, mapping, 'Stop_Trip')
-    f.close()
-    db_connection.commit()
-
-
-def import_into_database(archive_path, sqlite_database_path):
-    _verify_zip_contains_required_GTFS_filenames(archive_path)
-    _extract_to_temp_dir(archive_path)
-    if os.path.exists(sqlite_database_path):
-        os.remove(sqlite_database_path)
-    db_connection = _create_sqlite_db(sqlite_database_path)
-    
-    _process_routes_file(db_connection)
-    print('Processed routes.')
-    _process_trips_file(db_connection)
-    print('Processed trips.')
-    _process_stops_file(db_connection)
-    print('Processed stops.')
-    _process_stop_times_file(db_connection)
-    print('Processed stop_times.')
-    cursor = db_connection.cursor()
-    route_stop_data = cursor.execute('''
-                SELECT DISTINCT route_id,stop_id
-                FROM Trip, Stop_Trip
-                WHERE Trip.id = Stop_Trip.trip_id;
-                ''').fetchall()
-    for data_row in route_stop_data:
-        col_to_value_map = {'route_id': data_row[0], 'stop_id': data_row[1]}
-        _insert_data_into_table(db_connection, col_to_value_map, 'Stop_Route')
-    db_connection.commit()
+def _convert_optional_time(time_string) -> int:
+    '''seconds of a HH:MM:SS time_string, UNTIMED_SEC if it is empty.
+    raises ValueError'''
+    if not time_string.strip():
+        return UNTIMED_SEC
+    return _convert_time_data_to_seconds(time_string)
+
+
+def _ignore_issue(check, sample):
+    pass
+
+
+def _get_issue_recorder(report, filename):
+    '''record_issue(check, sample) adding to report, a
+    Validation.ValidationReport, for filename. Without a report issues are
+    ignored'''
+    if report is None:
+        return _ignore_issue
+    return report.get_recorder(filename)
+
+
+def _split_csv_records(lines):
+    '''yields the list of fields of each record of lines, an iterable of CSV
+    lines with their line ends. Lines without a quote, nearly all of a feed,
+    are split on commas; the others are parsed by the csv module, which reads
+    on through the following lines while a quoted field is open. Blank lines
+    are no record'''
+    lines = iter(lines)
+    for line in lines:
+        if '"' in line:
+            yield next(csv.reader(chain((line,), lines)))
+        else:
+            line = line.rstrip('\r\n')
+            if line:
+                yield line.split(',')
+
+
+def _get_time_indexes(file_column_names, time_column_names) -> list:
+    return [file_column_names.index(name) for name in time_column_names]
+
+
+def _parse_records(records, indexes, time_indexes, record_issue):
+    '''yields the tuple of the values at indexes of each record, those at
+    time_indexes converted to seconds, UNTIMED_SEC if empty. A record
+    missing a column or with an invalid time is passed to record_issue and
+    yields None'''
+    for fields in records:
+        try:
+            row = [fields[i] for i in indexes]
+        except IndexError:
+            record_issue('malformed_row', ','.join(fields))
+            yield None
+            continue
+        try:
+            for i in time_indexes:
+                row[i] = _convert_optional_time(row[i])
+        except ValueError:
+            record_issue('invalid_time', row[i])
+            yield None
+            continue
+        yield tuple(row)
+
+
+def _read_member_rows(zip_file, filename, file_column_names,
+        time_column_names=(), record_issue=_ignore_issue):
+    '''lazily yields a tuple of the requested column values for each record
+    of an archive member, streamed without extracting it, with the values of
+    time_column_names converted to seconds. Records that cannot be parsed
+    yield None, see _parse_records, so every record is accounted for.
+    The member is read in the PARSE_CHUNK_SIZE blocks of
+    _read_member_rows_parallel, so a quote left open gives up at the same
+    line whatever the number of workers'''
+    with zip_file.open(filename) as f:
+        col_to_index_map = _get_file_column_to_index_map(
+                f.readline().decode('utf-8-sig'), filename)
+        indexes = [col_to_index_map[name] for name in file_column_names]
+        time_indexes = _get_time_indexes(file_column_names, time_column_names)
+        for chunk in _read_line_aligned_chunks(f, PARSE_CHUNK_SIZE):
+            yield from _parse_records(_split_chunk_records(chunk), indexes,
+                    time_indexes, record_issue)
+
+
+def _find_record_boundary(block) -> int:
+    '''the end of the last line of block, which starts on a record, after
+    which no quoted field is open, 0 if there is none. As in the csv module,
+    a quote opens a quoted field only at the start of a field, elsewhere it
+    is a literal character. The block is searched from quote to quote'''
+    boundary = 0
+    position = 0
+    quoted = False
+    while True:
+        quote = block.find(b'"', position)
+        if quote < 0:
+            if not quoted:
+                boundary = max(boundary, block.rfind(b'\n', position) + 1)
+            return boundary
+        if quoted:
+            if block[quote + 1:quote + 2] == b'"':
+                position = quote + 2
+            elif quote + 1 == len(block):
+                # a closing or an escaped quote, the next block tells
+                return boundary
+            else:
+                quoted = False
+                position = quote + 1
+        else:
+            boundary = max(boundary, block.rfind(b'\n', position, quote) + 1)
+            quoted = quote == 0 or block[quote - 1:quote] in (b',', b'\n')
+            position = quote + 1
+
+
+def _read_line_aligned_chunks(f, chunk_size):
+    '''yields blocks of about chunk_size bytes from the binary stream f, each
+    ending on a line boundary outside quoted fields'''
+    remainder = b''
+    while True:
+        block = f.read(chunk_size)
+        if not block:
+            if remainder:
+                yield remainder
+            return
+        block = remainder + block
+        cut = _find_record_boundary(block)
+        if not cut and len(block) > MAX_OPEN_QUOTE_CHUNKS * chunk_size:
+            cut = block.rfind(b'\n') + 1
+        remainder = block[cut:]
+        if cut:
+            yield block[:cut]
+
+
+def _split_chunk_records(chunk):
+    '''_split_csv_records of a chunk of whole records'''
+    return _split_csv_records(io.StringIO(chunk.decode('utf-8')))
+
+
+def _parse_lines(chunk, indexes, time_indexes) -> tuple:
+    '''runs in a worker process. Parses a chunk of whole records as
+    _read_member_rows does, returns (rows, issues) where issues lists the
+    (check, sample) of the records parsed as None'''
+    issues = []
+    rows = list(_parse_records(_split_chunk_records(chunk), indexes,
+            time_indexes, lambda check, sample: issues.append((check,
+                sample))))
+    return rows, issues
+
+
+def _get_parsed_rows(future, record_issue) -> list:
+    '''the rows of a _parse_lines future, its issues passed to
+    record_issue'''
+    rows, issues = future.result()
+    for check, sample in issues:
+        record_issue(check, sample)
+    return rows
+
+
+def _read_member_rows_parallel(zip_file, filename, file_column_names, workers,
+        time_column_names=(), record_issue=_ignore_issue):
+    '''
+    Like _read_member_rows, with the parsing and time conversion spread over
+    a pool of worker processes.
+    The member is streamed in PARSE_CHUNK_SIZE blocks cut on record
+    boundaries, at most CHUNKS_IN_FLIGHT_PER_WORKER * workers chunks are
+    queued, and rows are yielded in file order to the single writer.
+    '''
+    with zip_file.open(filename) as f:
+        col_to_index_map = _get_file_column_to_index_map(
+                f.readline().decode('utf-8-sig'), filename)
+        indexes = [col_to_index_map[name] for name in file_column_names]
+        time_indexes = _get_time_indexes(file_column_names, time_column_names)
+        with ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for chunk in _read_line_aligned_chunks(f, PARSE_CHUNK_SIZE):
+                pending.append(executor.submit(_parse_lines, chunk, indexes,
+                        time_indexes))
+                if len(pending) >= CHUNKS_IN_FLIGHT_PER_WORKER * workers:
+                    yield from _get_parsed_rows(pending.popleft(),
+                            record_issue)
+            while pending:
+                yield from _get_parsed_rows(pending.popleft(), record_issue)
+
+
+def _count_source_rows(rows, checkpoint):
+    '''yields rows, counting them in checkpoint['source_rows']. The rows
+    pass through lazily, so when a batch is complete the count covers
+    exactly the records it was built from'''
+    for row in rows:
+        checkpoint['source_rows'] += 1
+        yield row
+
+
+def _read_rows(zip_file, filename, file_column_names, workers,
+        time_column_names=(), checkpoint=None, record_issue=_ignore_issue):
+    '''_read_member_rows or, with workers > 1, _read_member_rows_parallel,
+    without the records that could not be parsed. With a checkpoint, the
+    records it already covers are read past and the rest counted'''
+    if workers > 1:
+        rows = _read_member_rows_parallel(zip_file, filename,
+                file_column_names, workers, time_column_names, record_issue)
+    else:
+        rows = _read_member_rows(zip_file, filename, file_column_names,
+                time_column_names, record_issue)
+    if checkpoint is not None:
+        rows = _count_source_rows(islice(rows, checkpoint['source_rows'],
+                None), checkpoint)
+    return (row for row in rows if row is not None)
+
+
+def _normalise_int_id(gtfs_id):
+    '''the value an INT affinity column stores for gtfs_id, so '29' from
+    a file and 29 read back from the database are the same key map entry'''
+    try:
+        return int(gtfs_id)
+    except ValueError:
+        return gtfs_id
+
+
+def _read_key_maps(db_connection) -> dict:
+    '''returns dict: {table_name : {GTFS id : surrogate key , ... } , ... }
+    for the id lookup tables'''
+    return {table_name: dict(db_connection.execute(
+                'SELECT id, key FROM %s;' % table_name))
+            for table_name in KEY_TABLES}
+
+
+def _assign_keys(rows, previous_key_map, key_map, normalise_id,
+        record_issue=_ignore_issue):
+    '''yields (key, id, *rest) for each (id, *rest) row. Ids already in
+    previous_key_map keep their key so incremental imports only see real
+    changes, new ids are numbered after the largest key. key_map is filled
+    with the ids seen, a row repeating one is passed to record_issue and
+    skipped'''
+    next_key = max(previous_key_map.values(), default=0) + 1
+    for row in rows:
+        gtfs_id = normalise_id(row[0])
+        if gtfs_id in key_map:
+            record_issue('duplicate_id', row[0])
+            continue
+        key = previous_key_map.get(gtfs_id)
+        if key is None:
+            key = next_key
+            next_key += 1
+        key_map[gtfs_id] = key
+        yield (key, gtfs_id) + tuple(row[1:])
+
+
+def _replace_ids_with_keys(rows, index, key_map, normalise_id,
+        record_issue=_ignore_issue, check=None):
+    '''yields rows with the GTFS id at index replaced by its key. Rows
+    referring to an id missing from key_map are passed to record_issue as
+    check and skipped, no query could reach them'''
+    for row in rows:
+        key = key_map.get(normalise_id(row[index]))
+        if key is not None:
+            yield row[:index] + (key,) + row[index + 1:]
+        else:
+            record_issue(check, row[index])
+
+
+def _insert_keyed_rows(db_connection, key_maps, key_table, table_name,
+        column_names, rows, normalise_id, batch_size, checkpoint,
+        record_issue) -> int:
+    '''bulk inserts rows into the key_table lookup table (or its incoming
+    copy table_name), replacing key_maps[key_table]. With a checkpoint,
+    key_maps[key_table] holds the rows loaded before the import was
+    interrupted, which are kept'''
+    key_map = {} if checkpoint is None else dict(key_maps[key_table])
+    row_count = _bulk_insert(db_connection, table_name, column_names,
+            _assign_keys(rows, key_maps[key_table], key_map, normalise_id,
+                record_issue),
+            batch_size, checkpoint=checkpoint)
+    key_maps[key_table] = key_map
+    return row_count
+
+
+def _process_routes_file(db_connection, zip_file, key_maps,
+        batch_size=DEFAULT_BATCH_SIZE, table_name='Route', workers=1,
+        checkpoint=None, report=None):
+    record_issue = _get_issue_recorder(report, 'routes.txt')
+    rows = _read_rows(zip_file, 'routes.txt',
+            ('route_id', 'route_short_name', 'route_long_name'), workers,
+            checkpoint=checkpoint, record_issue=record_issue)
+    return _insert_keyed_rows(db_connection, key_maps, 'Route', table_name,
+            ('key', 'id', 'short_name', 'long_name'), rows, _normalise_int_id,
+            batch_size, checkpoint, record_issue)
+
+
+def _process_trips_file(db_connection, zip_file, key_maps,
+        batch_size=DEFAULT_BATCH_SIZE, table_name='Trip', workers=1,
+        checkpoint=None, report=None):
+    record_issue = _get_issue_recorder(report, 'trips.txt')
+    rows = _replace_ids_with_keys(_read_rows(zip_file, 'trips.txt',
+            ('trip_id', 'route_id'), workers, checkpoint=checkpoint,
+            record_issue=record_issue), 1, key_maps['Route'],
+            _normalise_int_id, record_issue, 'unknown_route_id')
+    return _insert_keyed_rows(db_connection, key_maps, 'Trip', table_name,
+            ('key', 'id', 'route_key'), rows, str, batch_size, checkpoint,
+            record_issue)
+
+
+def _parse_coordinate(value):
+    '''float degrees, None for the empty coordinates of e.g. generic
+    nodes'''
+    return float(value) if value.strip() else None
+
+
+def _parse_coordinates(stop_id, lat, lon, record_issue) -> tuple:
+    '''(lat, lon) as _parse_coordinate, (None, None) if either is not a
+    number, which is passed to record_issue'''
+    try:
+        return _parse_coordinate(lat), _parse_coordinate(lon)
+    except ValueError:
+        record_issue('invalid_coordinate', stop_id)
+        return None, None
+
+
+def _process_stops_file(db_connection, zip_file, key_maps,
+        batch_size=DEFAULT_BATCH_SIZE, table_name='Stop', workers=1,
+        checkpoint=None, report=None):
+    record_issue = _get_issue_recorder(report, 'stops.txt')
+    rows = ((stop_id, name) + _parse_coordinates(stop_id, lat, lon,
+                record_issue)
+            for stop_id, name, lat, lon in _read_rows(zip_file, 'stops.txt',
+                ('stop_id', 'stop_name', 'stop_lat', 'stop_lon'), workers,
+                checkpoint=checkpoint, record_issue=record_issue))
+    return _insert_keyed_rows(db_connection, key_maps, 'Stop', table_name,
+            ('key', 'id', 'name', 'lat', 'lon'), rows, _normalise_int_id,
+            batch_size, checkpoint, record_issue)
+
+
+def _process_stop_times_file(db_connection, zip_file, key_maps,
+        batch_size=DEFAULT_BATCH_SIZE, table_name='Stop_Trip', workers=1,
+        checkpoint=None, report=None):
+    record_issue = _get_issue_recorder(report, 'stop_times.txt')
+    rows = _read_rows(zip_file, 'stop_times.txt',
+            ('trip_id', 'departure_time', 'stop_id'), workers,
+            ('departure_time',), checkpoint, record_issue)
+    rows = _replace_ids_with_keys(_replace_ids_with_keys(rows, 0,
+            key_maps['Trip'], str, record_issue, 'unknown_trip_id'), 2,
+            key_maps['Stop'], _normalise_int_id, record_issue,
+            'unknown_stop_id')
+    return _bulk_insert(db_connection, table_name,
+            ('trip_key', 'departure_time_in_sec', 'stop_key'), rows,
+            batch_size, ignore_duplicates=True, checkpoint=checkpoint)
+
+
+def _parse_stop_times_chunk(chunk, column_count, indexes) -> tuple:
+    '''
+    May run in a worker process. Splits a chunk of whole stop_times.txt
+    records into (trip_ids, departure_secs, stop_ids, issues) columns with
+    one entry per record, see Columnar.split_columns & convert_times. When
+    the chunk cannot be split at once, its records are parsed one by one.
+    Malformed records are None in every column, empty times UNTIMED_SEC and
+    invalid times Columnar.INVALID_TIME, issues lists their (check,
+    sample).
+    '''
+    issues = []
+    text = chunk.decode('utf-8')
+    columns = Columnar.split_columns(text, column_count, indexes)
+    if columns is None:
+        rows = list(_parse_records(_split_csv_records(io.StringIO(text)),
+                indexes, (), lambda check, sample: issues.append(
+                    (check, sample))))
+        columns = [[row[i] if row is not None else None for row in rows]
+                for i in range(len(indexes))]
+    trip_ids, times, stop_ids = columns
+    departure_secs = Columnar.convert_times(times, _convert_optional_time)
+    for i in Columnar.get_indexes(departure_secs, Columnar.INVALID_TIME):
+        if times[i] is not None:
+            issues.append(('invalid_time', times[i]))
+    return trip_ids, departure_secs, stop_ids, issues
+
+
+def _parse_in_pool(workers, chunks, column_count, indexes):
+    '''yields _parse_stop_times_chunk of each chunk in order, at most
+    CHUNKS_IN_FLIGHT_PER_WORKER * workers chunks queued'''
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_parse_stop_times_chunk, chunk,
+                    column_count, indexes))
+            if len(pending) >= CHUNKS_IN_FLIGHT_PER_WORKER * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _read_stop_times_columns(zip_file, workers, record_issue):
+    '''yields the (trip_ids, departure_secs, stop_ids) columns of each
+    COLUMNAR_CHUNK_SIZE chunk of stop_times.txt in file order, parsed by
+    _parse_stop_times_chunk in this process or, with workers > 1, in a pool
+    of worker processes. The issues found are passed to record_issue'''
+    with zip_file.open('stop_times.txt') as f:
+        col_to_index_map = _get_file_column_to_index_map(
+                f.readline().decode('utf-8-sig'), 'stop_times.txt')
+        column_count = max(col_to_index_map.values()) + 1
+        indexes = [col_to_index_map[name]
+                for name in ('trip_id', 'departure_time', 'stop_id')]
+        chunks = _read_line_aligned_chunks(f, COLUMNAR_CHUNK_SIZE)
+        if workers > 1:
+            parsed = _parse_in_pool(workers, chunks, column_count, indexes)
+        else:
+            parsed = (_parse_stop_times_chunk(chunk, column_count, indexes)
+                    for chunk in chunks)
+        for trip_ids, departure_secs, stop_ids, issues in parsed:
+            for check, sample in issues:
+                record_issue(check, sample)
+            yield trip_ids, departure_secs, stop_ids
+
+
+def _get_stop_times_column_rows(trip_ids, departure_secs, stop_ids,
+        key_maps, record_issue):
+    '''the (trip_key, departure_time_in_sec, stop_key) rows of a column
+    chunk. Ids are mapped to keys once per distinct id; the records that
+    are malformed, have an invalid time or refer to an unknown trip or stop
+    are left out, the unknown ids passed to record_issue as
+    _replace_ids_with_keys does'''
+    trip_key_map = key_maps['Trip']
+    stop_key_map = key_maps['Stop']
+    trip_keys = Columnar.map_distinct(trip_ids, trip_key_map.get)
+    stop_keys = Columnar.map_distinct(stop_ids, lambda stop_id: None
+            if stop_id is None else stop_key_map.get(
+                _normalise_int_id(stop_id)))
+    skipped = set(Columnar.get_indexes(departure_secs, Columnar.INVALID_TIME))
+    for i in Columnar.get_indexes(trip_keys, None):
+        if i not in skipped:
+            record_issue('unknown_trip_id', trip_ids[i])
+            skipped.add(i)
+    for i in Columnar.get_indexes(stop_keys, None):
+        if i not in skipped:
+            record_issue('unknown_stop_id', stop_ids[i])
+            skipped.add(i)
+    rows = zip(trip_keys, Columnar.to_list(departure_secs), stop_keys)
+    if not skipped:
+        return list(rows)
+    return [row for i, row in enumerate(rows) if i not in skipped]
+
+
+def _process_stop_times_columns(db_connection, zip_file, key_maps,
+        batch_size=DEFAULT_BATCH_SIZE, table_name='Stop_Trip', workers=1,
+        checkpoint=None, report=None):
+    '''
+    _process_stop_times_file reading stop_times.txt as typed columns, see
+    Columnar: each COLUMNAR_CHUNK_SIZE chunk is split, its times converted
+    and its ids mapped to keys as whole columns, then inserted with one
+    executemany, batch_size is not used. With a checkpoint, each chunk is
+    committed with it.
+    '''
+    record_issue = _get_issue_recorder(report, 'stop_times.txt')
+    skip_rows = checkpoint['source_rows'] if checkpoint is not None else 0
+    sql_query = '''INSERT OR IGNORE INTO %s (trip_key, departure_time_in_sec,
+            stop_key) VALUES (?, ?, ?);''' % table_name
+    row_count = 0
+    with db_connection:
+        for columns in _read_stop_times_columns(zip_file, workers,
+                record_issue):
+            record_count = len(columns[0])
+            if skip_rows:
+                columns = [column[skip_rows:] for column in columns]
+                skip_rows -= min(skip_rows, record_count)
+            rows = _get_stop_times_column_rows(*columns, key_maps,
+                    record_issue)
+            db_connection.executemany(sql_query, rows)
+            row_count += len(rows)
+            if checkpoint is not None:
+                checkpoint['source_rows'] += len(columns[0])
+                _write_checkpoint(db_connection, checkpoint)
+                db_connection.commit()
+        if checkpoint is not None:
+            _write_checkpoint(db_connection, checkpoint, complete=True)
+    return row_count
+
+
+# GTFS file, table it is imported into and its _process_*_file function,
+# in import order. The functions share the signature
+# (db_connection, zip_file, key_maps, batch_size, table_name, workers,
+# checkpoint, report), report being the Validation.ValidationReport the
+# rows skipped are added to
+FILE_TABLES = (
+    ('routes.txt', 'Route', _process_routes_file),
+    ('trips.txt', 'Trip', _process_trips_file),
+    ('stops.txt', 'Stop', _process_stops_file),
+    ('stop_times.txt', 'Stop_Trip', _process_stop_times_file),
+    )
+# tables mapping GTFS ids to surrogate keys
+KEY_TABLES = ('Route', 'Trip', 'Stop')
+# replacing the _process_*_file function of FILE_TABLES with columnar=True
+COLUMNAR_PROCESS_FILES = {
+    'stop_times.txt': _process_stop_times_columns,
+    }
+# files whose rows refer to the ids of another file's table. When the set of
+# ids changes, they are re-imported so the references are mapped again
+DEPENDENT_FILENAMES = {
+    'routes.txt': ('trips.txt',),
+    'trips.txt': ('stop_times.txt',),
+    'stops.txt': ('stop_times.txt',),
+    }
+
+
+def _get_affected_stops_where_clause(affected_stops_only, column_name,
+        conditions=()) -> str:
+    '''WHERE clause of conditions, plus with affected_stops_only the one
+    keeping the stops listed in temp.Affected_Stop'''
+    conditions = list(conditions)
+    if affected_stops_only:
+        conditions.append('%s IN (SELECT stop_key FROM temp.Affected_Stop)'
+                % column_name)
+    return 'WHERE %s' % ' AND '.join(conditions) if conditions else ''
+
+
+def _build_stop_departure_table(db_connection, affected_stops_only=False,
+        checkpoint=None):
+    '''Stop_Trip with the route of each trip, clustered by (stop_key,
+    departure_time_in_sec) so the next departures from a stop are a range
+    scan, stop times without times left out. With affected_stops_only, only
+    rebuilds the rows of the stops listed in temp.Affected_Stop. The
+    checkpoint is marked complete in the same transaction. returns the
+    number of rows inserted'''
+    with db_connection:
+        _complete_checkpoint(db_connection, checkpoint)
+        if affected_stops_only:
+            db_connection.execute('DELETE FROM Stop_Departure %s;'
+                    % _get_affected_stops_where_clause(True, 'stop_key'))
+        row_count = db_connection.execute('''
+                INSERT INTO Stop_Departure (stop_key, departure_time_in_sec,
+                    trip_key, route_key)
+                SELECT Stop_Trip.stop_key, Stop_Trip.departure_time_in_sec,
+                    Stop_Trip.trip_key, Trip.route_key
+                FROM Stop_Trip
+                JOIN Trip ON Trip.key = Stop_Trip.trip_key
+                %s;
+                ''' % _get_affected_stops_where_clause(affected_stops_only,
+                    'Stop_Trip.stop_key', ('Stop_Trip.departure_time_in_sec'
+                        ' != %d' % UNTIMED_SEC,))).rowcount
+    return row_count
+
+
+def _build_stop_route_summary_table(db_connection, affected_stops_only=False,
+        checkpoint=None):
+    '''one row per (stop, route) with the earliest and latest departure,
+    aggregated from Stop_Departure so a stop report needs no aggregation at
+    query time. routes serving a stop only with untimed stop times get a
+    row with NULL departures, found with a seek per trip on the Stop_Trip
+    primary key (CROSS JOIN keeps Trip as the outer loop). With
+    affected_stops_only, only rebuilds the rows of the stops listed in
+    temp.Affected_Stop. The checkpoint is marked complete in the same
+    transaction. returns the number of rows inserted'''
+    where_clause = _get_affected_stops_where_clause(affected_stops_only,
+            'stop_key')
+    with db_connection:
+        _complete_checkpoint(db_connection, checkpoint)
+        if affected_stops_only:
+            db_connection.execute('DELETE FROM Stop_Route_Summary %s;'
+                    % where_clause)
+        row_count = db_connection.execute('''
+                INSERT INTO Stop_Route_Summary (stop_key, route_key,
+                    earliest_sec, latest_sec)
+                SELECT stop_key, route_key, min(departure_time_in_sec),
+                    max(departure_time_in_sec)
+                FROM Stop_Departure
+                %s
+                GROUP BY stop_key, route_key;
+                ''' % where_clause).rowcount
+        row_count += db_connection.execute('''
+                INSERT OR IGNORE INTO Stop_Route_Summary (stop_key, route_key)
+                SELECT DISTINCT Stop_Trip.stop_key, Trip.route_key
+                FROM Trip
+                CROSS JOIN Stop_Trip ON Stop_Trip.trip_key = Trip.key
+                AND Stop_Trip.departure_time_in_sec = %d
+                %s;
+                ''' % (UNTIMED_SEC, _get_affected_stops_where_clause(
+                    affected_stops_only, 'Stop_Trip.stop_key'))).rowcount
+    return row_count
+
+
+def _build_stop_location_table(db_connection, checkpoint=None):
+    '''(re)fills the Stop_Location R*Tree from the coordinates in Stop, in
+    one transaction with the checkpoint marked complete. returns the number
+    of rows inserted'''
+    with db_connection:
+        _complete_checkpoint(db_connection, checkpoint)
+        db_connection.execute('DELETE FROM Stop_Location;')
+        row_count = db_connection.execute('''
+                INSERT INTO Stop_Location (stop_key, min_lat, max_lat,
+                    min_lon, max_lon)
+                SELECT key, lat, lat, lon, lon
+                FROM Stop
+                WHERE lat IS NOT NULL AND lon IS NOT NULL;''').rowcount
+    return row_count
+
+
+def _build_indexes(db_connection, checkpoint=None):
+    '''creates INDEXES and runs ANALYZE, in one transaction with the
+    checkpoint marked complete'''
+    with db_connection:
+        _complete_checkpoint(db_connection, checkpoint)
+        for sql_query in INDEXES:
+            db_connection.execute(sql_query)
+        db_connection.execute('ANALYZE;')
+
+
+def _hash_archive_members(zip_path) -> dict:
+    '''returns dict: {filename : sha256 hex digest , ... } for the required
+    GTFS files, streamed from the archive'''
+    file_hashes = {}
+    with zipfile.ZipFile(zip_path) as zip_file:
+        for filename in REQUIRED_GFTS_FILENAMES_SET:
+            sha256 = hashlib.sha256()
+            with zip_file.open(filename) as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    sha256.update(block)
+            file_hashes[filename] = sha256.hexdigest()
+    return file_hashes
+
+
+def _read_feed_file_hashes(sqlite_database_path):
+    '''returns the hashes stored by the import that built the database, or
+    None if there is no database or its schema is not SCHEMA_VERSION'''
+    if not os.path.exists(sqlite_database_path):
+        return None
+    db_connection = sqlite3.connect(sqlite_database_path)
+    try:
+        if db_connection.execute('PRAGMA user_version;').fetchone()[0] \
+                != SCHEMA_VERSION:
+            return None
+        return dict(db_connection.execute(
+                'SELECT filename, sha256 FROM Feed_File;').fetchall())
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        db_connection.close()
+
+
+def _write_feed_file_hashes(db_connection, file_hashes):
+    with db_connection:
+        db_connection.execute('DELETE FROM Feed_File;')
+        db_connection.executemany('''INSERT INTO Feed_File (filename, sha256)
+                VALUES (?, ?);''', file_hashes.items())
+
+
+def _create_checkpoint_table(db_connection):
+    '''Import_Checkpoint records the progress of a full import in its side
+    file, one row per phase: the records of the phase's file loaded so
+    far and whether the phase is complete. It is dropped once the import
+    is'''
+    with db_connection:
+        db_connection.execute('''CREATE TABLE IF NOT EXISTS Import_Checkpoint
+                (phase TEXT PRIMARY KEY,
+                source_rows INTEGER NOT NULL,
+                complete INTEGER NOT NULL);''')
+
+
+def _read_checkpoints(db_connection, phase_names) -> dict:
+    '''returns dict: {phase_name : {'phase', 'source_rows', 'complete'} , ...}
+    for phase_names, new phases start at 0 rows'''
+    checkpoints = {phase: {'phase': phase, 'source_rows': source_rows,
+                           'complete': bool(complete)}
+                   for phase, source_rows, complete in db_connection.execute(
+                       '''SELECT phase, source_rows, complete
+                       FROM Import_Checkpoint;''')}
+    return {phase: checkpoints.get(phase, {'phase': phase, 'source_rows': 0,
+                'complete': False})
+            for phase in phase_names}
+
+
+def _write_checkpoint(db_connection, checkpoint, complete=False):
+    '''runs in the caller's transaction, committed with the rows it covers'''
+    checkpoint['complete'] = complete
+    db_connection.execute('''INSERT OR REPLACE INTO Import_Checkpoint
+            (phase, source_rows, complete) VALUES (?, ?, ?);''',
+            (checkpoint['phase'], checkpoint['source_rows'], complete))
+
+
+def _complete_checkpoint(db_connection, checkpoint):
+    '''written first in a phase's transaction: the INSERT opens the
+    transaction, so the statements that follow, DDL included, commit with
+    it'''
+    if checkpoint is not None:
+        _write_checkpoint(db_connection, checkpoint, complete=True)
+
+
+def _open_resumable_database(building_path, file_hashes):
+    '''returns a connection to the side file of an interrupted full import of
+    the same archive, None if there is none to resume'''
+    if not os.path.exists(building_path):
+        return None
+    db_connection = sqlite3.connect(building_path)
+    try:
+        if (db_connection.execute('PRAGMA user_version;').fetchone()[0]
+                    == SCHEMA_VERSION
+                and db_connection.execute('PRAGMA quick_check;').fetchone()[0]
+                    == 'ok'
+                and db_connection.execute('''SELECT name FROM sqlite_master
+                    WHERE name = 'Import_Checkpoint';''').fetchone()
+                and dict(db_connection.execute(
+                    'SELECT filename, sha256 FROM Feed_File;').fetchall())
+                    == file_hashes):
+            return db_connection
+    except sqlite3.DatabaseError:
+        pass
+    db_connection.close()
+    return None
+
+
+def _remove_database(path):
+    '''removes the database at path with any journal left next to it, which
+    SQLite would otherwise apply to a new database created at path'''
+    for suffix in ('',) + JOURNAL_SUFFIXES:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def remove_database(sqlite_database_path):
+    '''removes the database published at sqlite_database_path: the symlink
+    or file at the path, every generation and the side file of an
+    interrupted import, with their journals'''
+    for path in (sqlite_database_path, sqlite_database_path + LINK_SUFFIX):
+        if os.path.islink(path):
+            os.remove(path)
+    for _, path in get_generations(sqlite_database_path):
+        _remove_database(path)
+    _remove_database(sqlite_database_path)
+    _remove_database(sqlite_database_path + BUILDING_SUFFIX)
+
+
+def get_generations(sqlite_database_path) -> list:
+    '''[(number, path)] of the generations published at
+    sqlite_database_path, oldest first'''
+    directory, basename = os.path.split(os.path.abspath(sqlite_database_path))
+    prefix = basename + GENERATION_SUFFIX
+    return sorted((int(filename[len(prefix):]),
+                    os.path.join(directory, filename))
+            for filename in os.listdir(directory)
+            if filename.startswith(prefix) and filename[len(prefix):].isdigit())
+
+
+def _create_link(target_path, link_path) -> bool:
+    '''symlinks link_path to the basename of target_path, replacing any
+    link_path left by an interrupted import. returns False if symlinks
+    cannot be created here'''
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    try:
+        os.symlink(os.path.basename(target_path), link_path)
+    except (OSError, NotImplementedError):
+        return False
+    return True
+
+
+def _publish_generation(building_path, sqlite_database_path) -> str:
+    '''
+    Renames the complete database at building_path to a new generation file,
+    in WAL mode, then makes sqlite_database_path a symlink to it with a
+    rename, which is atomic: readers opening sqlite_database_path get either
+    generation, and those with it open keep reading theirs. The generations
+    before the last KEEP_GENERATIONS are removed.
+    Where symlinks cannot be created, the database is instead renamed over
+    sqlite_database_path in UNLINKED_JOURNAL_MODE, which fails on Windows
+    while a reader has the previous database open.
+    returns the path of the new generation
+    '''
+    generations = get_generations(sqlite_database_path)
+    number = generations[-1][0] + 1 if generations else 1
+    generation_path = '%s%s%d' % (sqlite_database_path, GENERATION_SUFFIX,
+            number)
+    # the previous database is the last generation, or a file at the path
+    # which then counts as one and makes the generations all older
+    kept_generations = KEEP_GENERATIONS - (1
+            if os.path.islink(sqlite_database_path) else 2)
+    link_path = sqlite_database_path + LINK_SUFFIX
+    linked = _create_link(generation_path, link_path)
+    db_connection = sqlite3.connect(building_path)
+    try:
+        db_connection.execute('PRAGMA journal_mode = %s;'
+                % (PUBLISHED_JOURNAL_MODE if linked
+                    else UNLINKED_JOURNAL_MODE))
+    finally:
+        db_connection.close()
+    if linked:
+        os.replace(building_path, generation_path)
+        os.replace(link_path, sqlite_database_path)
+    else:
+        generation_path = sqlite_database_path
+        os.replace(building_path, generation_path)
+    for _, path in generations[:max(0, len(generations) - kept_generations)]:
+        _remove_database(path)
+    return generation_path
+
+
+def _create_table_like(db_connection, table_name, new_table_name):
+    '''creates new_table_name with the definition of table_name, keys and
+    constraints included'''
+    sql_query = db_connection.execute('''SELECT sql FROM sqlite_master
+            WHERE type = 'table' AND name = ?;''', (table_name,)).fetchone()[0]
+    db_connection.execute(sql_query.replace('CREATE TABLE %s' % table_name,
+            'CREATE TABLE %s' % new_table_name, 1))
+
+
+def _get_phase_name(filename) -> str:
+    return os.path.splitext(filename)[0]
+
+
+def _get_process_file(filename, process_file, columnar):
+    if columnar:
+        return COLUMNAR_PROCESS_FILES.get(filename, process_file)
+    return process_file
+
+
+def _check_integrity(db_connection, report, instrumentation):
+    with instrumentation.phase('integrity'):
+        check_unused_rows(db_connection, report)
+
+
+def _import_all_files(db_connection, zip_file, batch_size, workers,
+        instrumentation, report, columnar):
+    '''
+    Every batch commits with the checkpoint of its phase in
+    Import_Checkpoint. On a side file left by an interrupted import, the
+    complete phases are skipped and the file of the interrupted one is read
+    from the first record no committed batch covers; the rows loaded
+    before keep their surrogate keys, so the result is the same as an
+    uninterrupted import's. report then holds the issues of the phases run.
+    '''
+    _create_checkpoint_table(db_connection)
+    file_phase_names = [_get_phase_name(filename)
+            for filename, _, _ in FILE_TABLES]
+    checkpoints = _read_checkpoints(db_connection, file_phase_names
+            + ['stop_departures', 'stop_route_summary', 'stop_locations',
+                'indexes'])
+    key_maps = _read_key_maps(db_connection)
+    for (filename, table_name, process_file), phase_name in zip(FILE_TABLES,
+            file_phase_names):
+        checkpoint = checkpoints[phase_name]
+        if checkpoint['complete']:
+            continue
+        if checkpoint['source_rows']:
+            print('Resuming %s after %d rows.' % (filename,
+                    checkpoint['source_rows']))
+        process_file = _get_process_file(filename, process_file, columnar)
+        with instrumentation.phase(phase_name) as phase:
+            phase['rows'] = process_file(db_connection, zip_file, key_maps,
+                    batch_size, table_name, workers, checkpoint, report)
+    for phase_name, build_table in (
+            ('stop_departures', _build_stop_departure_table),
+            ('stop_route_summary', _build_stop_route_summary_table),
+            ('stop_locations', _build_stop_location_table)):
+        if not checkpoints[phase_name]['complete']:
+            with instrumentation.phase(phase_name) as phase:
+                phase['rows'] = build_table(db_connection,
+                        checkpoint=checkpoints[phase_name])
+    if not checkpoints['indexes']['complete']:
+        with instrumentation.phase('indexes'):
+            _build_indexes(db_connection, checkpoints['indexes'])
+    _check_integrity(db_connection, report, instrumentation)
+    with db_connection:
+        db_connection.execute('DROP TABLE Import_Checkpoint;')
+
+
+def _reimport_changed_files(db_connection, zip_file, changed_filenames,
+        batch_size, workers, instrumentation, report, columnar) -> list:
+    '''
+    Each changed file is loaded into a <table>_Incoming side table, the rows
+    that differ from the current table are kept in temp.Changed_<table> and
+    the table contents are replaced. Surrogate keys of unchanged ids are
+    kept, when a file adds or removes ids the files in DEPENDENT_FILENAMES
+    referring to them are re-imported too.
+    Stop_Departure and Stop_Route_Summary are then rebuilt only for the
+    stops served by a changed stop_time or a changed trip, Stop_Location
+    if stops.txt was re-imported. report holds the issues of the files
+    re-imported, and the unused rows of the whole database.
+    returns the filenames re-imported
+    '''
+    changed_filenames = set(changed_filenames)
+    key_maps = _read_key_maps(db_connection)
+    with db_connection:
+        for filename, table_name, process_file in FILE_TABLES:
+            db_connection.execute('''CREATE TEMP TABLE Changed_%s
+                    AS SELECT * FROM main.%s WHERE 0;'''
+                    % (table_name, table_name))
+        db_connection.execute('''CREATE TEMP TABLE Affected_Stop
+                (stop_key INTEGER PRIMARY KEY);''')
+    reimported_filenames = []
+    for filename, table_name, process_file in FILE_TABLES:
+        if filename not in changed_filenames:
+            continue
+        reimported_filenames.append(filename)
+        incoming = table_name + '_Incoming'
+        with db_connection:
+            db_connection.execute('DROP TABLE IF EXISTS %s;' % incoming)
+            _create_table_like(db_connection, table_name, incoming)
+        previous_ids = set(key_maps.get(table_name, ()))
+        process_file = _get_process_file(filename, process_file, columnar)
+        with instrumentation.phase(_get_phase_name(filename)) as phase:
+            phase['rows'] = process_file(db_connection, zip_file, key_maps,
+                    batch_size, incoming, workers, report=report)
+        if table_name in key_maps and previous_ids != set(key_maps[table_name]):
+            changed_filenames.update(DEPENDENT_FILENAMES.get(filename, ()))
+        with db_connection:
+            db_connection.execute('''INSERT INTO temp.Changed_%s
+                    SELECT * FROM (SELECT * FROM %s EXCEPT SELECT * FROM %s)
+                    UNION ALL
+                    SELECT * FROM (SELECT * FROM %s EXCEPT SELECT * FROM %s);
+                    ''' % (table_name, table_name, incoming, incoming,
+                        table_name))
+            db_connection.execute('DELETE FROM %s;' % table_name)
+            db_connection.execute('INSERT INTO %s SELECT * FROM %s;'
+                    % (table_name, incoming))
+            db_connection.execute('DROP TABLE %s;' % incoming)
+    with db_connection:
+        db_connection.execute('''INSERT OR IGNORE INTO temp.Affected_Stop
+                SELECT stop_key FROM temp.Changed_Stop_Trip;''')
+        db_connection.execute('''INSERT OR IGNORE INTO temp.Affected_Stop
+                SELECT stop_key FROM Stop_Trip
+                WHERE trip_key IN (SELECT key FROM temp.Changed_Trip);''')
+    with instrumentation.phase('stop_departures') as phase:
+        phase['rows'] = _build_stop_departure_table(db_connection,
+                affected_stops_only=True)
+    with instrumentation.phase('stop_route_summary') as phase:
+        phase['rows'] = _build_stop_route_summary_table(db_connection,
+                affected_stops_only=True)
+    if 'stops.txt' in reimported_filenames:
+        with instrumentation.phase('stop_locations') as phase:
+            phase['rows'] = _build_stop_location_table(db_connection)
+    with instrumentation.phase('analyze'):
+        db_connection.execute('ANALYZE;')
+    _check_integrity(db_connection, report, instrumentation)
+    return reimported_filenames
+
+
+def import_into_database(archive_path, sqlite_database_path,
+        batch_size=DEFAULT_BATCH_SIZE, incremental=False, workers=1,
+        instrumentation=None, resume=False, validation_report=None,
+        columnar=False) -> list:
+    '''
+    The database is built in a side file, then published as a new
+    generation which sqlite_database_path atomically links to, see
+    _publish_generation. Readers never see a partially built database and
+    the import never waits on them.
+    With incremental=True and a database from a previous import, only the
+    tables whose source files changed are re-imported.
+    A full import checkpoints every batch in its side file. With
+    resume=True and the side file of a full import of the same archive that
+    failed or was killed, that import continues from its last checkpoint,
+    whether incremental is set or not.
+    With workers > 1, files are parsed by that many processes while this
+    process writes to the database. With columnar=True, stop_times.txt is
+    read as typed columns, see _process_stop_times_columns; the result is
+    the same.
+    Each phase is recorded by instrumentation, an
+    Instrumentation.Instrumentation. By default the phases are printed.
+    Rows that cannot be imported, references to unknown ids included, are
+    skipped and the issues found counted in validation_report, a
+    Validation.ValidationReport, whose summary is printed.
+    returns the list of filenames imported
+    '''
+    if instrumentation is None:
+        instrumentation = Instrumentation([print_phase])
+    if validation_report is None:
+        validation_report = ValidationReport()
+    with instrumentation.phase('extract') as phase:
+        _verify_zip_contains_required_GTFS_filenames(archive_path)
+        file_hashes = _hash_archive_members(archive_path)
+        phase['rows'] = len(file_hashes)
+    building_path = sqlite_database_path + BUILDING_SUFFIX
+    db_connection = None
+    if resume:
+        db_connection = _open_resumable_database(building_path, file_hashes)
+        if db_connection is None:
+            print('No interrupted import of %s to resume.' % archive_path)
+    previous_hashes = None
+    if incremental and db_connection is None:
+        previous_hashes = _read_feed_file_hashes(sqlite_database_path)
+
+    changed_filenames = [filename for filename, _, _ in FILE_TABLES]
+    if db_connection is None:
+        _remove_database(building_path)
+    if previous_hashes is not None:
+        changed_filenames = [filename for filename in changed_filenames
+                if file_hashes[filename] != previous_hashes.get(filename)]
+        if not changed_filenames:
+            print('No changes.')
+            return []
+        shutil.copyfile(sqlite_database_path, building_path)
+        db_connection = sqlite3.connect(building_path)
+    elif db_connection is None:
+        db_connection = _create_sqlite_db(building_path)
+        _write_feed_file_hashes(db_connection, file_hashes)
+    previous_pragmas = _set_pragmas(db_connection, IMPORT_PRAGMAS
+            if previous_hashes is not None else IMPORT_CHECKPOINTED_PRAGMAS)
+    try:
+        with zipfile.ZipFile(archive_path) as zip_file:
+            if previous_hashes is None:
+                _import_all_files(db_connection, zip_file, batch_size,
+                        workers, instrumentation, validation_report,
+                        columnar)
+            else:
+                changed_filenames = _reimport_changed_files(db_connection,
+                        zip_file, changed_filenames, batch_size, workers,
+                        instrumentation, validation_report, columnar)
+        _write_feed_file_hashes(db_connection, file_hashes)
+    finally:
+        _set_pragmas(db_connection, previous_pragmas)
+        db_connection.close()
+    _publish_generation(building_path, sqlite_database_path)
+    print_summary(validation_report)
     print('Done.')
-    if os.path.exists(TEMP_DIR):
-        rmtree(TEMP_DIR) 
+    return changed_filenames
@@ -0,0 +1,44 @@
+import json
+
+from sys                        import argv
+
+from GTFSProcessor              import Benchmark
+
+EXACT_ARGS_NUM = 2
+SIZES_OPTION = '--sizes='
+USAGE_STR = '''Usage:
+            benchmark.py [output-json-path] [--sizes=small,medium,large]
+            Sizes default to %s, see Benchmark.FEED_SIZES.''' \
+        % ','.join(Benchmark.DEFAULT_SIZES)
+
+if __name__ == '__main__':
+    sizes = Benchmark.DEFAULT_SIZES
+    args = []
+    for arg in argv:
+        if arg.startswith(SIZES_OPTION):
+            sizes = arg[len(SIZES_OPTION):].split(',')
+        else:
+            args.append(arg)
+    if len(args) != EXACT_ARGS_NUM:
+        print("Invalid arguments. %s" % USAGE_STR)
+        exit()
+    unknown_sizes = [size for size in sizes
+            if size not in Benchmark.FEED_SIZES]
+    if unknown_sizes:
+        print("Unknown sizes %s. %s" % (', '.join(unknown_sizes), USAGE_STR))
+        exit()
+    results = Benchmark.run_benchmarks(sizes)
+    with open(args[1], 'w') as f:
+        json.dump(results, f, indent=2)
+    for result in results['results']:
+        print('%s: %d stop_times imported in %.2fs, stop report p50 %.0fus'
+                % (result['size'], result['feed']['stop_times'],
+                    result['import']['total_sec'],
+                    result['queries']['sqlite']['get_stop_report']['p50_us']))
+        pool_result = result['concurrency']['pool']['get_stop_report']
+        threads = max(pool_result)
+        print('    %d threads: %.0f stop reports/sec (x%.2f), %d errors while '
+                'an import went live' % (threads,
+                    pool_result[threads]['queries_per_sec'],
+                    pool_result[threads]['speedup'],
+                    result['concurrency']['import_under_load']['errors']))
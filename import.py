@@ -1,31 +1,123 @@
-from os.path                            import exists
+import json
+
+from os.path                            import exists, isdir
 from sys                                import argv
 from GTFSProcessor                      import ZIPImporter
+from GTFSProcessor                      import Snapshot
+from GTFSProcessor                      import MultiFeed
+from GTFSProcessor.Instrumentation      import Instrumentation, print_phase
+from GTFSProcessor.Validation           import ValidationReport
 
 
-EXACT_ARGS_NUM = 3
-USAGE_STR = '''Usage: 
-            import.py [input-data-path] [database-Path]'''
+MIN_ARGS_NUM = 3
+INCREMENTAL_OPTION = '--incremental'
+SNAPSHOT_OPTION = '--snapshot'
+RESUME_OPTION = '--resume'
+COLUMNAR_OPTION = '--columnar'
+WORKERS_OPTION = '--workers='
+REPORT_OPTION = '--report='
+VALIDATION_REPORT_OPTION = '--validation-report='
+USAGE_STR = '''Usage:
+            import.py [input-data-path] [database-Path] [--incremental]
+                    [--workers=N] [--report=PATH] [--validation-report=PATH]
+                    [--snapshot] [--resume] [--columnar]
+            import.py [input-data-path] [input-data-path]... [database-dir]
+                    [options as above]
+            (each feed in its own process, into [database-dir]/[archive
+            name without .zip].sqlite)
+            --incremental : only re-import the files that changed since the
+                            import that built the database
+            --workers=N   : parse the files with N processes (default 1)
+            --report=PATH : write the per phase timings, rows/sec & process
+                            peak memory as JSON
+            --validation-report=PATH : write the issues found in the feed
+                            (rows skipped, unknown ids, unused rows) as
+                            JSON, per feed name with several archives
+            --resume      : continue the import of the same archive that
+                            failed or was killed from its last checkpoint
+            --columnar    : parse stop_times.txt a chunk at a time into
+                            columns, faster with NumPy installed
+            --snapshot    : then export the memory-mapped snapshot served by
+                            the 'snapshot' Routes backend, written to
+                            [database-Path]%s''' % Snapshot.SNAPSHOT_SUFFIX
 
 if __name__ == '__main__':
-    if len(argv) != EXACT_ARGS_NUM:
-        print("Invalid arguments. %s" % USAGE_STR)
+    incremental = INCREMENTAL_OPTION in argv[1:]
+    snapshot = SNAPSHOT_OPTION in argv[1:]
+    resume = RESUME_OPTION in argv[1:]
+    columnar = COLUMNAR_OPTION in argv[1:]
+    workers = 1
+    report_path = None
+    validation_report_path = None
+    args = []
+    for arg in argv:
+        if arg.startswith(WORKERS_OPTION):
+            workers = arg[len(WORKERS_OPTION):]
+        elif arg.startswith(REPORT_OPTION):
+            report_path = arg[len(REPORT_OPTION):]
+        elif arg.startswith(VALIDATION_REPORT_OPTION):
+            validation_report_path = arg[len(VALIDATION_REPORT_OPTION):]
+        elif arg not in (INCREMENTAL_OPTION, SNAPSHOT_OPTION, RESUME_OPTION,
+                COLUMNAR_OPTION):
+            args.append(arg)
+    if not str(workers).isdigit() or int(workers) < 1:
+        print("--workers must be a positive integer. %s" % USAGE_STR)
         exit()
-    if not argv[1].endswith('.zip'):
-        print("1st Argument must be a .zip archive. %s" % USAGE_STR)
+    workers = int(workers)
+    if len(args) < MIN_ARGS_NUM:
+        print("Invalid arguments. %s" % USAGE_STR)
         exit()
-    if not exists(argv[1]):
-        print("Archive %s not found." % argv[1])
+    archive_paths = args[1:-1]
+    for archive_path in archive_paths:
+        if not archive_path.endswith('.zip'):
+            print("Input data must be .zip archives. %s" % USAGE_STR)
+            exit()
+        if not exists(archive_path):
+            print("Archive %s not found." % archive_path)
+            exit()
+    if len(archive_paths) == 1:
+        db_filepaths = [args[-1]]
+    elif exists(args[-1]) and not isdir(args[-1]):
+        print("%s is not a directory. %s" % (args[-1], USAGE_STR))
         exit()
-    if exists(argv[2]):
+    else:
+        db_filepaths = [MultiFeed.get_feed_database_path(archive_path,
+                args[-1]) for archive_path in archive_paths]
+    existing = [db_filepath for db_filepath in db_filepaths
+            if exists(db_filepath)]
+    if existing and not incremental and not resume:
         while True:
             in_ = input("Database %s already exists, overwrite?(y/n)"
-                % argv[2]).lower()
+                % ', '.join(existing)).lower()
             if in_ == 'n':
                 print('Aborting.')
                 exit()
             elif in_ == 'y':
                 break
-                
-    ZIPImporter.import_into_database(argv[1],argv[2])
-    
+
+    instrumentation = Instrumentation([print_phase])
+    if len(archive_paths) == 1:
+        validation_report = ValidationReport()
+        ZIPImporter.import_into_database(archive_paths[0], db_filepaths[0],
+                incremental=incremental, workers=workers,
+                instrumentation=instrumentation, resume=resume,
+                validation_report=validation_report, columnar=columnar)
+        validation_reports = validation_report.report()
+    else:
+        validation_reports = {}
+        MultiFeed.import_feeds(archive_paths, args[-1],
+                instrumentation=instrumentation, incremental=incremental,
+                workers=workers, resume=resume, columnar=columnar,
+                validation_reports=validation_reports)
+    if snapshot:
+        for db_filepath in db_filepaths:
+            with instrumentation.phase('snapshot'):
+                size = Snapshot.export_snapshot(db_filepath)
+            print('Snapshot written to %s%s (%.1f MB).' % (db_filepath,
+                    Snapshot.SNAPSHOT_SUFFIX, size / 1e6))
+    if report_path:
+        with open(report_path, 'w') as f:
+            f.write(instrumentation.to_json(indent=2))
+    if validation_report_path:
+        with open(validation_report_path, 'w') as f:
+            json.dump(validation_reports, f, indent=2)
@@ -1,43 +1,232 @@
-from os.path                    import exists
-from sys                        import argv
+import csv
+import sys
+import json
+import time
 
-from GTFSProcessor              import Routes   
+from os.path                    import exists, isdir
+from sys                        import argv, stdin
+
+from GTFSProcessor              import Routes
+from GTFSProcessor              import MultiFeed
 
 EXACT_ARGS_NUM = 3
-USAGE_STR = '''Usage: 
-            routes_at_stop.py [database-Path] [stop_id]'''
+STOPS_FROM_ARGS_NUM = 4
+STOPS_FROM_OPTION = '--stops-from'
+# valued options of the next departures mode
+NEXT_OPTIONS = ('--next', '--after', '--route')
+FORMAT_OPTION = '--format'
+FORMATS = ('text', 'json', 'csv')
+# one csv row per route of a stop, or a single row without route for a stop
+# with no routes or not found. The feed column is added when querying a
+# directory of feed databases
+STOP_REPORT_CSV_COLUMNS = ('stop_id', 'found', 'stop_name', 'route_id',
+        'short_name', 'long_name', 'earliest', 'latest')
+DEPARTURE_CSV_COLUMNS = ('stop_id', 'departure', 'departure_sec',
+        'day_offset', 'wait_sec', 'route_id', 'short_name', 'long_name',
+        'trip_id')
+USAGE_STR = '''Usage:
+            routes_at_stop.py [database-Path] [stop_id]
+            routes_at_stop.py [database-Path] --stops-from [stop_ids-file-path]
+            (one stop_id per line, pass - as the path to read from stdin)
+            routes_at_stop.py [database-Path] [stop_id] --next=N
+                    [--after=HH:MM[:SS]] [--route=route_id]
+            (the next N departures, after the current local time by default)
+            Pass a directory of feed databases built by import.py from
+            several archives as [database-Path] to query every feed, with
+            --route=[feed name]:[route_id]
+            --format=text|json|csv : text by default. json writes one object
+            per stop report or departure per line, csv one row per route of
+            a stop or per departure after a header row. Each is written as
+            soon as it is resolved'''
+
+
+def _parse_valued_options(args) -> tuple:
+    '''returns (remaining args, {option : value}) for NEXT_OPTIONS and
+    FORMAT_OPTION, options absent from args are left out'''
+    remaining = []
+    options = {}
+    for arg in args:
+        name, separator, value = arg.partition('=')
+        if separator and (name in NEXT_OPTIONS or name == FORMAT_OPTION):
+            options[name] = value
+        else:
+            remaining.append(arg)
+    return remaining, options
+
+
+def _read_stop_ids(f):
+    for line in f:
+        stop_id = line.strip()
+        if stop_id:
+            yield stop_id
+
+
+def _get_feed_prefix(row) -> str:
+    '''row is a route or departure dict, which has a feed when querying a
+    directory of feed databases'''
+    return '[%s] ' % row['feed'] if 'feed' in row else ''
+
+
+def _print_stop_report(stop_id, stop_report):
+    if stop_report:
+        print('Stop ID : %s' % stop_report['stop_id'])
+        print('Stop Name : %s' % stop_report['stop_name'])
+        if len(stop_report['routes']) == 0:
+            print('No routes found stopping at ID %s' % stop_id)
+        else:
+            print('Routes Stopping:')
+            for route in stop_report['routes']:
+                print("%s%s - %s (earliest %s; latest %s)" % (
+                    _get_feed_prefix(route), route['short_name'],
+                    route['long_name'],
+                    route['earliest'], route['latest']))
+    else:
+        print('Stop %s not found in database.' % stop_id)
+
+
+def _print_next_departures(stop_id, departures):
+    if not departures:
+        print('No departures found from stop ID %s' % stop_id)
+    for departure in departures:
+        print("%s (in %d min) %s%s - %s, trip %s" % (departure['departure'],
+            departure['wait_sec'] // 60, _get_feed_prefix(departure),
+            departure['short_name'],
+            departure['long_name'], departure['trip_id']))
+
+
+def _write_json_stop_report(stop_id, stop_report):
+    '''one line, the report with found: true or the stop_id with found:
+    false'''
+    record = dict(stop_report, found=True) if stop_report else {
+            'stop_id': stop_id, 'found': False}
+    print(json.dumps(record))
+
+
+def _write_json_next_departures(stop_id, departures):
+    for departure in departures:
+        print(json.dumps(dict(departure, stop_id=stop_id)))
+
+
+def _get_csv_writer(columns, multi_feed) -> csv.DictWriter:
+    '''writes the header of columns, plus feed with multi_feed, to stdout.
+    Row keys that are not columns are left out'''
+    writer = csv.DictWriter(sys.stdout, columns + ('feed',) if multi_feed
+            else columns, extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    return writer
+
+
+def _write_csv_stop_report(writer, stop_id, stop_report):
+    if not stop_report:
+        writer.writerow({'stop_id': stop_id, 'found': False})
+        return
+    stop = {'stop_id': stop_report['stop_id'], 'found': True,
+            'stop_name': stop_report['stop_name']}
+    if not stop_report['routes']:
+        writer.writerow(stop)
+    for route in stop_report['routes']:
+        writer.writerow(dict(stop, **route))
+
+
+def _write_csv_next_departures(writer, stop_id, departures):
+    for departure in departures:
+        writer.writerow(dict(departure, stop_id=stop_id))
+
+
+def _get_stop_report_writer(output_format, multi_feed):
+    '''returns write(stop_id, stop_report) writing output_format to stdout,
+    the csv header is written first'''
+    if output_format == 'json':
+        return _write_json_stop_report
+    if output_format == 'csv':
+        writer = _get_csv_writer(STOP_REPORT_CSV_COLUMNS, multi_feed)
+        return lambda stop_id, stop_report: _write_csv_stop_report(writer,
+                stop_id, stop_report)
+    return _print_stop_report
+
+
+def _get_next_departures_writer(output_format, multi_feed):
+    '''returns write(stop_id, departures) writing output_format to stdout,
+    the csv header is written first'''
+    if output_format == 'json':
+        return _write_json_next_departures
+    if output_format == 'csv':
+        writer = _get_csv_writer(DEPARTURE_CSV_COLUMNS, multi_feed)
+        return lambda stop_id, departures: _write_csv_next_departures(writer,
+                stop_id, departures)
+    return _print_next_departures
+
 
 if __name__ == '__main__':
-    if len(argv) != EXACT_ARGS_NUM:
-        print("Invalid arguments. %s" % USAGE_STR)
+    args, options = _parse_valued_options(argv)
+    output_format = options.pop(FORMAT_OPTION, 'text')
+    next_options = options
+    if output_format not in FORMATS:
+        print("--format must be one of %s. %s" % ('|'.join(FORMATS),
+                USAGE_STR))
         exit()
-    if not argv[1].endswith('.sqlite'):
-        print("1st Argument must be a .sqlite database. %s" 
-                % USAGE_STR)
+    if (len(args) == STOPS_FROM_ARGS_NUM and args[2] == STOPS_FROM_OPTION
+            and not next_options):
+        stops_from = args[3]
+    elif len(args) == EXACT_ARGS_NUM and args[2] != STOPS_FROM_OPTION:
+        stops_from = None
+    else:
+        print("Invalid arguments. %s" % USAGE_STR)
         exit()
-    if not exists(argv[1]):
-        print("Database %s not found." % argv[1])
+    if next_options and '--next' not in next_options:
+        print("--after and --route require --next. %s" % USAGE_STR)
         exit()
-    if Routes.check_if_stop_exists(argv[1],argv[2]):
-        route_set = Routes.get_route_ids_passing_through_stop(argv[1], argv[2])
-        print('Stop ID : %s' % argv[0])
-        stop_name = Routes.get_stop_name(argv[1], argv[2])
-        print('Stop Name : %s' % argv[0])
-        if len(route_set) == 0:
-            print('No routes found stopping at ID %d' % argv[2])
-        else:
-            print('Routes Stopping:')
-            for route_id in route_set:
-                route_short_name = Routes.get_route_short_name(
-                        argv[1], route_id)
-                route_long_name = Routes.get_route_long_name(
-                        argv[1], route_id)
-                earliest_dep = Routes.get_earliest_service_for_stop_on_trip(
-                        argv[1], route_id, argv[2])
-                latest_dep = Routes.get_latest_service_for_stop_on_trip(
-                        argv[1], route_id, argv[2])
-                print("%s - %s (earliest %s; latest %s)" % (route_short_name,
-                    route_long_name, earliest_dep, latest_dep))
+    route_id = next_options.get('--route')
+    multi_feed = isdir(args[1])
+    if multi_feed:
+        db_filepaths = MultiFeed.get_feed_databases(args[1])
+        if not db_filepaths:
+            print("No feed databases found in %s." % args[1])
+            exit()
+        if route_id is not None:
+            feed_name, separator, route_id = route_id.partition(':')
+            if not separator:
+                print("--route must be [feed name]:[route_id]. %s"
+                        % USAGE_STR)
+                exit()
+            route_id = (feed_name, route_id)
+        session = MultiFeed.MultiFeedSession.from_databases(db_filepaths)
     else:
-        print('Stop %s not found in database.' % argv[2])
-
+        if not args[1].endswith('.sqlite'):
+            print("1st Argument must be a .sqlite database. %s"
+                    % USAGE_STR)
+            exit()
+        if not exists(args[1]):
+            print("Database %s not found." % args[1])
+            exit()
+        session = Routes.RoutesSession(args[1])
+    with session:
+        if next_options:
+            after = next_options.get('--after', time.strftime('%H:%M:%S'))
+            try:
+                limit = int(next_options['--next'])
+                if limit < 1:
+                    raise ValueError('--next must be positive')
+                departures = session.get_next_departures(args[2], after,
+                        limit, route_id)
+            except ValueError:
+                print("Invalid --next or --after value. %s" % USAGE_STR)
+                exit()
+            _get_next_departures_writer(output_format, multi_feed)(args[2],
+                    departures)
+        elif stops_from is None:
+            _get_stop_report_writer(output_format, multi_feed)(args[2],
+                    session.get_stop_report(args[2]))
+        else:
+            if stops_from != '-' and not exists(stops_from):
+                print("Stop ids file %s not found." % stops_from)
+                exit()
+            write_stop_report = _get_stop_report_writer(output_format,
+                    multi_feed)
+            f = stdin if stops_from == '-' else open(stops_from)
+            with f:
+                for stop_id, stop_report in session.get_stop_reports(
+                        _read_stop_ids(f)):
+                    write_stop_report(stop_id, stop_report)
+                    if output_format == 'text':
+                        print()
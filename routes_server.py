@@ -0,0 +1,78 @@
+import json
+import asyncio
+
+from os.path                    import exists
+from sys                        import argv
+
+from GTFSProcessor              import QueryServer
+
+SERVE_ARGS_NUM = 2
+LOAD_TEST_OPTION = '--load-test'
+USAGE_STR = '''Usage:
+            routes_server.py [database-Path] [--port=N | --unix=PATH]
+                    [--threads=N] [--cache-size=N]
+            routes_server.py --load-test [stop_ids-file-path]
+                    [--port=N | --unix=PATH] [--requests=N] [--concurrency=N]
+            Serves GET /stops/[stop_id] as JSON, GET /health reports the
+            database generation and cache statistics.
+            The load test cycles through the stop_ids in the file (one per
+            line) and prints the latency percentiles as JSON.'''
+INT_OPTIONS = {'--port': 8080, '--threads': QueryServer.DEFAULT_THREADS,
+        '--cache-size': QueryServer.DEFAULT_CACHE_SIZE, '--requests': 10000,
+        '--concurrency': 16}
+
+
+def _parse_options(args) -> tuple:
+    '''returns (positional args, {option : value}), raises ValueError'''
+    options = dict(INT_OPTIONS)
+    options['--unix'] = None
+    positional = []
+    for arg in args:
+        name, _, value = arg.partition('=')
+        if name in INT_OPTIONS:
+            options[name] = int(value)
+            if options[name] < 0 or (name != '--port' and options[name] == 0):
+                raise ValueError('%s must be positive' % name)
+        elif name == '--unix':
+            options[name] = value
+        elif arg == LOAD_TEST_OPTION:
+            continue
+        elif arg.startswith('--'):
+            raise ValueError('unknown option %s' % arg)
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+if __name__ == '__main__':
+    try:
+        args, options = _parse_options(argv)
+    except ValueError as e:
+        print("Invalid arguments, %s. %s" % (e, USAGE_STR))
+        exit()
+    if len(args) != SERVE_ARGS_NUM:
+        print("Invalid arguments. %s" % USAGE_STR)
+        exit()
+    if LOAD_TEST_OPTION in argv:
+        if not exists(args[1]):
+            print("Stop ids file %s not found." % args[1])
+            exit()
+        with open(args[1]) as f:
+            stop_ids = [line.strip() for line in f if line.strip()]
+        if not stop_ids:
+            print("Stop ids file %s is empty." % args[1])
+            exit()
+        result = asyncio.run(QueryServer.run_load_test(stop_ids,
+                options['--requests'], options['--concurrency'],
+                port=options['--port'], unix_path=options['--unix']))
+        print(json.dumps(result, indent=2))
+    else:
+        if not args[1].endswith('.sqlite'):
+            print("1st Argument must be a .sqlite database. %s" % USAGE_STR)
+            exit()
+        if not exists(args[1]):
+            print("Database %s not found." % args[1])
+            exit()
+        QueryServer.serve_forever(args[1], port=options['--port'],
+                unix_path=options['--unix'], threads=options['--threads'],
+                cache_size=options['--cache-size'])
@@ -1,15 +1,1668 @@
 import unittest
 import os
+import time
+import io
+import json
 import sqlite3
+import zipfile
+import asyncio
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
 
 from sys                import argv
+from shutil             import rmtree
+from contextlib         import closing, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 from GTFSProcessor      import ZIPImporter
 from GTFSProcessor      import Routes
+from GTFSProcessor      import QueryServer
+from GTFSProcessor      import Synthetic
+from GTFSProcessor      import Snapshot
+from GTFSProcessor      import MultiFeed
+from GTFSProcessor      import Validation
+from GTFSProcessor      import Columnar
+from GTFSProcessor      import Benchmark
+from GTFSProcessor      import Instrumentation
+
+import routes_at_stop
 
 DB_FILENAME = 'db.sqlite'
 USAGE_STR = '''Usage: 
             tests.py [optional-database-path]'''
 
+SAMPLE_GTFS_FILES = {
+    'routes.txt': 'route_id,agency_id,route_short_name,route_long_name,'
+        'route_type\n'
+        '1,A,R1,Route One,3\n'
+        '2,A,R2,Route Two,3\n',
+    'trips.txt': 'route_id,service_id,trip_id\n'
+        '1,S,T1\n'
+        '1,S,T2\n'
+        '2,S,T3\n',
+    'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon\n'
+        '100,Main St,45.50,-73.56\n'
+        '101,Second St,45.51,-73.57\n'
+        '102,Orphan St,45.60,-73.60\n',
+    'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,'
+        'stop_sequence\n'
+        'T1,05:00:00,05:00:00,100,1\n'
+        'T1,05:10:00,05:10:00,101,2\n'
+        'T2,25:30:00,25:30:00,100,1\n'
+        'T2,25:40:00,25:40:00,101,2\n'
+        'T3,06:15:00,06:15:00,100,1\n',
+    }
+
+
+def _write_sample_gtfs_zip(zip_path, files=SAMPLE_GTFS_FILES):
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        for filename, content in files.items():
+            zip_file.writestr(filename, content)
+
+
+def _import_quietly(*args, **kwargs):
+    with redirect_stdout(io.StringIO()):
+        return ZIPImporter.import_into_database(*args, **kwargs)
+
+
+class SampleFeedTestCase(unittest.TestCase):
+    '''imports gtfs_files, or the Synthetic feed generated with
+    synthetic_feed arguments, into a fresh database in a temp dir'''
+    gtfs_files = SAMPLE_GTFS_FILES
+    synthetic_feed = None
+    import_kwargs = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.zip_path = os.path.join(cls.temp_dir, 'feed.zip')
+        cls.db_path = os.path.join(cls.temp_dir, 'db.sqlite')
+        if cls.synthetic_feed:
+            Synthetic.write_synthetic_feed(cls.zip_path, **cls.synthetic_feed)
+        else:
+            _write_sample_gtfs_zip(cls.zip_path, cls.gtfs_files)
+        _import_quietly(cls.zip_path, cls.db_path, **cls.import_kwargs)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.temp_dir)
+
+    def setUp(self):
+        self.db_connection = sqlite3.connect(self.db_path)
+        self.cursor = self.db_connection.cursor()
+
+    def tearDown(self):
+        self.db_connection.close()
+
+
+class BulkImportTest(SampleFeedTestCase):
+    import_kwargs = {'batch_size': 2}
+
+    def test_row_counts(self):
+        expected = {'Route': 2, 'Trip': 3, 'Stop': 3, 'Stop_Trip': 5,
+                'Stop_Departure': 5, 'Stop_Route_Summary': 3}
+        for table_name, count in expected.items():
+            result = self.cursor.execute('SELECT count(*) FROM %s;'
+                    % table_name).fetchone()[0]
+            self.assertEqual(count, result, msg=table_name)
+
+    def test_stop_trip_departure_seconds(self):
+        result = self.cursor.execute('''SELECT departure_time_in_sec
+                FROM Stop_Trip
+                JOIN Trip ON Trip.key = Stop_Trip.trip_key
+                JOIN Stop ON Stop.key = Stop_Trip.stop_key
+                WHERE Trip.id = 'T2' AND Stop.id = 100;''').fetchone()[0]
+        self.assertEqual(25 * 3600 + 30 * 60, result)
+
+    def test_ids_stored_as_integers(self):
+        result = self.cursor.execute('''SELECT typeof(id) FROM Stop
+                UNION SELECT typeof(id) FROM Route;''').fetchall()
+        self.assertEqual([('integer',)], result)
+
+    def test_link_tables_store_surrogate_keys(self):
+        result = self.cursor.execute('''SELECT typeof(trip_key),
+                    typeof(stop_key), typeof(departure_time_in_sec)
+                FROM Stop_Trip
+                UNION SELECT typeof(route_key), typeof(stop_key),
+                    typeof(earliest_sec)
+                FROM Stop_Route_Summary;''').fetchall()
+        self.assertEqual([('integer', 'integer', 'integer')], result)
+        self.assertEqual([(1, 'T1'), (2, 'T2'), (3, 'T3')],
+                self.cursor.execute('SELECT key, id FROM Trip;').fetchall())
+
+    def test_link_tables_without_rowid(self):
+        for table_name in ('Stop_Trip', 'Stop_Departure',
+                'Stop_Route_Summary'):
+            sql_query = self.cursor.execute('''SELECT sql FROM sqlite_master
+                    WHERE name = ?;''', (table_name,)).fetchone()[0]
+            self.assertTrue(sql_query.rstrip(';').endswith('WITHOUT ROWID'),
+                    msg=table_name)
+
+    def test_database_published_in_wal_mode(self):
+        result = self.cursor.execute('PRAGMA journal_mode;').fetchone()[0]
+        self.assertEqual('wal', result)
+
+    def test_bulk_insert_with_values_needing_quotes(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE T (a TEXT, b INT);')
+        rows = [('say "hi"', 1), ("it's", 2), ('x', 3)]
+        count = ZIPImporter._bulk_insert(connection, 'T', ('a', 'b'), rows,
+                batch_size=2)
+        self.assertEqual(3, count)
+        self.assertEqual(rows, connection.execute(
+                'SELECT a, b FROM T ORDER BY b;').fetchall())
+
+
+class StreamingImportTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_member_rows_are_read_lazily(self):
+        _write_sample_gtfs_zip(self.zip_path)
+        with zipfile.ZipFile(self.zip_path) as zip_file:
+            rows = ZIPImporter._read_member_rows(zip_file, 'stop_times.txt',
+                    ('trip_id', 'stop_id'))
+            self.assertEqual(('T1', '100'), next(rows))
+            self.assertEqual(4, len(list(rows)))
+
+    def test_member_rows_with_byte_order_mark(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = '\ufeff' + files['stops.txt']
+        _write_sample_gtfs_zip(self.zip_path, files)
+        with zipfile.ZipFile(self.zip_path) as zip_file:
+            rows = list(ZIPImporter._read_member_rows(zip_file, 'stops.txt',
+                    ('stop_id',)))
+        self.assertEqual([('100',), ('101',), ('102',)], rows)
+
+    def test_import_writes_nothing_but_the_database(self):
+        _write_sample_gtfs_zip(self.zip_path)
+        cwd_before = set(os.listdir(os.getcwd()))
+        _import_quietly(self.zip_path, os.path.join(self.temp_dir, 'db.sqlite'))
+        self.assertSetEqual(cwd_before, set(os.listdir(os.getcwd())))
+        self.assertSetEqual(set(['feed.zip', 'db.sqlite',
+                    'db.sqlite' + ZIPImporter.GENERATION_SUFFIX + '1']),
+                set(os.listdir(self.temp_dir)))
+
+
+class QueryPlanTest(SampleFeedTestCase):
+    synthetic_feed = {'stop_count': 500, 'route_count': 50,
+            'trip_count': 2000, 'stops_per_trip': 20}
+
+    def _get_plan_details(self, sql_query, params) -> list:
+        return [row[-1] for row in self.cursor.execute(
+                'EXPLAIN QUERY PLAN ' + sql_query, params).fetchall()]
+
+    def test_indexes_exist(self):
+        result = set([row[0] for row in self.cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index';")])
+        for sql_query in ZIPImporter.INDEXES:
+            index_name = sql_query.split()[2]
+            self.assertIn(index_name, result)
+
+    def test_database_is_analyzed(self):
+        result = self.cursor.execute(
+                'SELECT count(*) FROM sqlite_stat1;').fetchone()[0]
+        self.assertGreater(result, 0)
+
+    def test_routes_queries_do_not_scan(self):
+        for sql_query, params in Routes.QUERIES:
+            for detail in self._get_plan_details(sql_query, params):
+                self.assertFalse(detail.startswith('SCAN'),
+                        msg="%s\nplan: %s" % (sql_query, detail))
+                self.assertIn(' USING ', detail,
+                        msg="%s\nplan: %s" % (sql_query, detail))
+                self.assertNotIn('TEMP B-TREE', detail,
+                        msg="%s\nplan: %s" % (sql_query, detail))
+
+    def test_nearby_query_uses_the_rtree(self):
+        details = self._get_plan_details(Routes.NEARBY_STOP_REPORTS_SQL,
+                {'min_lat': 45.4, 'max_lat': 45.41, 'min_lon': -73.7,
+                'max_lon': -73.69})
+        self.assertRegex(details[0],
+                '^SCAN Stop_Location VIRTUAL TABLE INDEX 2:[A-E0-9]{8}$')
+        for detail in details[1:]:
+            self.assertTrue(detail.startswith('SEARCH '), msg=detail)
+            self.assertNotIn('TEMP B-TREE', detail, msg=detail)
+
+    def test_batch_query_searches_stops_by_key(self):
+        sql_query = Routes.STOP_REPORTS_SQL % '(?, ?), (?, ?)'
+        details = [row[-1] for row in self.cursor.execute(
+                'EXPLAIN QUERY PLAN ' + sql_query, (0, '100', 1, '101'))]
+        self.assertTrue([d for d in details if d.startswith('SEARCH Stop ')])
+        for detail in details:
+            if detail.startswith('SCAN'):
+                self.assertTrue('Requested_Stop' in detail
+                        or 'CONSTANT ROWS' in detail, msg=detail)
+
+
+class StopRouteSummaryTest(SampleFeedTestCase):
+    def test_summary_rows(self):
+        expected = [(100, 1, 5 * 3600, 25 * 3600 + 1800),
+                    (100, 2, 6 * 3600 + 900, 6 * 3600 + 900),
+                    (101, 1, 5 * 3600 + 600, 25 * 3600 + 2400)]
+        result = self.cursor.execute('''SELECT Stop.id, Route.id,
+                    earliest_sec, latest_sec
+                FROM Stop_Route_Summary
+                JOIN Stop ON Stop.key = Stop_Route_Summary.stop_key
+                JOIN Route ON Route.key = Stop_Route_Summary.route_key
+                ORDER BY Stop.id, Route.id;''').fetchall()
+        self.assertEqual(expected, result)
+
+    def test_earliest_and_latest_service(self):
+        self.assertEqual('05:00:00', Routes.get_earliest_service_for_stop_on_trip(
+                self.db_path, '1', '100'))
+        self.assertEqual('25:30:00', Routes.get_latest_service_for_stop_on_trip(
+                self.db_path, '1', '100'))
+        self.assertEqual('', Routes.get_latest_service_for_stop_on_trip(
+                self.db_path, '2', '101'))
+
+    def test_get_stop_report(self):
+        expected = {'stop_id': '100', 'stop_name': 'Main St', 'routes': [
+            {'route_id': 1, 'short_name': 'R1', 'long_name': 'Route One',
+                'earliest': '05:00:00', 'latest': '25:30:00'},
+            {'route_id': 2, 'short_name': 'R2', 'long_name': 'Route Two',
+                'earliest': '06:15:00', 'latest': '06:15:00'}]}
+        self.assertEqual(expected, Routes.get_stop_report(self.db_path, '100'))
+
+    def test_get_stop_report_for_stop_without_routes(self):
+        expected = {'stop_id': '102', 'stop_name': 'Orphan St', 'routes': []}
+        self.assertEqual(expected, Routes.get_stop_report(self.db_path, '102'))
+
+    def test_get_stop_report_for_nonexistent_stop_returns_empty_dict(self):
+        self.assertEqual({}, Routes.get_stop_report(self.db_path, '999'))
+
+
+class StringIdsTest(SampleFeedTestCase):
+    gtfs_files = {filename: content.replace('100', 'S-100').replace(
+                '\n1,', '\nblue,').replace('\n2,', '\ngreen,')
+            for filename, content in SAMPLE_GTFS_FILES.items()}
+
+    def test_string_ids_accepted_and_returned(self):
+        with Routes.open_session(self.db_path) as session:
+            self.assertEqual(set(['blue', 'green']),
+                    session.get_route_ids_passing_through_stop('S-100'))
+            self.assertEqual('R1', session.get_route_short_name('blue'))
+            self.assertEqual('25:30:00',
+                    session.get_latest_service_for_stop_on_trip('blue',
+                        'S-100'))
+            self.assertEqual(['blue', 'green'], [route['route_id'] for route
+                    in session.get_stop_report('S-100')['routes']])
+            self.assertEqual([('T3', 'green')], [(departure['trip_id'],
+                    departure['route_id']) for departure in
+                    session.get_next_departures('S-100', '06:00', 1)])
+
+
+class RoutesSessionTest(SampleFeedTestCase):
+    def test_session_matches_module_functions(self):
+        with Routes.RoutesSession(self.db_path) as session:
+            self.assertTrue(session.check_if_stop_exists('100'))
+            self.assertFalse(session.check_if_stop_exists('999'))
+            self.assertEqual('Main St', session.get_stop_name('100'))
+            self.assertSetEqual(set([1, 2]),
+                    session.get_route_ids_passing_through_stop('100'))
+            self.assertEqual('R2', session.get_route_short_name('2'))
+            self.assertEqual('Route Two', session.get_route_long_name('2'))
+            self.assertEqual('06:15:00',
+                    session.get_earliest_service_for_stop_on_trip('2', '100'))
+            self.assertEqual(Routes.get_stop_report(self.db_path, '100'),
+                    session.get_stop_report('100'))
+
+    def test_session_is_read_only(self):
+        with Routes.RoutesSession(self.db_path) as session:
+            with self.assertRaises(sqlite3.OperationalError):
+                session._connection.execute('DELETE FROM Stop;')
+
+    def test_session_closed_on_exit(self):
+        with Routes.RoutesSession(self.db_path) as session:
+            pass
+        with self.assertRaises(sqlite3.ProgrammingError):
+            session.get_stop_name('100')
+
+    def test_session_shared_between_threads(self):
+        errors = []
+        def worker(session):
+            try:
+                for _ in range(200):
+                    self.assertEqual('Main St', session.get_stop_name('100'))
+            except Exception as e:
+                errors.append(e)
+        with Routes.RoutesSession(self.db_path) as session:
+            threads = [threading.Thread(target=worker, args=(session,))
+                    for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([], errors)
+
+    def test_missing_database_is_not_created(self):
+        db_path = os.path.join(self.temp_dir, 'missing.sqlite')
+        with self.assertRaises(sqlite3.OperationalError):
+            Routes.RoutesSession(db_path)
+        self.assertFalse(os.path.exists(db_path))
+
+
+class StopReportsBatchTest(SampleFeedTestCase):
+    def test_reports_in_input_order(self):
+        stop_ids = ['101', '999', '100', '102', '100']
+        result = list(Routes.get_stop_reports(self.db_path, iter(stop_ids),
+                chunk_size=2))
+        self.assertEqual(stop_ids, [stop_id for stop_id, _ in result])
+        for stop_id, stop_report in result:
+            self.assertEqual(Routes.get_stop_report(self.db_path, stop_id),
+                    stop_report)
+
+    def test_empty_input(self):
+        self.assertEqual([], list(Routes.get_stop_reports(self.db_path, [])))
+
+
+class RoutesAtStopFormatTest(SampleFeedTestCase):
+    def _write_stop_reports(self, output_format, stop_ids) -> list:
+        output = io.StringIO()
+        with redirect_stdout(output):
+            write_stop_report = routes_at_stop._get_stop_report_writer(
+                    output_format, False)
+            for stop_id, stop_report in Routes.get_stop_reports(self.db_path,
+                    stop_ids):
+                write_stop_report(stop_id, stop_report)
+        return output.getvalue().splitlines()
+
+    def test_json_lines(self):
+        lines = self._write_stop_reports('json', ['100', '999'])
+        self.assertEqual([dict(Routes.get_stop_report(self.db_path, '100'),
+                found=True), {'stop_id': '999', 'found': False}],
+                [json.loads(line) for line in lines])
+
+    def test_csv_rows(self):
+        lines = self._write_stop_reports('csv', ['100', '102', '999'])
+        self.assertEqual([
+                'stop_id,found,stop_name,route_id,short_name,long_name,'
+                    'earliest,latest',
+                '100,True,Main St,1,R1,Route One,05:00:00,25:30:00',
+                '100,True,Main St,2,R2,Route Two,06:15:00,06:15:00',
+                '102,True,Orphan St,,,,,',
+                '999,False,,,,,,'], lines)
+
+
+class MemoryBackendParityTest(SampleFeedTestCase):
+    synthetic_feed = {'stop_count': 40, 'route_count': 7, 'trip_count': 60,
+            'stops_per_trip': 5}
+
+    def test_parity_with_sqlite_backend(self):
+        stop_ids = [str(i) for i in range(42)] + ['abc']
+        route_ids = [str(i) for i in range(9)] + [3]
+        with Routes.open_session(self.db_path, 'sqlite') as sql_backend, \
+                Routes.open_session(self.db_path, 'memory') as memory_backend:
+            for stop_id in stop_ids:
+                for method_name in ('check_if_stop_exists', 'get_stop_name',
+                        'get_route_ids_passing_through_stop',
+                        'get_stop_report'):
+                    self.assertEqual(
+                        getattr(sql_backend, method_name)(stop_id),
+                        getattr(memory_backend, method_name)(stop_id),
+                        msg='%s(%s)' % (method_name, stop_id))
+                for route_id in route_ids:
+                    for method_name in ('get_earliest_service_for_stop_on_trip',
+                            'get_latest_service_for_stop_on_trip'):
+                        self.assertEqual(
+                            getattr(sql_backend, method_name)(route_id,
+                                stop_id),
+                            getattr(memory_backend, method_name)(route_id,
+                                stop_id),
+                            msg='%s(%s, %s)' % (method_name, route_id,
+                                stop_id))
+            for route_id in route_ids:
+                self.assertEqual(sql_backend.get_route_short_name(route_id),
+                        memory_backend.get_route_short_name(route_id))
+                self.assertEqual(sql_backend.get_route_long_name(route_id),
+                        memory_backend.get_route_long_name(route_id))
+            self.assertEqual(list(sql_backend.get_stop_reports(stop_ids)),
+                    list(memory_backend.get_stop_reports(stop_ids)))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Routes.open_session(self.db_path, 'postgres')
+
+
+class NextDeparturesTest(SampleFeedTestCase):
+    def _get_departures(self, *args, **kwargs) -> list:
+        return [(departure['trip_id'], departure['departure'],
+                departure['day_offset'], departure['wait_sec'])
+                for departure in Routes.get_next_departures(self.db_path,
+                    *args, **kwargs)]
+
+    def test_wraps_past_midnight(self):
+        expected = [('T3', '06:15:00', 0, 900), ('T2', '25:30:00', 0, 70200),
+                ('T1', '05:00:00', 1, 82800)]
+        self.assertEqual(expected, self._get_departures('100', '06:00', 3))
+
+    def test_times_past_24_00_of_the_previous_service_day(self):
+        expected = [('T2', '25:30:00', -1, 1800), ('T1', '05:00:00', 0, 14400)]
+        self.assertEqual(expected, self._get_departures('100', 3600, 2))
+
+    def test_route_filter(self):
+        expected = [('T3', '06:15:00', 1, 83700)]
+        self.assertEqual(expected, self._get_departures('100', '07:00:00', 5,
+                route_id='2'))
+
+    def test_departure_fields(self):
+        expected = [{'departure': '05:10:00', 'departure_sec': 18600,
+                'day_offset': 0, 'wait_sec': 600, 'route_id': 1,
+                'short_name': 'R1', 'long_name': 'Route One',
+                'trip_id': 'T1'}]
+        self.assertEqual(expected, Routes.get_next_departures(self.db_path,
+                '101', '05:00:00', 1))
+
+    def test_no_departures(self):
+        self.assertEqual([], self._get_departures('102', '05:00'))
+        self.assertEqual([], self._get_departures('999', '05:00'))
+
+    def test_invalid_time(self):
+        with self.assertRaises(ValueError):
+            self._get_departures('100', 'noon')
+
+
+class NextDeparturesParityTest(SampleFeedTestCase):
+    synthetic_feed = {'stop_count': 30, 'route_count': 5, 'trip_count': 200,
+            'stops_per_trip': 6}
+
+    def test_parity_with_sqlite_backend(self):
+        with Routes.open_session(self.db_path, 'sqlite') as sql_backend, \
+                Routes.open_session(self.db_path, 'memory') as memory_backend:
+            for stop_id in range(1, 32):
+                for after in ('00:00', '03:30:00', '12:00', '23:59:59'):
+                    for route_id in (None, 1, '3'):
+                        self.assertEqual(
+                            sql_backend.get_next_departures(stop_id, after, 7,
+                                route_id),
+                            memory_backend.get_next_departures(stop_id, after,
+                                7, route_id),
+                            msg='%s %s %s' % (stop_id, after, route_id))
+
+
+class SnapshotTest(SampleFeedTestCase):
+    synthetic_feed = {'stop_count': 40, 'route_count': 7, 'trip_count': 60,
+            'stops_per_trip': 5}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        Snapshot.export_snapshot(cls.db_path)
+        cls.snapshot_path = cls.db_path + Snapshot.SNAPSHOT_SUFFIX
+
+    def test_parity_with_memory_backend(self):
+        stop_ids = [str(i) for i in range(42)] + ['abc']
+        route_ids = [str(i) for i in range(9)] + [3, 'x']
+        with Routes.open_session(self.db_path, 'memory') as memory_backend, \
+                Routes.open_session(self.db_path, 'snapshot') as snapshot:
+            for stop_id in stop_ids:
+                for method_name in ('check_if_stop_exists', 'get_stop_name',
+                        'get_route_ids_passing_through_stop',
+                        'get_stop_report'):
+                    self.assertEqual(
+                        getattr(memory_backend, method_name)(stop_id),
+                        getattr(snapshot, method_name)(stop_id),
+                        msg='%s(%s)' % (method_name, stop_id))
+                for route_id in route_ids:
+                    self.assertEqual(
+                        memory_backend.get_latest_service_for_stop_on_trip(
+                            route_id, stop_id),
+                        snapshot.get_latest_service_for_stop_on_trip(route_id,
+                            stop_id))
+                self.assertEqual(
+                        memory_backend.get_next_departures(stop_id, '23:00', 5),
+                        snapshot.get_next_departures(stop_id, '23:00', 5))
+            for route_id in route_ids:
+                self.assertEqual(memory_backend.get_route_long_name(route_id),
+                        snapshot.get_route_long_name(route_id))
+
+    def test_sections_are_views_of_the_mapping(self):
+        with Snapshot.SnapshotRoutesIndex(self.snapshot_path) as snapshot:
+            self.assertIsInstance(snapshot.departure_sec, memoryview)
+            self.assertEqual('i', snapshot.departure_sec.format)
+            self.assertTrue(snapshot.departure_sec.readonly)
+        self.assertEqual(0, len(snapshot._views))
+
+    def test_replaced_snapshot_keeps_open_readers_valid(self):
+        with Snapshot.SnapshotRoutesIndex(self.snapshot_path) as snapshot:
+            expected = snapshot.get_stop_report('1')
+            Snapshot.export_snapshot(self.db_path)
+            self.assertEqual(expected, snapshot.get_stop_report('1'))
+
+    def test_not_a_snapshot(self):
+        with self.assertRaises(ValueError):
+            Snapshot.SnapshotRoutesIndex(self.db_path)
+
+
+class _SlowSession:
+    '''stands in for the session of a feed, answering after delay_sec'''
+    def __init__(self, delay_sec):
+        self.delay_sec = delay_sec
+
+    def get_stop_report(self, stop_id) -> dict:
+        time.sleep(self.delay_sec)
+        return {}
+
+    def close(self):
+        pass
+
+
+class MultiFeedTest(unittest.TestCase):
+    feeds = {'agency_a': {'stop_count': 30, 'route_count': 4,
+                          'trip_count': 30, 'stops_per_trip': 5, 'seed': 1},
+             'agency_b': {'stop_count': 20, 'route_count': 3,
+                          'trip_count': 20, 'stops_per_trip': 4, 'seed': 2}}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.database_dir = os.path.join(cls.temp_dir, 'feeds')
+        archive_paths = []
+        for feed_name, synthetic_feed in cls.feeds.items():
+            archive_paths.append(os.path.join(cls.temp_dir,
+                    feed_name + '.zip'))
+            Synthetic.write_synthetic_feed(archive_paths[-1],
+                    **synthetic_feed)
+        cls.instrumentation = Instrumentation.Instrumentation()
+        with redirect_stdout(io.StringIO()):
+            cls.db_filepaths = MultiFeed.import_feeds(archive_paths,
+                    cls.database_dir, instrumentation=cls.instrumentation)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(cls.temp_dir)
+
+    def test_no_feeds_given(self):
+        empty_dir = os.path.join(self.temp_dir, 'no_feeds')
+        with self.assertRaisesRegex(ValueError, 'No feeds given'):
+            MultiFeed.import_feeds([], empty_dir)
+        self.assertFalse(os.path.exists(empty_dir))
+
+    def test_unknown_cpu_count(self):
+        archive_path = os.path.join(self.temp_dir, 'agency_c.zip')
+        Synthetic.write_synthetic_feed(archive_path, stop_count=5,
+                route_count=1, trip_count=2, stops_per_trip=2)
+        cpu_count = os.cpu_count
+        os.cpu_count = lambda: None
+        try:
+            with redirect_stdout(io.StringIO()):
+                db_filepaths = MultiFeed.import_feeds([archive_path],
+                        os.path.join(self.temp_dir, 'unknown_cpus'),
+                        instrumentation=Instrumentation.Instrumentation())
+        finally:
+            os.cpu_count = cpu_count
+        self.assertTrue(Routes.check_if_stop_exists(
+                db_filepaths['agency_c'], '1'))
+
+    def test_feed_databases(self):
+        self.assertEqual(self.db_filepaths,
+                MultiFeed.get_feed_databases(self.database_dir))
+        for feed_name, db_filepath in self.db_filepaths.items():
+            with closing(sqlite3.connect(db_filepath)) as db_connection:
+                self.assertEqual(self.feeds[feed_name]['route_count'],
+                        db_connection.execute(
+                            'SELECT COUNT(*) FROM Route').fetchone()[0])
+        phase_names = [record['name']
+                for record in self.instrumentation.phases]
+        self.assertIn('agency_a/stop_times', phase_names)
+        self.assertIn('agency_b/stop_times', phase_names)
+
+    def test_duplicate_feed_names(self):
+        with self.assertRaises(ValueError):
+            MultiFeed.import_feeds(['a/feed.zip', 'b/feed.zip'],
+                    self.database_dir)
+
+    def test_queries_merge_every_feed(self):
+        sessions = {feed_name: Routes.RoutesSession(db_filepath)
+                for feed_name, db_filepath in self.db_filepaths.items()}
+        with MultiFeed.MultiFeedSession(sessions) as multi_feed_session:
+            for stop_id in ('1', '25', '99'):
+                reports = {feed_name: session.get_stop_report(stop_id)
+                        for feed_name, session in sessions.items()}
+                expected_routes = [dict(route, feed=feed_name)
+                        for feed_name, report in reports.items() if report
+                        for route in report['routes']]
+                report = multi_feed_session.get_stop_report(stop_id)
+                self.assertEqual(expected_routes, report.get('routes', []))
+                self.assertEqual(any(reports.values()),
+                        multi_feed_session.check_if_stop_exists(stop_id))
+                self.assertEqual({(feed_name, route['route_id'])
+                            for route in expected_routes
+                            for feed_name in [route['feed']]},
+                        multi_feed_session.get_route_ids_passing_through_stop(
+                            stop_id))
+                departures = multi_feed_session.get_next_departures(stop_id,
+                        '12:00', 8)
+                expected = sorted([dict(departure, feed=feed_name)
+                        for feed_name, session in sessions.items()
+                        for departure in session.get_next_departures(stop_id,
+                            '12:00', 8)],
+                        key=lambda departure: departure['wait_sec'])[:8]
+                self.assertEqual(expected, departures)
+            self.assertEqual([(stop_id,
+                        multi_feed_session.get_stop_report(stop_id))
+                    for stop_id in ('1', '25', '99')],
+                    list(multi_feed_session.get_stop_reports(['1', '25',
+                        '99'], chunk_size=2)))
+
+    def test_stops_near_merges_every_feed(self):
+        with MultiFeed.MultiFeedSession.from_databases(
+                self.db_filepaths) as multi_feed_session:
+            stops = multi_feed_session.get_stops_near(45.5, -73.6, 5000)
+            self.assertEqual({'agency_a', 'agency_b'},
+                    set(stop['feed'] for stop in stops))
+            distances = [stop['distance_m'] for stop in stops]
+            self.assertEqual(sorted(distances), distances)
+            self.assertEqual(stops[:2], multi_feed_session.get_stops_near(
+                    45.5, -73.6, 5000, 2))
+
+    def test_route_ids_are_namespaced(self):
+        with MultiFeed.MultiFeedSession.from_databases(
+                self.db_filepaths) as multi_feed_session:
+            self.assertEqual('Synthetic route 4',
+                    multi_feed_session.get_route_long_name(('agency_a', 4)))
+            self.assertEqual('',
+                    multi_feed_session.get_route_long_name(('agency_b', 4)))
+            self.assertEqual('',
+                    multi_feed_session.get_route_long_name(('agency_c', 1)))
+            for departure in multi_feed_session.get_next_departures('1',
+                    '00:00', 5, ('agency_b', 2)):
+                self.assertEqual(('agency_b', 2),
+                        (departure['feed'], departure['route_id']))
+
+    def test_feeds_are_queried_concurrently(self):
+        delay_sec = 0.2
+        with MultiFeed.MultiFeedSession({str(i): _SlowSession(delay_sec)
+                for i in range(4)}) as multi_feed_session:
+            start = time.perf_counter()
+            self.assertEqual({}, multi_feed_session.get_stop_report('1'))
+            self.assertLess(time.perf_counter() - start, 2 * delay_sec)
+
+
+class StopsNearTest(SampleFeedTestCase):
+    gtfs_files = dict(SAMPLE_GTFS_FILES, **{'stops.txt':
+            SAMPLE_GTFS_FILES['stops.txt'] + '103,Generic Node,,\n'})
+
+    def test_nearest_first_with_stop_reports(self):
+        stops = Routes.get_stops_near(self.db_path, 45.50, -73.56, 2000)
+        self.assertEqual(['100', '101'], [stop['stop_id'] for stop in stops])
+        self.assertEqual(0, stops[0]['distance_m'])
+        self.assertAlmostEqual(1358, stops[1]['distance_m'], delta=1)
+        for stop in stops:
+            report = Routes.get_stop_report(self.db_path, stop['stop_id'])
+            self.assertEqual(report, {key: value for key, value in
+                    stop.items() if key not in ('lat', 'lon', 'distance_m')})
+        self.assertEqual((45.51, -73.57), (stops[1]['lat'], stops[1]['lon']))
+
+    def test_limit_and_stop_without_routes(self):
+        stops = Routes.get_stops_near(self.db_path, 45.60, -73.60, 20000, 1)
+        self.assertEqual([{'stop_id': '102', 'stop_name': 'Orphan St',
+                'routes': [], 'lat': 45.6, 'lon': -73.6, 'distance_m': 0.0}],
+                stops)
+
+    def test_no_match_and_stops_without_coordinates(self):
+        self.assertEqual([], Routes.get_stops_near(self.db_path, 0, 0, 1000))
+        self.assertTrue(Routes.check_if_stop_exists(self.db_path, '103'))
+        self.assertNotIn('103', [stop['stop_id'] for stop in
+                Routes.get_stops_near(self.db_path, 45.5, -73.5, 1e7)])
+
+    def test_invalid_arguments(self):
+        for args in ((91, 0, 10), (0, 181, 10), (0, 0, -1)):
+            with self.assertRaises(ValueError):
+                Routes.get_stops_near(self.db_path, *args)
+
+
+class StopsNearParityTest(SampleFeedTestCase):
+    synthetic_feed = {'stop_count': 300, 'route_count': 7, 'trip_count': 60,
+            'stops_per_trip': 20}
+
+    def test_backends_match_a_brute_force_search(self):
+        Snapshot.export_snapshot(self.db_path)
+        points = [(45.5, -73.6), (45.65, -73.45), (45.31, -73.79),
+                (45.5, -72.0)]
+        stops = self.cursor.execute(
+                'SELECT id, lat, lon FROM Stop ORDER BY key;').fetchall()
+        sessions = [Routes.open_session(self.db_path, backend)
+                for backend in Routes.BACKENDS]
+        try:
+            for lat, lon in points:
+                for radius_m in (0, 800, 3000, 40000):
+                    expected = [str(stop_id) for stop_id, stop_lat, stop_lon
+                            in stops if Routes._get_distance_m(lat, lon,
+                                stop_lat, stop_lon) <= radius_m]
+                    results = [session.get_stops_near(lat, lon, radius_m)
+                            for session in sessions]
+                    self.assertSetEqual(set(expected),
+                            set(stop['stop_id'] for stop in results[0]))
+                    for result in results:
+                        self.assertEqual(results[0], result)
+                        for stop in result:
+                            self.assertIsInstance(stop['stop_id'], str)
+                    distances = [stop['distance_m'] for stop in results[0]]
+                    self.assertEqual(sorted(distances), distances)
+                    self.assertEqual(results[0][:3],
+                            sessions[0].get_stops_near(lat, lon, radius_m, 3))
+        finally:
+            for session in sessions:
+                session.close()
+
+
+def _read_all_queries(db_path, queries) -> dict:
+    '''queries: {name : sql}, returns {name : sorted rows}'''
+    db_connection = sqlite3.connect(db_path)
+    try:
+        return {name: sorted(db_connection.execute(sql_query).fetchall(),
+                key=repr) for name, sql_query in queries.items()}
+    finally:
+        db_connection.close()
+
+
+def _read_all_tables(db_path, table_names) -> dict:
+    return _read_all_queries(db_path, {table_name: 'SELECT * FROM %s;'
+            % table_name for table_name in table_names})
+
+
+class IncrementalImportTest(unittest.TestCase):
+    # surrogate keys of new ids depend on the import history, tables are
+    # compared with their keys replaced by the GTFS ids
+    DECODED_TABLE_QUERIES = {
+        'Route': 'SELECT id, short_name, long_name FROM Route;',
+        'Trip': '''SELECT Trip.id, Route.id FROM Trip
+                LEFT JOIN Route ON Route.key = Trip.route_key;''',
+        'Stop': 'SELECT id, name, lat, lon FROM Stop;',
+        'Stop_Location': '''SELECT Stop.id, min_lat, max_lat, min_lon, max_lon
+                FROM Stop_Location
+                LEFT JOIN Stop ON Stop.key = Stop_Location.stop_key;''',
+        'Stop_Trip': '''SELECT Trip.id, departure_time_in_sec, Stop.id
+                FROM Stop_Trip
+                LEFT JOIN Trip ON Trip.key = Stop_Trip.trip_key
+                LEFT JOIN Stop ON Stop.key = Stop_Trip.stop_key;''',
+        'Stop_Departure': '''SELECT Stop.id, departure_time_in_sec, Trip.id,
+                    Route.id
+                FROM Stop_Departure
+                LEFT JOIN Stop ON Stop.key = Stop_Departure.stop_key
+                LEFT JOIN Trip ON Trip.key = Stop_Departure.trip_key
+                LEFT JOIN Route ON Route.key = Stop_Departure.route_key;''',
+        'Stop_Route_Summary': '''SELECT Stop.id, Route.id, earliest_sec,
+                    latest_sec
+                FROM Stop_Route_Summary
+                LEFT JOIN Stop ON Stop.key = Stop_Route_Summary.stop_key
+                LEFT JOIN Route ON Route.key = Stop_Route_Summary.route_key;
+                ''',
+        'Feed_File': 'SELECT * FROM Feed_File;',
+        }
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        _write_sample_gtfs_zip(self.zip_path)
+        _import_quietly(self.zip_path, self.db_path)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def _assert_incremental_matches_full_import(self, files,
+            expected_filenames):
+        new_zip_path = os.path.join(self.temp_dir, 'new_feed.zip')
+        full_db_path = os.path.join(self.temp_dir, 'full.sqlite')
+        _write_sample_gtfs_zip(new_zip_path, files)
+        result = _import_quietly(new_zip_path, self.db_path, incremental=True)
+        self.assertEqual(expected_filenames, result)
+        _import_quietly(new_zip_path, full_db_path)
+        self.assertEqual(
+                _read_all_queries(full_db_path, self.DECODED_TABLE_QUERIES),
+                _read_all_queries(self.db_path, self.DECODED_TABLE_QUERIES))
+        self.assertFalse(os.path.exists(self.db_path
+                + ZIPImporter.BUILDING_SUFFIX))
+
+    def test_unchanged_feed_imports_nothing(self):
+        self.assertEqual([], _import_quietly(self.zip_path, self.db_path,
+                incremental=True))
+
+    def test_changed_route_name(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['routes.txt'] = files['routes.txt'].replace('Route Two',
+                'Route 2')
+        self._assert_incremental_matches_full_import(files, ['routes.txt'])
+        self.assertEqual('Route 2', Routes.get_stop_report(self.db_path,
+                '100')['routes'][1]['long_name'])
+
+    def test_changed_stop_times(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stop_times.txt'] = files['stop_times.txt'].replace(
+                'T3,06:15:00,06:15:00,100,1', 'T3,04:15:00,04:15:00,101,1')
+        self._assert_incremental_matches_full_import(files,
+                ['stop_times.txt'])
+
+    def test_trip_moved_to_another_route_and_new_stop(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['trips.txt'] = files['trips.txt'].replace('1,S,T2', '2,S,T2')
+        files['stops.txt'] += '103,New St,45.70,-73.70\n'
+        self._assert_incremental_matches_full_import(files,
+                ['trips.txt', 'stops.txt', 'stop_times.txt'])
+
+    def test_removed_stop_reimports_stop_times(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = files['stops.txt'].replace(
+                '101,Second St,45.51,-73.57\n', '')
+        self._assert_incremental_matches_full_import(files,
+                ['stops.txt', 'stop_times.txt'])
+        self.assertEqual(set(), Routes.get_route_ids_passing_through_stop(
+                self.db_path, '101'))
+
+    def test_moved_stop(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = files['stops.txt'].replace(
+                '101,Second St,45.51,-73.57', '101,Second St,46.00,-74.00')
+        self._assert_incremental_matches_full_import(files, ['stops.txt'])
+        self.assertEqual(['101'], [stop['stop_id'] for stop in
+                Routes.get_stops_near(self.db_path, 46.0, -74.0, 100)])
+
+    def test_surrogate_keys_of_unchanged_ids_are_kept(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['trips.txt'] = 'route_id,service_id,trip_id\n2,S,T0\n' + \
+                files['trips.txt'].split('\n', 1)[1]
+        query = 'SELECT key, id FROM Trip;'
+        before = _read_all_queries(self.db_path, {'Trip': query})['Trip']
+        new_zip_path = os.path.join(self.temp_dir, 'new_feed.zip')
+        _write_sample_gtfs_zip(new_zip_path, files)
+        _import_quietly(new_zip_path, self.db_path, incremental=True)
+        after = _read_all_queries(self.db_path, {'Trip': query})['Trip']
+        self.assertEqual(before + [(4, 'T0')], after)
+
+    def test_database_with_another_schema_is_fully_imported(self):
+        db_connection = sqlite3.connect(self.db_path)
+        db_connection.execute('PRAGMA user_version = 1;')
+        db_connection.close()
+        result = _import_quietly(self.zip_path, self.db_path, incremental=True)
+        self.assertEqual(4, len(result))
+
+    def test_missing_database_falls_back_to_full_import(self):
+        os.remove(self.db_path)
+        result = _import_quietly(self.zip_path, self.db_path, incremental=True)
+        self.assertEqual(4, len(result))
+
+
+class ParallelParseTest(unittest.TestCase):
+    TABLE_NAMES = ('Route', 'Trip', 'Stop', 'Stop_Trip', 'Stop_Route_Summary')
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        Synthetic.write_synthetic_feed(self.zip_path, stop_count=30,
+                route_count=5, trip_count=40, stops_per_trip=6)
+        self.chunk_size = ZIPImporter.PARSE_CHUNK_SIZE
+        ZIPImporter.PARSE_CHUNK_SIZE = 100
+
+    def tearDown(self):
+        ZIPImporter.PARSE_CHUNK_SIZE = self.chunk_size
+        rmtree(self.temp_dir)
+
+    def test_line_aligned_chunks(self):
+        data = b'a,b\nccc,d\ne\nlast-without-newline'
+        chunks = list(ZIPImporter._read_line_aligned_chunks(io.BytesIO(data),
+                5))
+        self.assertEqual(data, b''.join(chunks))
+        for chunk in chunks[:-1]:
+            self.assertTrue(chunk.endswith(b'\n'), msg=chunk)
+
+    def test_parallel_import_matches_serial_import(self):
+        serial_db_path = os.path.join(self.temp_dir, 'serial.sqlite')
+        parallel_db_path = os.path.join(self.temp_dir, 'parallel.sqlite')
+        _import_quietly(self.zip_path, serial_db_path)
+        _import_quietly(self.zip_path, parallel_db_path, workers=2)
+        self.assertEqual(_read_all_tables(serial_db_path, self.TABLE_NAMES),
+                _read_all_tables(parallel_db_path, self.TABLE_NAMES))
+
+    def test_parallel_rows_keep_file_order(self):
+        with zipfile.ZipFile(self.zip_path) as zip_file:
+            serial = list(ZIPImporter._read_member_rows(zip_file,
+                    'stop_times.txt', ('trip_id', 'stop_id')))
+            parallel = list(ZIPImporter._read_member_rows_parallel(zip_file,
+                    'stop_times.txt', ('trip_id', 'stop_id'), 2))
+        self.assertEqual(serial, parallel)
+
+
+INVALID_GTFS_FILES = {
+    'routes.txt': 'route_id,route_short_name,route_long_name\r\n'
+        '1,R1,"Downtown, via ""Main"""\r\n'
+        '1,R1b,Duplicate\r\n'
+        '2,R2,Route Two\r\n',
+    'trips.txt': 'route_id,service_id,trip_id\n'
+        '1,S,T1\n'
+        '9,S,T9\n'
+        '2,S,T2\n',
+    'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon\n'
+        '100,"Main St, North",45.50,-73.56\n'
+        '101,"Second\nSt",north,-73.57\n'
+        '102,Orphan St,45.60,-73.60\n',
+    'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,'
+        'stop_sequence\n'
+        'T1,05:00:00,05:00:00,100,1\n'
+        'T1,,,101,2\n'
+        'T9,05:00:00,05:00:00,100,1\n'
+        'T1,05:20:00,05:20:00,999,3\n'
+        'T2,06:00\n'
+        'T2,06:00:00,06:00:00,101,1\n'
+        'T2,6.30,6.30,100,2\n'
+        'T2,05:00,05:00,100,3\n'
+        'T2,05:00:00:30,05:00:00:30,100,4\n',
+    }
+
+
+class ValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        self.db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        _write_sample_gtfs_zip(self.zip_path, INVALID_GTFS_FILES)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def _import(self, **kwargs) -> dict:
+        report = Validation.ValidationReport()
+        _import_quietly(self.zip_path, self.db_path, validation_report=report,
+                **kwargs)
+        return report.report()
+
+    def test_csv_records(self):
+        lines = ['a,b\r\n', '\n', '"x, ""y""",z\n', '"multi\n', 'line",w\n',
+                'last']
+        self.assertEqual([['a', 'b'], ['x, "y"', 'z'], ['multi\nline', 'w'],
+                ['last']], list(ZIPImporter._split_csv_records(lines)))
+
+    def test_time_shapes(self):
+        self.assertEqual(18000, ZIPImporter._convert_time_data_to_seconds(
+                '5:00:00'))
+        self.assertEqual(360010, ZIPImporter._convert_time_data_to_seconds(
+                '100:00:10'))
+        for time_string in ('05:00', '05:00:00:30', '6.30', '05:-1:00',
+                '05: 0:00', ''):
+            with self.assertRaises(ValueError, msg=time_string):
+                ZIPImporter._convert_time_data_to_seconds(time_string)
+
+    def test_quoted_fields_are_imported(self):
+        self._import()
+        with closing(sqlite3.connect(self.db_path)) as db_connection:
+            self.assertEqual([(1, 'R1', 'Downtown, via "Main"'),
+                    (2, 'R2', 'Route Two')], db_connection.execute(
+                    'SELECT id, short_name, long_name FROM Route;').fetchall())
+            self.assertEqual([(100, 'Main St, North', 45.5),
+                    (101, 'Second\nSt', None), (102, 'Orphan St', 45.6)],
+                    db_connection.execute(
+                    'SELECT id, name, lat FROM Stop;').fetchall())
+            self.assertEqual(3, db_connection.execute(
+                    'SELECT count(*) FROM Stop_Trip;').fetchone()[0])
+
+    def test_report(self):
+        report = self._import()
+        self.assertEqual(8, report['errors'])
+        self.assertEqual(2, report['warnings'])
+        samples = {(issue['filename'], issue['check']): issue['samples']
+                for issue in report['issues']}
+        self.assertEqual({
+                ('routes.txt', 'duplicate_id'): ['1'],
+                ('trips.txt', 'unknown_route_id'): ['9'],
+                ('stop_times.txt', 'malformed_row'): ['T2,06:00'],
+                ('stop_times.txt', 'invalid_time'): ['6.30', '05:00',
+                    '05:00:00:30'],
+                ('stop_times.txt', 'unknown_trip_id'): ['T9'],
+                ('stop_times.txt', 'unknown_stop_id'): ['999'],
+                ('stops.txt', 'invalid_coordinate'): ['101'],
+                ('stops.txt', 'stop_without_departures'): ['102'],
+                }, samples)
+        self.assertEqual(Validation.ERROR, report['issues'][0]['severity'])
+
+    def test_stop_times_without_times_serve_their_route(self):
+        self._import()
+        Snapshot.export_snapshot(self.db_path)
+        expected_routes = [
+                {'route_id': 1, 'short_name': 'R1',
+                 'long_name': 'Downtown, via "Main"', 'earliest': '',
+                 'latest': ''},
+                {'route_id': 2, 'short_name': 'R2', 'long_name': 'Route Two',
+                 'earliest': '06:00:00', 'latest': '06:00:00'}]
+        for backend in Routes.BACKENDS:
+            with Routes.open_session(self.db_path, backend) as session:
+                self.assertEqual(expected_routes,
+                        session.get_stop_report('101')['routes'],
+                        msg=backend)
+                self.assertEqual('',
+                        session.get_earliest_service_for_stop_on_trip(1,
+                            '101'), msg=backend)
+                self.assertEqual([('T2', 0)], [(departure['trip_id'],
+                        departure['day_offset']) for departure
+                        in session.get_next_departures('101', '00:00', 1)],
+                        msg=backend)
+
+    def test_parallel_report_matches_serial_report(self):
+        chunk_size = ZIPImporter.PARSE_CHUNK_SIZE
+        ZIPImporter.PARSE_CHUNK_SIZE = 20
+        try:
+            self.assertEqual(self._import(), self._import(workers=2))
+        finally:
+            ZIPImporter.PARSE_CHUNK_SIZE = chunk_size
+
+    def test_chunks_are_not_cut_in_quoted_fields(self):
+        data = b'1,"a\nb",c\n2,"d\ne\nf",g\n3,h,i\n'
+        chunks = list(ZIPImporter._read_line_aligned_chunks(io.BytesIO(data),
+                6))
+        self.assertEqual(data, b''.join(chunks))
+        for chunk in chunks:
+            self.assertEqual(0, chunk.count(b'"') % 2, msg=chunk)
+
+    def test_quotes_inside_fields_do_not_open_quoted_fields(self):
+        data = b'1,Joe\'s "Diner,x\n2,"multi\nline",y\n3,z,w\n'
+        chunks = list(ZIPImporter._read_line_aligned_chunks(io.BytesIO(data),
+                6))
+        self.assertEqual(data, b''.join(chunks))
+        self.assertEqual([['1', 'Joe\'s "Diner', 'x'],
+                ['2', 'multi\nline', 'y'], ['3', 'z', 'w']],
+                [fields for chunk in chunks
+                    for fields in ZIPImporter._split_csv_records(
+                        io.StringIO(chunk.decode('utf-8')))])
+
+    def test_parallel_import_with_quotes_inside_fields(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = ('stop_id,stop_name,stop_lat,stop_lon\n'
+                '100,Joe\'s "Diner,45.50,-73.56\n'
+                '101,"Second\nSt, ""North""",45.51,-73.57\n'
+                '102,Third St,45.52,-73.58\n')
+        _write_sample_gtfs_zip(self.zip_path, files)
+        queries = {'Stop': 'SELECT id, name, lat FROM Stop;'}
+        _import_quietly(self.zip_path, self.db_path)
+        serial = _read_all_queries(self.db_path, queries)
+        chunk_size = ZIPImporter.PARSE_CHUNK_SIZE
+        ZIPImporter.PARSE_CHUNK_SIZE = 16
+        try:
+            _import_quietly(self.zip_path, self.db_path, workers=2)
+        finally:
+            ZIPImporter.PARSE_CHUNK_SIZE = chunk_size
+        self.assertEqual(serial, _read_all_queries(self.db_path, queries))
+        self.assertEqual([(100, 'Joe\'s "Diner', 45.5),
+                (101, 'Second\nSt, "North"', 45.51),
+                (102, 'Third St', 45.52)], serial['Stop'])
+
+    def test_stray_quote_recovered_whatever_the_workers(self):
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = ('stop_id,stop_name,stop_lat,stop_lon\n'
+                '100,"Main St,45.50,-73.56\n' + ''.join(
+                    '%d,Stop %d,45.51,-73.57\n' % (stop_id, stop_id)
+                    for stop_id in range(101, 141)))
+        _write_sample_gtfs_zip(self.zip_path, files)
+        queries = {'Stop': 'SELECT id, name, lat FROM Stop;'}
+        chunk_size = ZIPImporter.PARSE_CHUNK_SIZE
+        ZIPImporter.PARSE_CHUNK_SIZE = 16
+        try:
+            _import_quietly(self.zip_path, self.db_path)
+            serial = _read_all_queries(self.db_path, queries)
+            _import_quietly(self.zip_path, self.db_path, workers=2)
+            parallel = _read_all_queries(self.db_path, queries)
+        finally:
+            ZIPImporter.PARSE_CHUNK_SIZE = chunk_size
+        self.assertEqual(serial, parallel)
+        # the open quote gives up after MAX_OPEN_QUOTE_CHUNKS chunks
+        self.assertEqual((140, 'Stop 140', 45.51), serial['Stop'][-1])
+
+
+class ColumnarImportTest(unittest.TestCase):
+    TABLE_NAMES = ('Route', 'Trip', 'Stop', 'Stop_Trip', 'Stop_Departure',
+            'Stop_Route_Summary')
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.chunk_size = ZIPImporter.COLUMNAR_CHUNK_SIZE
+        ZIPImporter.COLUMNAR_CHUNK_SIZE = 100
+
+    def tearDown(self):
+        ZIPImporter.COLUMNAR_CHUNK_SIZE = self.chunk_size
+        rmtree(self.temp_dir)
+
+    def _import(self, zip_path, **kwargs) -> tuple:
+        db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        report = Validation.ValidationReport()
+        _import_quietly(zip_path, db_path, validation_report=report, **kwargs)
+        return _read_all_tables(db_path, self.TABLE_NAMES), report.report()
+
+    def test_split_columns(self):
+        self.assertEqual([['a', 'd'], ['c', 'f']],
+                Columnar.split_columns('a,b,c\r\nd,e,f\r\n', 3, [0, 2]))
+        self.assertIsNone(Columnar.split_columns('a,b\nc\n', 2, [0]))
+        self.assertIsNone(Columnar.split_columns('"a,b",c\n', 2, [0]))
+        self.assertEqual([[]], Columnar.split_columns('', 2, [0]))
+
+    def test_convert_times(self):
+        times = ['05:00:00', '5:00:00', '25:30:10', '100:00:00', '', None,
+                'ab:cd:ef']
+        self.assertEqual([18000, 18000, 91810, 360000, Columnar.INVALID_TIME,
+                Columnar.INVALID_TIME, Columnar.INVALID_TIME],
+                Columnar.to_list(Columnar.convert_times(times,
+                    ZIPImporter._convert_time_data_to_seconds)))
+        self.assertEqual([18000, 0, 359999], Columnar.to_list(
+                Columnar.convert_times(['5:00:00', '00:00:00', '99:59:59'],
+                    ZIPImporter._convert_time_data_to_seconds)))
+
+    def test_columnar_import_matches_row_import(self):
+        zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        Synthetic.write_synthetic_feed(zip_path, stop_count=30,
+                route_count=5, trip_count=40, stops_per_trip=6)
+        row_import = self._import(zip_path)
+        self.assertEqual(row_import, self._import(zip_path, columnar=True))
+        self.assertEqual(row_import, self._import(zip_path, columnar=True,
+                workers=2))
+
+    def test_columnar_validation_matches_row_validation(self):
+        zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        _write_sample_gtfs_zip(zip_path, INVALID_GTFS_FILES)
+        self.assertEqual(self._import(zip_path),
+                self._import(zip_path, columnar=True))
+
+    def _assert_columnar_path_matches_row_path(self, column_type):
+        '''convert_times gives column_type columns of the seconds the row
+        path converts each time to, for times all [H]H:MM:SS and mixed
+        ones, and the columnar imports match the row imports'''
+        def convert_row_time(time_string):
+            try:
+                return ZIPImporter._convert_optional_time(time_string)
+            except ValueError:
+                return Columnar.INVALID_TIME
+        for times in (['05:00:00', '5:00:00', '25:30:10', '00:00:00'],
+                ['05:00:00', '', ' ', '6.30', 'ab:cd:ef', '100:00:00',
+                    '5:00:00']):
+            seconds = Columnar.convert_times(times,
+                    ZIPImporter._convert_optional_time)
+            self.assertIsInstance(seconds, column_type)
+            self.assertEqual([convert_row_time(time_string)
+                        for time_string in times],
+                    Columnar.to_list(seconds))
+        zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        Synthetic.write_synthetic_feed(zip_path, stop_count=30,
+                route_count=5, trip_count=40, stops_per_trip=6)
+        self.assertEqual(self._import(zip_path),
+                self._import(zip_path, columnar=True))
+        _write_sample_gtfs_zip(zip_path, INVALID_GTFS_FILES)
+        self.assertEqual(self._import(zip_path),
+                self._import(zip_path, columnar=True))
+
+    def test_columnar_path_without_numpy(self):
+        numpy = Columnar.numpy
+        Columnar.numpy = None
+        try:
+            self._assert_columnar_path_matches_row_path(Columnar.array)
+        finally:
+            Columnar.numpy = numpy
+
+    @unittest.skipUnless(Columnar.numpy, 'NumPy is not installed')
+    def test_columnar_path_with_numpy(self):
+        self._assert_columnar_path_matches_row_path(Columnar.numpy.ndarray)
+
+
+def _import_until_killed(zip_path, db_path, batch_size, kill_after_rows):
+    '''runs in a child process, which dies without any cleanup like a killed
+    import once kill_after_rows departure times have been parsed'''
+    convert_time_data_to_seconds = ZIPImporter._convert_time_data_to_seconds
+    rows = [0]
+    def convert_until_killed(time_string):
+        rows[0] += 1
+        if rows[0] > kill_after_rows:
+            os._exit(1)
+        return convert_time_data_to_seconds(time_string)
+    ZIPImporter._convert_time_data_to_seconds = convert_until_killed
+    _import_quietly(zip_path, db_path, batch_size)
+
+
+class ResumableImportTest(unittest.TestCase):
+    TABLE_NAMES = ('Route', 'Trip', 'Stop', 'Stop_Trip', 'Stop_Departure',
+            'Stop_Route_Summary', 'Feed_File', 'sqlite_master')
+    STOP_TIMES_ROWS = 2000
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        self.db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        Synthetic.write_synthetic_feed(self.zip_path, stop_count=40,
+                route_count=7, trip_count=200, stops_per_trip=10)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def _kill_import(self, batch_size, kill_after_rows):
+        process = multiprocessing.get_context('fork').Process(
+                target=_import_until_killed, args=(self.zip_path,
+                    self.db_path, batch_size, kill_after_rows))
+        process.start()
+        process.join()
+        self.assertEqual(1, process.exitcode)
+        self.assertFalse(os.path.exists(self.db_path))
+
+    def test_resumed_import_matches_uninterrupted_import(self):
+        full_db_path = os.path.join(self.temp_dir, 'full.sqlite')
+        _import_quietly(self.zip_path, full_db_path)
+        self._kill_import(batch_size=300, kill_after_rows=1000)
+        instrumentation = Instrumentation.Instrumentation()
+        _import_quietly(self.zip_path, self.db_path, batch_size=300,
+                instrumentation=instrumentation, resume=True)
+        self.assertEqual(_read_all_tables(full_db_path, self.TABLE_NAMES),
+                _read_all_tables(self.db_path, self.TABLE_NAMES))
+        phases = {record['name']: record['rows']
+                for record in instrumentation.phases}
+        # finished files are not read again, nor the committed batches
+        self.assertNotIn('stops', phases)
+        self.assertEqual(self.STOP_TIMES_ROWS - 900, phases['stop_times'])
+        self.assertFalse(os.path.exists(self.db_path
+                + ZIPImporter.BUILDING_SUFFIX))
+
+    def test_columnar_resume_matches_uninterrupted_import(self):
+        full_db_path = os.path.join(self.temp_dir, 'full.sqlite')
+        _import_quietly(self.zip_path, full_db_path)
+        self._kill_import(batch_size=300, kill_after_rows=1000)
+        _import_quietly(self.zip_path, self.db_path, batch_size=300,
+                resume=True, columnar=True)
+        self.assertEqual(_read_all_tables(full_db_path, self.TABLE_NAMES),
+                _read_all_tables(self.db_path, self.TABLE_NAMES))
+
+    def test_resume_of_another_archive_starts_over(self):
+        self._kill_import(batch_size=300, kill_after_rows=1000)
+        Synthetic.write_synthetic_feed(self.zip_path, stop_count=40,
+                route_count=7, trip_count=200, stops_per_trip=10, seed=1)
+        instrumentation = Instrumentation.Instrumentation()
+        _import_quietly(self.zip_path, self.db_path,
+                instrumentation=instrumentation, resume=True)
+        full_db_path = os.path.join(self.temp_dir, 'full.sqlite')
+        _import_quietly(self.zip_path, full_db_path)
+        self.assertEqual(_read_all_tables(full_db_path, self.TABLE_NAMES),
+                _read_all_tables(self.db_path, self.TABLE_NAMES))
+        self.assertIn('stops', [record['name']
+                for record in instrumentation.phases])
+
+    def test_resume_without_interrupted_import(self):
+        _import_quietly(self.zip_path, self.db_path, resume=True)
+        with closing(sqlite3.connect(self.db_path)) as db_connection:
+            self.assertEqual(self.STOP_TIMES_ROWS, db_connection.execute(
+                    'SELECT COUNT(*) FROM Stop_Trip;').fetchone()[0])
+            self.assertIsNone(db_connection.execute('''SELECT name
+                    FROM sqlite_master
+                    WHERE name = 'Import_Checkpoint';''').fetchone())
+
+
+class QueryServerTest(SampleFeedTestCase):
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = QueryServer.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+    def _run_with_server(self, client_coroutine_function):
+        async def run():
+            service = QueryServer.StopReportService(self.db_path, threads=2,
+                    cache_size=10)
+            server = await QueryServer.start_server(service, port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await client_coroutine_function(service, port)
+            finally:
+                server.close()
+                await server.wait_closed()
+                service.close()
+        return asyncio.run(run())
+
+    def test_stop_report_over_http(self):
+        async def client(service, port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for stop_id in ('100', '100', '999'):
+                writer.write(('GET /stops/%s HTTP/1.1\r\n\r\n'
+                        % stop_id).encode('ascii'))
+                responses.append(await QueryServer._read_response(reader))
+            writer.close()
+            return responses, service.cache.hits
+        responses, cache_hits = self._run_with_server(client)
+        self.assertEqual(200, responses[0][0])
+        self.assertEqual(Routes.get_stop_report(self.db_path, '100'),
+                json.loads(responses[0][1]))
+        self.assertEqual(responses[0], responses[1])
+        self.assertEqual(404, responses[2][0])
+        self.assertEqual(1, cache_hits)
+
+    def test_load_test_reports_percentiles(self):
+        async def client(service, port):
+            return await QueryServer.run_load_test(['100', '101', '999'],
+                    requests=60, concurrency=3, port=port)
+        result = self._run_with_server(client)
+        self.assertEqual(60, result['requests'])
+        self.assertEqual(0, result['errors'])
+        self.assertSetEqual(set(['p50', 'p90', 'p99', 'max']),
+                set(result['latency_ms']))
+
+    def test_invalid_content_length_is_bad_request(self):
+        async def client(service, port):
+            responses = []
+            for content_length in ('abc', '-1'):
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                        port)
+                writer.write(('GET /stops/100 HTTP/1.1\r\nContent-Length: '
+                        '%s\r\n\r\n' % content_length).encode('ascii'))
+                responses.append(await QueryServer._read_response(reader))
+                # the server closes the connection after answering
+                responses.append(await reader.read())
+                writer.close()
+            return responses
+        responses = self._run_with_server(client)
+        self.assertEqual(400, responses[0][0])
+        self.assertEqual({'error': 'invalid Content-Length abc'},
+                json.loads(responses[0][1]))
+        self.assertEqual(400, responses[2][0])
+        self.assertEqual([b'', b''], responses[1::2])
+
+    def test_load_test_quotes_stop_ids(self):
+        async def client(service, port):
+            stop_ids = []
+            get_stop_report = service.get_stop_report
+            async def record_stop_id(stop_id):
+                stop_ids.append(stop_id)
+                return await get_stop_report(stop_id)
+            service.get_stop_report = record_stop_id
+            result = await QueryServer.run_load_test(['a b/c?d', 100],
+                    requests=2, concurrency=1, port=port)
+            return result, stop_ids
+        result, stop_ids = self._run_with_server(client)
+        self.assertEqual(0, result['errors'])
+        self.assertEqual(['a b/c?d', '100'], stop_ids)
+
+    def test_new_import_generation_invalidates_cache(self):
+        db_path = os.path.join(self.temp_dir, 'generations.sqlite')
+        _import_quietly(self.zip_path, db_path)
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = files['stops.txt'].replace('Main St', 'High St')
+        new_zip_path = os.path.join(self.temp_dir, 'renamed.zip')
+        _write_sample_gtfs_zip(new_zip_path, files)
+        async def run():
+            service = QueryServer.StopReportService(db_path, threads=1)
+            try:
+                before = await service.get_stop_report('100')
+                _import_quietly(new_zip_path, db_path)
+                after = await service.get_stop_report('100')
+                return before, after
+            finally:
+                service.close()
+        before, after = asyncio.run(run())
+        self.assertEqual('Main St', before['stop_name'])
+        self.assertEqual('High St', after['stop_name'])
+
+
+class GenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        self.renamed_zip_path = os.path.join(self.temp_dir, 'renamed.zip')
+        _write_sample_gtfs_zip(self.zip_path)
+        files = dict(SAMPLE_GTFS_FILES)
+        files['stops.txt'] = files['stops.txt'].replace('Main St', 'High St')
+        _write_sample_gtfs_zip(self.renamed_zip_path, files)
+        _import_quietly(self.zip_path, self.db_path)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_imports_publish_new_generations(self):
+        _import_quietly(self.zip_path, self.db_path)
+        _import_quietly(self.renamed_zip_path, self.db_path, incremental=True)
+        generations = ZIPImporter.get_generations(self.db_path)
+        self.assertEqual([2, 3], [number for number, _ in generations])
+        self.assertTrue(os.path.islink(self.db_path))
+        self.assertEqual(os.path.basename(generations[-1][1]),
+                os.readlink(self.db_path))
+        self.assertEqual('High St',
+                Routes.get_stop_name(self.db_path, '100'))
+
+    def test_open_session_keeps_its_generation(self):
+        with Routes.RoutesSession(self.db_path) as session:
+            _import_quietly(self.renamed_zip_path, self.db_path)
+            self.assertEqual('Main St', session.get_stop_name('100'))
+        self.assertEqual('High St',
+                Routes.get_stop_name(self.db_path, '100'))
+
+    def test_pool_moves_to_new_generation_between_queries(self):
+        with Routes.RoutesPool(self.db_path, size=2) as pool:
+            reports = pool.get_stop_reports(['100', '101'])
+            self.assertEqual('Main St', next(reports)[1]['stop_name'])
+            _import_quietly(self.renamed_zip_path, self.db_path)
+            self.assertEqual('High St', pool.get_stop_name('100'))
+            # an iteration started before the import ends on its generation
+            self.assertEqual(('101', Routes.get_stop_report(self.db_path,
+                    '101')), next(reports))
+            reports.close()
+            self.assertEqual(1, len(pool._idle))
+
+    def test_pool_queries_from_threads_during_import(self):
+        done = threading.Event()
+        def query(pool):
+            names = set()
+            while not done.is_set():
+                names.add(pool.get_stop_report('100')['stop_name'])
+            return names
+        with Routes.RoutesPool(self.db_path) as pool:
+            with ThreadPoolExecutor(4) as executor:
+                futures = [executor.submit(query, pool) for _ in range(4)]
+                try:
+                    _import_quietly(self.renamed_zip_path, self.db_path)
+                    _import_quietly(self.zip_path, self.db_path)
+                finally:
+                    done.set()
+                names = set().union(*[future.result() for future in futures])
+            self.assertLessEqual(names, set(['Main St', 'High St']))
+            self.assertEqual('Main St', pool.get_stop_name('100'))
+
+    def test_pool_checks_generation_under_its_lock(self):
+        get_database_generation = Routes.get_database_generation
+        locked = []
+        with Routes.RoutesPool(self.db_path) as pool:
+            def get_generation_locked(db_filepath):
+                locked.append(pool._lock.locked())
+                return get_database_generation(db_filepath)
+            Routes.get_database_generation = get_generation_locked
+            try:
+                pool.get_stop_name('100')
+            finally:
+                Routes.get_database_generation = get_database_generation
+        self.assertEqual([True], locked)
+
+    def test_database_renamed_over_path_without_symlinks(self):
+        symlink = os.symlink
+        def symlink_not_permitted(*args, **kwargs):
+            raise OSError('symbolic link privilege not held')
+        os.symlink = symlink_not_permitted
+        try:
+            _import_quietly(self.renamed_zip_path, self.db_path)
+            self.assertEqual([1], [number for number, _ in
+                    ZIPImporter.get_generations(self.db_path)])
+            _import_quietly(self.renamed_zip_path, self.db_path)
+        finally:
+            os.symlink = symlink
+        self.assertEqual([], ZIPImporter.get_generations(self.db_path))
+        self.assertFalse(os.path.islink(self.db_path))
+        self.assertEqual([], [filename for filename in
+                os.listdir(self.temp_dir) if filename.startswith('db.sqlite')
+                and filename != 'db.sqlite'])
+        with closing(sqlite3.connect(self.db_path)) as db_connection:
+            self.assertEqual('delete', db_connection.execute(
+                    'PRAGMA journal_mode;').fetchone()[0])
+        self.assertEqual('High St',
+                Routes.get_stop_name(self.db_path, '100'))
+        # symlinks available again, the next import publishes a generation
+        _import_quietly(self.zip_path, self.db_path)
+        self.assertTrue(os.path.islink(self.db_path))
+        self.assertEqual('Main St',
+                Routes.get_stop_name(self.db_path, '100'))
+
+
+class SyntheticFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_feed_is_deterministic(self):
+        contents = []
+        for name in ('a.zip', 'b.zip'):
+            zip_path = os.path.join(self.temp_dir, name)
+            Synthetic.write_synthetic_feed(zip_path, 20, 3, 10, 4, seed=7)
+            with open(zip_path, 'rb') as f:
+                contents.append(f.read())
+        self.assertEqual(contents[0], contents[1])
+
+    def test_feed_imports_with_expected_counts(self):
+        zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        counts = Synthetic.write_synthetic_feed(zip_path, 20, 3, 10, 4)
+        _import_quietly(zip_path, db_path)
+        db_connection = sqlite3.connect(db_path)
+        for key, table_name in (('stops', 'Stop'), ('routes', 'Route'),
+                ('trips', 'Trip'), ('stop_times', 'Stop_Trip')):
+            self.assertEqual(counts[key], db_connection.execute(
+                    'SELECT count(*) FROM %s;' % table_name).fetchone()[0])
+        db_connection.close()
+
+    def test_benchmark_result_structure(self):
+        zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        Synthetic.write_synthetic_feed(zip_path, 20, 3, 10, 4)
+        import_result = Benchmark.benchmark_import(zip_path, db_path)
+        self.assertSetEqual(set(['extract', 'routes', 'trips', 'stops',
+                'stop_times', 'stop_departures', 'stop_route_summary',
+                'stop_locations', 'indexes', 'integrity']),
+                set(import_result['phases']))
+        query_result = Benchmark.benchmark_queries(db_path, sample_stops=5)
+        self.assertSetEqual(set(Routes.BACKENDS), set(query_result))
+        json.dumps(query_result)
+        concurrency_result = Benchmark.benchmark_concurrency(db_path,
+                zip_path, thread_counts=(1, 2), queries=20)
+        self.assertSetEqual(set([1, 2]),
+                set(concurrency_result['pool']['get_stop_report']))
+        self.assertEqual(0, concurrency_result['import_under_load']['errors'])
+        self.assertTrue(
+                concurrency_result['import_under_load']['moved_to_new_generation'])
+        json.dumps(concurrency_result)
+
+    def test_benchmark_import_starts_clean(self):
+        zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        Synthetic.write_synthetic_feed(zip_path, 20, 3, 10, 4)
+        with redirect_stdout(io.StringIO()):
+            for _ in range(3):
+                Benchmark.benchmark_import(zip_path, db_path)
+        self.assertEqual([1], [number for number, _ in
+                ZIPImporter.get_generations(db_path)])
+        ZIPImporter.remove_database(db_path)
+        self.assertEqual(['feed.zip'], os.listdir(self.temp_dir))
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.temp_dir, 'feed.zip')
+        self.db_path = os.path.join(self.temp_dir, 'db.sqlite')
+        _write_sample_gtfs_zip(self.zip_path)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_import_phases_reported_to_hooks(self):
+        events = []
+        instrumentation = Instrumentation.Instrumentation([events.append],
+                trace_memory=True)
+        _import_quietly(self.zip_path, self.db_path,
+                instrumentation=instrumentation)
+        self.assertEqual(['extract', 'routes', 'trips', 'stops', 'stop_times',
+                'stop_departures', 'stop_route_summary', 'stop_locations',
+                'indexes', 'integrity'], [event['name'] for event in events])
+        rows = {event['name']: event['rows'] for event in events}
+        self.assertEqual(5, rows['stop_times'])
+        self.assertEqual(3, rows['stop_route_summary'])
+        self.assertEqual(3, rows['stop_locations'])
+        for event in events:
+            self.assertGreaterEqual(event['wall_sec'], 0)
+            self.assertIsNotNone(event['peak_traced_bytes'])
+            self.assertIn('process_peak_rss_kb', event)
+        report = json.loads(instrumentation.to_json())
+        self.assertEqual(10, len(report['phases']))
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_nested_phase_keeps_outer_traced_peak(self):
+        instrumentation = Instrumentation.Instrumentation(trace_memory=True)
+        with instrumentation.phase('outer'):
+            buffer = bytearray(8 << 20)
+            del buffer
+            with instrumentation.phase('inner'):
+                buffer = bytearray(1 << 20)
+                del buffer
+        peaks = {record['name']: record['peak_traced_bytes']
+                for record in instrumentation.phases}
+        self.assertGreaterEqual(peaks['outer'], 8 << 20)
+        self.assertGreaterEqual(peaks['inner'], 1 << 20)
+        self.assertLess(peaks['inner'], 8 << 20)
+
+    def test_trace_memory_stops_the_tracing_it_started(self):
+        instrumentation = Instrumentation.Instrumentation(trace_memory=True)
+        self.assertFalse(tracemalloc.is_tracing())
+        with instrumentation.phase('outer'):
+            with instrumentation.phase('inner'):
+                pass
+            self.assertTrue(tracemalloc.is_tracing())
+        self.assertFalse(tracemalloc.is_tracing())
+        with self.assertRaises(KeyError):
+            with instrumentation.phase('failed'):
+                raise KeyError('failed')
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(['inner', 'outer'],
+                [record['name'] for record in instrumentation.phases])
+        # tracing started by the caller is left running
+        tracemalloc.start()
+        try:
+            with instrumentation.phase('traced'):
+                pass
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+    def test_default_import_output_is_printed(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            ZIPImporter.import_into_database(self.zip_path, self.db_path)
+        self.assertIn('Processed stop_times: 5 rows', output.getvalue())
+
+    def test_query_counts_and_latency(self):
+        _import_quietly(self.zip_path, self.db_path)
+        Snapshot.export_snapshot(self.db_path)
+        for backend in Routes.BACKENDS:
+            instrumentation = Instrumentation.Instrumentation()
+            with Routes.open_session(self.db_path, backend,
+                    instrumentation) as session:
+                session.get_stop_name('100')
+                session.get_stop_name('101')
+                session.get_stop_report('100')
+                list(session.get_stop_reports(['100', '101']))
+            queries = instrumentation.report()['queries']
+            self.assertEqual(2, queries['get_stop_name']['count'], backend)
+            self.assertIn('get_stop_reports' if backend == 'sqlite'
+                    else 'get_stop_report', queries)
+            for stats in queries.values():
+                self.assertGreaterEqual(stats['mean_us'], 0)
+
+
 class TestDatabase(unittest.TestCase):
     def setUp(self):
         if not os.path.exists(DB_FILENAME):
@@ -21,7 +1674,7 @@ database file named %s in this directory''' % DB_FILENAME )
     def test_Stop_Trip_Table(self):
         cursor_obj = self.cursor.execute('SELECT * FROM Stop_Trip;')
         col_names = [desc[0] for desc in cursor_obj.description]
-        expected = set(['stop_id', 'trip_id', 'departure_time_in_sec'])
+        expected = set(['stop_key', 'trip_key', 'departure_time_in_sec'])
         self.assertSetEqual(expected, set(col_names),
             msg= "Expected : %s\nResult : %s" 
                 % (str(expected), str(col_names)))
@@ -29,7 +1682,7 @@ database file named %s in this directory''' % DB_FILENAME )
     def test_Route_Table(self):
         cursor_obj = self.cursor.execute('SELECT * FROM Route;')
         col_names = [desc[0] for desc in cursor_obj.description]
-        expected = set(['id', 'short_name', 'long_name'])
+        expected = set(['key', 'id', 'short_name', 'long_name'])
         self.assertSetEqual(expected, set(col_names),
             msg= "Expected : %s\nResult : %s" 
                 % (str(expected), str(col_names)))